@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+API call budget harness
+
+Runs `handler.scrape` (or the batch/queue handlers) against local stand-in servers for N
+accounts with M new rows per run and fails if any run makes more DKB or Google requests than
+recorded in `budgets.json`.
+"""
+
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from os import environ, path
+
+import rsa
+
+from bench.fakes import FakeDKB, FakeFinTSClient, FakeGoogle
+
+BUDGETS_FILE = path.join(path.dirname(path.abspath(__file__)), 'budgets.json')
+
+SCENARIOS = [
+    {'accounts': {'SEPA': 1}, 'rows': 10},
+    {'accounts': {'SEPA': 1}, 'rows': 1000},
+    {'accounts': {'SEPA': 1, 'CREDIT': 1, 'DEPOT': 1}, 'rows': 10},
+    {'accounts': {'SEPA': 1, 'CREDIT': 1, 'DEPOT': 1}, 'rows': 1000},
+    {'accounts': {'SEPA': 3, 'CREDIT': 2, 'DEPOT': 1}, 'rows': 100},
+    # batch mode, every tenant sees the same accounts but writes its own spreadsheet
+    {'accounts': {'SEPA': 1, 'CREDIT': 1, 'DEPOT': 1}, 'rows': 100, 'tenants': 3},
+    # coordinator + one worker draining the in-process queue
+    {'accounts': {'SEPA': 1, 'CREDIT': 1, 'DEPOT': 1}, 'rows': 100, 'queue': True},
+]
+RUNS = 2
+
+
+def scenario_name(scenario):
+    accounts = ','.join(
+        '{}={}'.format(k, v) for k, v in sorted(scenario['accounts'].items())
+    )
+    name = '{} rows={}'.format(accounts, scenario['rows'])
+    if 'tenants' in scenario:
+        name += ' tenants={}'.format(scenario['tenants'])
+    if scenario.get('queue'):
+        name += ' queue'
+    return name
+
+
+def setup_environment(dkb, google):
+    """
+    point config at the stand-in servers, has to happen before config is imported
+    """
+
+    _, private_key = rsa.newkeys(1024)
+    environ.update({
+        'DKB_BASE_URL': dkb.url + '/banking',
+        'DKB_USER': 'user',
+        'DKB_PASSWORD': 'password',
+        'GOOGLE_API_BASE_URL': google.url,
+        'GOOGLE_SHEET_NAME': 'dkb-budget',
+        'GOOGLE_SHEET_WRITER': 'writer@example.com',
+        'CREDS_CLIENT_EMAIL': 'bench@example.com',
+        'CREDS_PRIVATE_KEY': private_key.save_pkcs1().decode('utf-8'),
+        'CREDS_CLIENT_ID': 'bench',
+        'CREDS_PRIVATE_KEY_ID': 'bench',
+        'CREDS_TOKEN_URI': google.url + '/token',
+        'STATE_DIR': tempfile.mkdtemp(prefix='dkb-budget-'),
+        'QUEUE_URL': 'memory://',
+    })
+    environ['QUEUE_RESULTS_TARGET'] = path.join(environ['STATE_DIR'], 'runs')
+    # credentials of the batch tenants
+    for i in range(max(s.get('tenants', 0) for s in SCENARIOS)):
+        environ['DKB_T{}_USER'.format(i)] = 'user{}'.format(i)
+        environ['DKB_T{}_PASSWORD'.format(i)] = 'password'
+
+
+def run_scenario(handler, dkb, google, scenario):
+    from bench.generator import get_account
+
+    accounts = []
+    for account_type, count in sorted(scenario['accounts'].items()):
+        for i in range(count):
+            accounts.append(get_account(account_type, len(accounts) + 1))
+
+    dkb.accounts = accounts
+    dkb.rows = scenario['rows']
+    google.reset()
+    # every scenario starts cold, without state of the previous one
+    shutil.rmtree(environ['STATE_DIR'], ignore_errors=True)
+
+    runs = []
+    for run in range(RUNS):
+        dkb.run = run
+        dkb.reset_counts()
+        google.reset_counts()
+        with redirect_stdout(io.StringIO()) as out:
+            if 'tenants' in scenario:
+                res = handler.batch({'time_span': '30', 'tenants': [
+                    {
+                        'name': 't{}'.format(i),
+                        'credentials': 'DKB_T{}'.format(i),
+                        'sheet_name': 'dkb-budget-t{}'.format(i),
+                    } for i in range(scenario['tenants'])
+                ]}, None)
+            elif scenario.get('queue'):
+                res = handler.coordinator({'time_span': '30'}, None)
+                if res['statusCode'] == 200:
+                    res = handler.worker({}, None)
+            else:
+                res = handler.scrape({'time_span': '30'}, None)
+        if res['statusCode'] != 200:
+            raise RuntimeError('Run failed:\n{}\n{}'.format(
+                out.getvalue(), res['body']
+            ))
+        dkb_counts = dkb.counts()
+        google_counts = google.counts()
+        runs.append({
+            'dkb': sum(dkb_counts.values()),
+            'google': sum(google_counts.values()),
+            'details': {
+                'dkb': dict(dkb_counts),
+                'google': dict(google_counts),
+            },
+        })
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--update', action='store_true',
+        help='record the measured counts as the new budgets'
+    )
+    parser.add_argument('--output', help='write the json report to this file')
+    args = parser.parse_args(argv)
+
+    dkb = FakeDKB().start()
+    google = FakeGoogle().start()
+    setup_environment(dkb, google)
+
+    import handler
+    import src.dkb
+
+    # FinTS is not part of the budget, accounts come from the stand-in
+    FakeFinTSClient.dkb = dkb
+    src.dkb.FinTS3PinTanClient = FakeFinTSClient
+
+    budgets = {}
+    if path.exists(BUDGETS_FILE):
+        with open(BUDGETS_FILE) as f:
+            budgets = json.load(f)
+
+    report = {}
+    failed = []
+    try:
+        for scenario in SCENARIOS:
+            name = scenario_name(scenario)
+            runs = run_scenario(handler, dkb, google, scenario)
+            report[name] = runs
+            for i, run in enumerate(runs):
+                budget = budgets.get(name, [{}] * RUNS)[i]
+                for key in ['dkb', 'google']:
+                    limit = budget.get(key)
+                    status = 'ok'
+                    if limit is None:
+                        status = 'no budget'
+                    elif run[key] > limit:
+                        status = 'OVER BUDGET'
+                        failed.append((name, i, key, run[key], limit))
+                    elif run[key] < limit:
+                        status = 'under budget, consider --update'
+                    print('{:<44} run {} {:<6} {:>4} / {:>4}  {}'.format(
+                        name, i + 1, key, run[key],
+                        '-' if limit is None else limit, status
+                    ), file=sys.stderr)
+    finally:
+        dkb.stop()
+        google.stop()
+
+    if args.update:
+        with open(BUDGETS_FILE, 'w') as f:
+            json.dump({
+                name: [{'dkb': r['dkb'], 'google': r['google']} for r in runs]
+                for name, runs in report.items()
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        failed = []
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    if failed:
+        for name, run, key, count, limit in failed:
+            print('{} run {}: {} requests to {} exceed the budget of {}'.format(
+                name, run + 1, count, key, limit
+            ), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Categorization of synthetic transactions with a large generated rule set
+"""
+
+import argparse
+import csv
+import json
+import platform
+import random
+import re
+import string
+import time
+
+from config import get_config
+from src.categories import Categorizer, row_text
+from bench.generator import PAYEES, generate_export
+
+
+def generate_rules(count, seed=0, pattern_share=0.1):
+    """
+    `count` rules with random keywords, every tenth one a regex rule, the
+    rules matching the generated payees come last
+    """
+
+    rnd = random.Random(seed)
+
+    def word():
+        return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(5, 12)))
+
+    rules = []
+    for i in range(max(0, count - len(PAYEES))):
+        if rnd.random() < pattern_share:
+            rule = {'patterns': [r'{}\s+\d{{{}}}'.format(word(), rnd.randint(2, 6))]}
+        else:
+            rule = {'keywords': [word() for _ in range(rnd.randint(1, 4))]}
+        rule['category'] = 'category {}'.format(i)
+        rules.append(rule)
+
+    for payee in PAYEES[:count]:
+        rules.append({'category': payee.split()[0], 'keywords': [payee.lower()]})
+    return rules
+
+
+def naive_rule(rules, text):
+    """
+    the baseline, every rule tried against the text one after another
+    """
+
+    lowered = text.lower()
+    for i, rule in enumerate(rules):
+        if any(keyword.lower() in lowered for keyword in rule.get('keywords', [])):
+            return i
+        if any(re.search(p, text, re.IGNORECASE) for p in rule.get('patterns', [])):
+            return i
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--rules', type=int, default=5000)
+    parser.add_argument(
+        '--naive-rows', type=int, default=200,
+        help='rows matched with the per rule baseline, which is too slow for all rows'
+    )
+    parser.add_argument('--output', help='write the json report to this file')
+    args = parser.parse_args(argv)
+
+    fields = get_config('categories.fields.SEPA')
+    fieldnames = list(get_config('dkb.SEPA.fieldnames'))
+    idx = [fieldnames.index(name) for name in fields]
+    lines = generate_export('SEPA', args.rows).splitlines()
+    texts = [
+        row_text(row, idx) for row in csv.reader(lines[-args.rows:], delimiter=';')
+    ]
+    rules = generate_rules(args.rules)
+
+    start = time.perf_counter()
+    categorizer = Categorizer(rules)
+    compile_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [categorizer.rule(text) for text in texts]
+    compiled_s = time.perf_counter() - start
+
+    sample = texts[:args.naive_rows]
+    start = time.perf_counter()
+    naive = [naive_rule(rules, text) for text in sample]
+    naive_s = time.perf_counter() - start
+
+    if naive != compiled[:len(sample)]:
+        raise RuntimeError('Compiled and per rule matching differ')
+
+    results = [
+        {
+            'name': 'compiled',
+            'rows': len(texts),
+            'rules': len(rules),
+            'compile_s': compile_s,
+            'best_s': compiled_s,
+            'rows_per_s': len(texts) / compiled_s if compiled_s else None,
+        },
+        {
+            'name': 'per rule',
+            'rows': len(sample),
+            'rules': len(rules),
+            'best_s': naive_s,
+            'rows_per_s': len(sample) / naive_s if naive_s else None,
+        },
+    ]
+
+    output = json.dumps({
+        'meta': {
+            'python': platform.python_version(),
+            'categorized': sum(1 for x in compiled if x is not None),
+        },
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,817 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Offline regression checks of the sinks and run handling, no network access
+or credentials needed
+"""
+
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+import traceback
+from contextlib import redirect_stdout
+from datetime import date
+from os import environ, path
+
+from fints.client import FinTS3PinTanClient
+
+from bench.fakes import FakeFinTSClient
+
+CHECKS = []
+# stand-in servers of the checks that run handlers
+FAKES = {}
+
+
+def check(f):
+    CHECKS.append(f)
+    return f
+
+
+def transactions(rows, category=True):
+    """
+    parsed SEPA like account of (day, cents, payee[, category]) rows
+    """
+
+    fieldnames = ['Buchungstag', 'Betrag (EUR)', 'Auftraggeber / Begünstigter']
+    indices = {'date': [0], 'currency': [1]}
+    if category:
+        fieldnames.append('Kategorie')
+        indices['category'] = [3]
+    return {
+        'account_number': '0000000003',
+        'account_type': 'SEPA',
+        'fieldnames': fieldnames,
+        'indices': indices,
+        'transactions': [
+            [day.strftime('%x'), cents] + list(rest) for day, cents, *rest in rows
+        ],
+    }
+
+
+@check
+def columnar_keeps_dropped_columns():
+    """
+    a column missing in a later run (categories switched off) keeps its
+    history instead of replacing the partition
+    """
+
+    from src.columnar import ColumnarSink
+
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    try:
+        sink = ColumnarSink(verbose=False, target=target)
+        info = {'request_date': date(2019, 3, 31).strftime('%x')}
+        sink.add_data({'info': info, 'accounts': {'0000000003': transactions([
+            (date(2019, 3, 1), -1200, 'Hausverwaltung', 'Miete'),
+            (date(2019, 3, 2), -350, 'Cafe', 'Essen'),
+        ])}})
+        sink.add_data({'info': info, 'accounts': {'0000000003': transactions([
+            (date(2019, 3, 2), -350, 'Cafe'),
+            (date(2019, 3, 3), -999, 'Rewe'),
+        ], category=False)}})
+
+        from src.storage import get_store
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        raw = get_store(target).read(
+            'transactions/account=0000000003/month=2019-03/data.parquet'
+        )
+        table = pq.read_table(pa.BufferReader(raw)).to_pydict()
+        assert table['Auftraggeber / Begünstigter'] == ['Rewe', 'Cafe', 'Hausverwaltung'], table
+        assert table['Kategorie'] == [None, 'Essen', 'Miete'], table
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+@check
+def pending_rows_of_repeated_transactions():
+    """
+    a pending transaction of the export is kept next to a settled one of
+    the same day, description and amount the sheet already holds
+    """
+
+    from src.sheets import reconcile_pending
+
+    def rows(*statuses):
+        # settled rows have a value date
+        return [
+            '{};{};01.01.2019;Cafe;-3,50;'.format(status, '' if status == 'Nein' else value)
+            for status, value in statuses
+        ]
+
+    # status, Wertstellung, Belegdatum, Beschreibung, Betrag (EUR)
+    reconcile = [0, 'Nein', [2, 3, 4]]
+    new_rows, existing_rows = reconcile_pending(
+        rows(('Nein', 0)), rows(('Ja', '02.01.2019')), *reconcile
+    )
+    assert new_rows == rows(('Nein', 0)), new_rows
+    assert existing_rows == rows(('Ja', '02.01.2019')), existing_rows
+
+    # the second coffee settled, the first one is still pending
+    first = rows(('Ja', '02.01.2019'), ('Nein', 0))
+    new_rows, existing_rows = reconcile_pending(first, first, *reconcile)
+    assert new_rows == first and existing_rows == first, (new_rows, existing_rows)
+
+    # the pending one of the sheet settled
+    new_rows, existing_rows = reconcile_pending(
+        rows(('Ja', '02.01.2019'), ('Ja', '03.01.2019')), first, *reconcile
+    )
+    assert existing_rows == rows(('Ja', '02.01.2019')), existing_rows
+
+
+@check
+def merge_sorted_ties_and_interleaved_sources():
+    """
+    merged rows are the stable sort of all sources by date descending,
+    without repeated rows
+    """
+
+    import random
+    from datetime import datetime, timedelta
+    from src.sheets import merge_sorted
+
+    indices = {'date': [1]}
+
+    def row(day, text):
+        return 'x;{};{}'.format((datetime(2019, 3, 1) + timedelta(days=day)).strftime('%x'), text)
+
+    def expected(sources):
+        day = {r: r.split(';')[1] for rows in sources for r in rows}
+        rows = sorted(
+            [r for rows in sources for r in rows],
+            key=lambda r: datetime.strptime(day[r], '%x'), reverse=True
+        )
+        return [r for i, r in enumerate(rows) if r not in rows[:i]]
+
+    # ties keep the order of the sources, within a source and across them
+    new = [row(2, 'a'), row(1, 'b'), row(1, 'c'), row(0, 'd')]
+    existing = [row(2, 'e'), row(1, 'c'), row(1, 'f'), row(0, 'd')]
+    assert merge_sorted([new, existing], indices) == [
+        row(2, 'a'), row(2, 'e'), row(1, 'b'), row(1, 'c'), row(1, 'f'), row(0, 'd')
+    ]
+
+    rnd = random.Random(0)
+    for _ in range(200):
+        sources = []
+        for _ in range(rnd.randint(1, 4)):
+            rows = [row(rnd.randint(0, 5), rnd.choice('abcdef')) for _ in range(rnd.randint(0, 8))]
+            if rnd.random() < 0.8:
+                rows.sort(key=lambda r: datetime.strptime(r.split(';')[1], '%x'), reverse=True)
+            sources.append(rows)
+        assert merge_sorted(sources, indices) == expected(sources), sources
+
+
+@check
+def categories_of_overlapping_rules():
+    """
+    the trie and combined regexes pick the same rule as trying every rule in
+    order, the first matching one
+    """
+
+    import random
+    import re
+    from src.categories import Categorizer
+
+    rules = [
+        {'category': 'coffee', 'keywords': ['rewe to go', 'cafe']},
+        {'category': 'groceries', 'keywords': ['rewe', 'edeka'], 'patterns': ['lidl\\s*\\d+']},
+        {'category': 'rent', 'patterns': ['miete \\d{2}/\\d{4}', '(?P<m>mie)te']},
+        {'category': 'cash', 'patterns': ['^atm', '(?P<m>\\d)\\d{3}']},
+        {'category': 'repeated', 'patterns': ['(\\w)\\1{2}']},
+        {'category': 'shopping', 'keywords': ['re', 'lidl', 'cafe'], 'patterns': ['.*markt']},
+        {'category': 'empty', 'keywords': ['']},
+    ]
+
+    def first_rule(text):
+        for i, rule in enumerate(rules):
+            if any(k and k in text.lower() for k in rule.get('keywords', [])) or \
+                    any(re.search(p, text, re.IGNORECASE) for p in rule.get('patterns', [])):
+                return i
+        return None
+
+    class Chunked(Categorizer):
+        CHUNK_SIZE = 2
+
+    words = ['REWE', 'rewe to go', 'Edeka', 'Cafe', 'LIDL 42', 'lidl', 'Miete 03/2019', 'Miete',
+             'ATM', '1234', 'aaa', 'Markt', 're', 'x']
+    rnd = random.Random(0)
+    texts = [' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 4))) for _ in range(500)]
+    for categorizer in [Categorizer(rules), Chunked(rules)]:
+        for text in texts + words:
+            assert categorizer.rule(text) == first_rule(text), (text, categorizer.rule(text))
+    assert Categorizer(rules).categorize('REWE to go') == 'coffee'
+    assert Categorizer(rules).categorize('x') == ''
+
+
+@check
+def search_postings_after_documents_without_terms():
+    """
+    a segment loaded after documents without any terms keeps its offset
+    """
+
+    from src.search import SearchIndex
+
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    try:
+        def doc(key, text):
+            return {
+                'key': key, 'account': '0000000003', 'date': '2019-03-01',
+                'text': text, 'fieldnames': ['Verwendungszweck'], 'cells': [text],
+            }
+
+        index = SearchIndex(target)
+        index.add([doc('a', ''), doc('b', '--')])
+        index.add([doc('c', 'rewe')])
+        index.add([doc('d', 'edeka')])
+
+        loaded = SearchIndex(target)
+        for term, expected in [('rewe', 'rewe'), ('edeka', 'edeka')]:
+            res = loaded.search(term)
+            assert res['total'] == 1, res
+            assert res['results'][0]['row'] == {'Verwendungszweck': expected}, res
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+@check
+def search_updates_of_concurrent_workers():
+    """
+    workers adding to the same index at once keep each other's segments,
+    including the merged ones
+    """
+
+    import threading
+    from src.search import MAX_SEGMENTS, SearchIndex
+
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    try:
+        def add(i):
+            SearchIndex(target).add([{
+                'key': str(i), 'account': '0000000003', 'date': '2019-03-01',
+                'text': 'rewe', 'fieldnames': ['Verwendungszweck'], 'cells': ['rewe'],
+            }])
+
+        workers = [threading.Thread(target=add, args=(i,)) for i in range(2 * MAX_SEGMENTS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        res = SearchIndex(target).search('rewe', limit=0)
+        assert res['total'] == len(workers), res
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+@check
+def worker_indexes_per_tenant():
+    """
+    queue mode writes every tenant to its own search index
+    """
+
+    import handler
+    from bench.generator import get_account
+    from src.batch import get_tenant_target
+    from src.search import SearchIndex
+
+    dkb = FAKES['dkb']
+    dkb.accounts = [get_account('SEPA', 1)]
+    dkb.rows = 20
+    dkb.run = 0
+    tenants = [
+        {'name': 't{}'.format(i), 'credentials': 'DKB_T{}'.format(i),
+         'sheet_name': 'checks-t{}'.format(i)}
+        for i in range(2)
+    ]
+    res = handler.coordinator({'time_span': '30', 'tenants': tenants}, None)
+    assert res['statusCode'] == 200, res
+    res = handler.worker({}, None)
+    assert res['statusCode'] == 200, res
+
+    for tenant in tenants:
+        index = SearchIndex(get_tenant_target(tenant, 'search.target'))
+        assert index.search()['total'] == 20, tenant
+    assert SearchIndex().search()['total'] == 0
+
+
+@check
+def worker_finalizes_once():
+    """
+    of the workers that see the last window of a run, only the one holding
+    the lease of a step runs it, and a finished step is not run again
+    """
+
+    from bench.generator import get_account
+    from config import get_config
+    from src.lease import get_lease
+    from src.storage import get_store
+    from src.work_queue import get_queue
+    from src.worker import Worker, coordinate
+
+    dkb = FAKES['dkb']
+    google = FAKES['google']
+    dkb.accounts = [get_account('SEPA', 1), get_account('CREDIT', 2)]
+    dkb.rows = 20
+    dkb.run = 0
+    queue = get_queue()
+    results = get_store(get_config('queue.results_target'))
+    lease = get_lease()
+
+    def items():
+        run = coordinate({'time_span': '30', 'sheet_name': 'checks-finalize'}, queue, verbose=False)
+        messages = []
+        while True:
+            message = queue.get(wait=0)
+            if message is None:
+                break
+            queue.ack(message)
+            messages.append(message.body)
+        return run['run_id'], messages
+
+    worker = Worker(verbose=False)
+    try:
+        run_id, messages = items()
+        key = '{}/dashboard'.format(run_id)
+        assert lease.acquire(key, 'other-worker', 60)
+        for message in messages:
+            worker.process(message)
+        assert results.read('{}/result.json'.format(run_id)) is None
+        lease.release(key, 'other-worker')
+
+        run_id, messages = items()
+        for message in messages:
+            worker.process(message)
+        assert results.read('{}/result.json'.format(run_id)) is not None
+        # delivered again, or seen complete by a second worker
+        google.reset_counts()
+        worker.process(messages[-1])
+        assert not google.counts(), google.counts()
+    finally:
+        worker.close()
+
+
+@check
+def dashboard_written_by_another_run():
+    """
+    a dashboard another run wrote since the stored snapshot is written in
+    full instead of by the diff against the snapshot
+    """
+
+    import handler
+    from bench.generator import get_account
+
+    dkb = FAKES['dkb']
+    google = FAKES['google']
+    dkb.accounts = [get_account('SEPA', 1)]
+    dkb.rows = 20
+    dkb.run = 0
+    google.reset()
+    environ['DKB_DASHBOARD_USER'] = 'dashboard'
+    environ['DKB_DASHBOARD_PASSWORD'] = 'password'
+    tenant = {'name': 'dashboard', 'credentials': 'DKB_DASHBOARD', 'sheet_name': 'checks-dashboard'}
+
+    def dashboard():
+        spreadsheet, = google.spreadsheets.values()
+        return spreadsheet['values']['GENERATED VALUES']
+
+    res = handler.batch({'time_span': '30', 'tenants': [tenant]}, None)
+    assert res['statusCode'] == 200, res
+    written = [list(row) for row in dashboard()]
+    # another run (container) wrote the dashboard with other values
+    dashboard()[0][-1] = 'another run'
+    dashboard()[3][0] = 'another account'
+
+    res = handler.batch({'time_span': '30', 'tenants': [tenant]}, None)
+    assert res['statusCode'] == 200, res
+    assert dashboard()[3] == written[3], dashboard()
+
+
+@check
+def monthly_sums_of_checkpointed_invocations():
+    """
+    the dashboard of a run completed over several invocations shows the
+    monthly sums of every account as values
+    """
+
+    import handler
+    from bench.generator import get_account
+
+    class Context(object):
+        def get_remaining_time_in_millis(self):
+            return 0
+
+    dkb = FAKES['dkb']
+    google = FAKES['google']
+    dkb.accounts = [get_account('SEPA', 1), get_account('CREDIT', 2)]
+    dkb.rows = 20
+    dkb.run = 0
+    google.reset()
+    for pending in [1, 0]:
+        res = handler.scrape({'time_span': '30'}, Context())
+        assert res['statusCode'] == 200, res
+        assert len(json.loads(res['body'])['res']['info'].get('pending', [])) == pending, res
+
+    spreadsheet, = google.spreadsheets.values()
+    cells = [str(cell) for row in spreadsheet['values']['GENERATED VALUES'] for cell in row]
+    assert not any(cell.startswith('=QUERY') for cell in cells), cells
+
+
+@check
+def lambda_without_shared_state():
+    """
+    a default lambda deploy (local STATE_DIR) scrapes all accounts in one
+    invocation instead of checkpointing
+    """
+
+    import handler
+    from bench.generator import get_account
+
+    class Context(object):
+        def get_remaining_time_in_millis(self):
+            return 0
+
+    dkb = FAKES['dkb']
+    dkb.accounts = [get_account('SEPA', 1), get_account('CREDIT', 2)]
+    dkb.rows = 20
+    dkb.run = 0
+    environ['AWS_LAMBDA_FUNCTION_NAME'] = 'dkb-scraper-checks'
+    try:
+        res = handler.scrape({'time_span': '30'}, Context())
+    finally:
+        del environ['AWS_LAMBDA_FUNCTION_NAME']
+    assert res['statusCode'] == 200, res
+    info = json.loads(res['body'])['res']['info']
+    assert not info.get('pending'), info
+
+
+@check
+def unchanged_exports_of_another_spreadsheet():
+    """
+    an export unchanged since the last run is written again into a
+    spreadsheet created since
+    """
+
+    import handler
+    from bench.generator import get_account
+
+    dkb = FAKES['dkb']
+    google = FAKES['google']
+    dkb.accounts = [get_account('SEPA', 1)]
+    dkb.rows = 20
+    dkb.run = 0
+    environ['DKB_SCOPE_USER'] = 'scope'
+    environ['DKB_SCOPE_PASSWORD'] = 'password'
+    tenant = {'name': 'scope', 'credentials': 'DKB_SCOPE', 'sheet_name': 'checks-scope'}
+
+    for _ in range(2):
+        google.reset()
+        res = handler.batch({'time_span': '30', 'tenants': [tenant]}, None)
+        assert res['statusCode'] == 200, res
+        spreadsheet, = google.spreadsheets.values()
+        assert len(spreadsheet['values'].get('Girokonto / 0000000001', [])) == 21, res
+
+
+@check
+def run_in_progress_before_the_deadline():
+    """
+    a run overlapping one in flight answers before its invocation times out
+    """
+
+    import time
+    import handler
+    from src.batch import get_lock_key
+    from src.lease import get_lease
+
+    class Context(object):
+        def __init__(self, millis):
+            self.timeout = time.time() + millis / 1000
+
+        def get_remaining_time_in_millis(self):
+            return int((self.timeout - time.time()) * 1000)
+
+    lease = get_lease()
+    key = get_lock_key(environ['DKB_USER'], environ['GOOGLE_SHEET_NAME'])
+    assert lease.acquire(key, 'in-flight', 60)
+    try:
+        start = time.time()
+        res = handler.scrape({'time_span': '30'}, Context(int(environ['SCHEDULE_RESERVE_MS']) + 1500))
+        assert res['statusCode'] == 202, res
+        assert time.time() - start < 3, time.time() - start
+    finally:
+        lease.release(key, 'in-flight')
+
+
+@check
+def reprocess_rebuilds_the_sinks():
+    """
+    reprocessing with --rebuild replaces the worksheet and the indexed
+    transactions of an account, after the run holding the lease
+    """
+
+    import threading
+    import handler
+    from bench.generator import get_account
+    from src import archive
+    from src.batch import get_lock_key
+    from src.lease import get_lease
+    from src.search import SearchIndex
+
+    dkb = FAKES['dkb']
+    google = FAKES['google']
+    dkb.accounts = [get_account('SEPA', 1)]
+    dkb.rows = 20
+    dkb.run = 0
+    google.reset()
+    shutil.rmtree(environ['ARCHIVE_TARGET'], ignore_errors=True)
+    res = handler.scrape({'time_span': '30'}, None)
+    assert res['statusCode'] == 200, res
+
+    # rows and transactions the archive does not have
+    spreadsheet, = google.spreadsheets.values()
+    worksheet = spreadsheet['values']['Girokonto / 0000000001']
+    worksheet.append(['01.01.2000'] + worksheet[1][1:])
+    SearchIndex().add([{
+        'key': 'stale', 'account': '0000000001', 'date': '2000-01-01',
+        'text': 'stale', 'fieldnames': ['Verwendungszweck'], 'cells': ['stale'],
+    }])
+
+    lease = get_lease()
+    key = get_lock_key(environ['DKB_USER'], environ['GOOGLE_SHEET_NAME'])
+    assert lease.acquire(key, 'in-flight', 60)
+    threading.Timer(0.5, lambda: lease.release(key, 'in-flight', {'status': 'ok', 'res': {}})).start()
+    archive.main(['--rebuild', '--account', '0000000001'])
+
+    assert len(spreadsheet['values']['Girokonto / 0000000001']) == 21
+    assert SearchIndex().search('stale')['total'] == 0
+    assert SearchIndex().search(account='0000000001')['total'] == 20
+
+
+@check
+def reprocess_drops_settled_pending_rows():
+    """
+    a pending transaction of an older archived export is not written next to
+    its settled version from a newer export
+    """
+
+    from config import get_config
+    from src.archive import reconcile_exports
+
+    data = {'account_type': 'CREDIT', 'fieldnames': get_config('dkb.CREDIT.fieldnames')}
+
+    def row(status, value_date, description):
+        cells = dict(zip(data['fieldnames'], [status, value_date, '01.01.2019', description, -350]))
+        return [cells.get(name, '') for name in data['fieldnames']]
+
+    older = [row('Nein', '', 'Cafe'), row('Nein', '', 'Cafe'), row('Ja', '02.01.2019', 'Kiosk')]
+    newer = [row('Ja', '03.01.2019', 'Cafe'), row('Nein', '', 'Cafe'), row('Ja', '02.01.2019', 'Kiosk')]
+    transactions = reconcile_exports([older, newer], data)
+    # one of the coffees settled, the other one is still pending
+    assert transactions == [row('Nein', '', 'Cafe'), row('Ja', '02.01.2019', 'Kiosk')] + newer, \
+        transactions
+
+
+@check
+def holdings_recorded_at_the_fetch_time():
+    """
+    depot snapshots are recorded at the time their export was fetched, not
+    when they are written
+    """
+
+    from bench.generator import generate_export, get_account
+    from src.dkb import DKBSession
+    from src.holdings import HoldingsSink, to_positions
+
+    session = DKBSession(username=None, password=None, verbose=False)
+    data = session.parse_export(get_account('DEPOT', 2), generate_export('DEPOT', 5))
+    sink = HoldingsSink(verbose=False, target=tempfile.mkdtemp(prefix='dkb-checks-'))
+    try:
+        sink.add_data({
+            'info': {'fetched_at': '2019-01-02T10:00:00Z'},
+            'accounts': {data['account_number']: data},
+        })
+        assert sink.store.as_of(data['account_number'], '2019-01-02T09:59:59Z') == {}
+        assert sink.store.as_of(data['account_number'], '2019-01-02T10:00:00Z') == \
+            to_positions(data)
+    finally:
+        shutil.rmtree(sink.target, ignore_errors=True)
+
+
+@check
+def holdings_as_of_every_snapshot():
+    """
+    the delta encoded holdings at any time, across monthly segments, are the
+    snapshot recorded last before it
+    """
+
+    from datetime import datetime, timedelta
+    from src.holdings import HoldingsStore
+
+    def position(quantity):
+        return {'isin': 'DE0005140008', 'wkn': '', 'name': 'Deutsche Bank',
+                'quantity': quantity, 'price': '10.00', 'value': str(quantity * 10)}
+
+    snapshots = [
+        {'A': position(1)},
+        {'A': position(2), 'B': position(5)},
+        {'A': position(2), 'B': position(5)},
+        {'B': position(6)},
+        {},
+        {'A': position(3), 'C': position(1)},
+    ]
+    start = datetime(2019, 1, 30, 12)
+    times = [start + timedelta(days=10 * i) for i in range(len(snapshots))]
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    try:
+        store = HoldingsStore(target)
+        for positions, when in zip(snapshots, times):
+            store.record('0000000002', positions, when)
+
+        assert store.as_of('0000000002', start - timedelta(seconds=1)) == {}
+        for positions, when in zip(snapshots, times):
+            assert store.as_of('0000000002', when) == positions, when
+            assert store.as_of('0000000002', when + timedelta(days=9)) == positions, when
+
+        series = store.series('0000000002', 'A')
+        assert [(ts, position and position['quantity']) for ts, _, position in series] == [
+            (times[0].strftime('%Y-%m-%dT%H:%M:%SZ'), 1),
+            (times[1].strftime('%Y-%m-%dT%H:%M:%SZ'), 2),
+            (times[3].strftime('%Y-%m-%dT%H:%M:%SZ'), None),
+            (times[5].strftime('%Y-%m-%dT%H:%M:%SZ'), 3),
+        ], series
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+@check
+def scheduler_runs_units_above_the_budget():
+    """
+    a unit estimated above the whole budget of an invocation is not left
+    pending forever
+    """
+
+    from src.scheduler import Scheduler
+    from src.state import save_state
+
+    class Deadline(object):
+        def remaining(self):
+            return int(environ['SCHEDULE_RESERVE_MS']) + 1000
+
+    name = 'checkpoint-checks-budget'
+    save_state(name, {'durations': {'big': 60000, 'small': 10}})
+    done = []
+    for _ in range(2):
+        scheduler = Scheduler(name, 'key', Deadline(), verbose=False)
+        scheduler.run([('big', 'big'), ('small', 'small')], lambda unit: done.append(unit))
+    assert done == ['small', 'big'], done
+    assert not scheduler.pending, scheduler.pending
+
+
+@check
+def cassette_without_credentials():
+    """
+    a recorded login keeps no password, session cookie or bearer token
+    """
+
+    import gzip
+    from urllib.parse import parse_qsl
+    from uuid import uuid4
+    import handler
+    from bench.generator import get_account
+    from src.cassette import REDACTED, REDACTED_HEADERS, get_cassette
+    from src.storage import get_store
+
+    dkb = FAKES['dkb']
+    dkb.accounts = [get_account('SEPA', 1)]
+    dkb.rows = 5
+    dkb.run = 0
+    cassette = get_cassette()
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    password = environ['DKB_PASSWORD']
+    environ['DKB_PASSWORD'] = uuid4().hex
+    try:
+        cassette.mode, cassette.target = 'record', target
+        res = handler.scrape({'time_span': '30'}, None)
+        assert res['statusCode'] == 200, res
+        content = gzip.decompress(get_store(target).read(cassette.name)).decode('utf-8')
+        secrets = [environ['DKB_PASSWORD'], dkb.session_id, 'fake-token', 'Bearer']
+    finally:
+        environ['DKB_PASSWORD'] = password
+        cassette.mode = 'off'
+        shutil.rmtree(target, ignore_errors=True)
+
+    for secret in secrets:
+        assert secret not in content, secret
+    interactions = json.loads(content)['interactions']
+    for interaction in interactions:
+        for message in [interaction['request'], interaction['response']]:
+            for name, value in message['headers'].items():
+                assert name.lower() not in REDACTED_HEADERS or value == REDACTED, (name, value)
+    login, = [
+        dict(parse_qsl(i['request']['body']['text'])) for i in interactions
+        if 'j_password' in (i['request']['body'] or {}).get('text', '')
+    ]
+    assert login['j_password'] == login['j_username'] == REDACTED, login
+    # the session cookie was sent after the login
+    assert any('Cookie' in i['request']['headers'] for i in interactions)
+
+
+@check
+def replay_without_network():
+    """
+    a recorded scrape replays without any connection, FinTS included
+    """
+
+    import socket
+    import handler
+    import src.dkb
+    from bench.generator import get_account
+    from src.cassette import Cassette, get_cassette
+
+    dkb = FAKES['dkb']
+    dkb.accounts = [get_account('SEPA', 1), get_account('DEPOT', 2)]
+    dkb.rows = 20
+    dkb.run = 0
+    cassette = get_cassette()
+    target = tempfile.mkdtemp(prefix='dkb-checks-')
+    connect = socket.socket.connect
+    try:
+        cassette.mode, cassette.target = 'record', target
+        res = handler.scrape({'time_span': '30'}, None)
+        assert res['statusCode'] == 200, res
+
+        recorded = Cassette('replay', target, cassette.name, verbose=False)
+        cassette.mode = 'replay'
+        cassette.interactions, cassette.state = recorded.interactions, recorded.state
+        dkb.reset_counts()
+        FAKES['google'].reset_counts()
+
+        def refuse(sock, address):
+            raise AssertionError('replay connects to {}'.format(address))
+
+        socket.socket.connect = refuse
+        # the real client, it must not be asked
+        src.dkb.FinTS3PinTanClient = FinTS3PinTanClient
+        res = handler.scrape({'time_span': '30'}, None)
+        assert res['statusCode'] == 200, res
+        assert not dkb.counts() and not FAKES['google'].counts()
+    finally:
+        socket.socket.connect = connect
+        src.dkb.FinTS3PinTanClient = FakeFinTSClient
+        cassette.mode = 'off'
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def setup():
+    """
+    stand-in servers and environment, before the configuration is loaded
+    """
+
+    from bench import budget
+    from bench.fakes import FakeDKB, FakeGoogle
+
+    FAKES['dkb'] = FakeDKB().start()
+    FAKES['google'] = FakeGoogle().start()
+    budget.setup_environment(FAKES['dkb'], FAKES['google'])
+    environ['SINKS'] = 'gsheet,search'
+    environ['SCHEDULE_RESERVE_MS'] = '500'
+    environ['ARCHIVE'] = 'true'
+    environ['ARCHIVE_TARGET'] = path.join(environ['STATE_DIR'], 'archive')
+    environ['SEARCH_TARGET'] = path.join(environ['STATE_DIR'], 'search')
+    environ['COLUMNAR_TARGET'] = path.join(environ['STATE_DIR'], 'columnar')
+
+    import src.dkb
+
+    FakeFinTSClient.dkb = FAKES['dkb']
+    src.dkb.FinTS3PinTanClient = FakeFinTSClient
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('names', nargs='*', help='only these checks')
+    args = parser.parse_args(argv)
+
+    setup()
+    failed = 0
+    for f in CHECKS:
+        if args.names and f.__name__ not in args.names:
+            continue
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                f()
+            print('{:60} ok'.format(f.__name__))
+        except Exception:
+            failed += 1
+            print('{:60} FAILED'.format(f.__name__))
+            print(out.getvalue())
+            traceback.print_exc()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
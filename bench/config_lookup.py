@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Per lookup cost of configuration access
+"""
+
+import argparse
+import json
+import platform
+import timeit
+
+import jmespath
+
+import config
+from config import get_config, thaw
+
+__plain = {'dkb': {'formats': {'date': '%d.%m.%Y'}}}
+
+LOOKUPS = [
+    ('plain dict items (baseline)', lambda: __plain['dkb']['formats']['date']),
+    ('attribute', lambda: config.config.dkb.formats.date),
+    ('get_config dotted path', lambda: get_config('dkb.formats.date')),
+    ('get_config relative path', lambda: get_config('formats.date', config.config.dkb)),
+    ('get_config jmespath expression', lambda: get_config('dkb.SEPA.keys.date[0]')),
+]
+
+
+def legacy_lookup():
+    """
+    the previous get_config: merge the stage into the defaults and search from scratch
+    """
+
+    cfg = __legacy['default']
+    if config.env in __legacy:
+        __merge(__legacy[config.env], cfg)
+    return jmespath.search('dkb.formats.date', cfg)
+
+
+__legacy = thaw(config.freeze(config.stages))
+__merge = getattr(config, '__merge')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--output', help='write the json report to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, fn in LOOKUPS + [('legacy merge + jmespath.search', legacy_lookup)]:
+        number = args.number if fn is not legacy_lookup else max(1, args.number // 100)
+        best = min(timeit.repeat(fn, number=number, repeat=3))
+        results.append({
+            'name': name,
+            'number': number,
+            'ns_per_lookup': best / number * 1e9,
+        })
+
+    output = json.dumps({
+        'meta': {'python': platform.python_version()},
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Local stand-in servers for the DKB banking pages and the Google Sheets/Drive
+APIs. Every request is counted by route so API call budgets can be checked.
+"""
+
+import gzip
+import json
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+from uuid import uuid4
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """
+    Threaded local http server counting requests per route
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.RLock()
+        self.httpd = ThreadingServer(('127.0.0.1', 0), self.__handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def counts(self):
+        with self.lock:
+            return Counter(route for _, route in self.calls)
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = []
+
+    def record(self, method, route):
+        with self.lock:
+            self.calls.append((method, route))
+
+    def handle(self, method, path, query, body):
+        """
+        return (status, content_type, body) for a request, optionally
+        followed by a dict of extra headers
+        """
+
+        raise NotImplementedError
+
+    def __handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def __respond(self):
+                parts = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    status, content_type, content, *headers = server.handle(
+                        self.command, parts.path, parse_qs(parts.query), body
+                    )
+                except Exception as e:
+                    status, content_type, content, headers = 500, 'text/plain', str(e), []
+
+                if isinstance(content, str):
+                    content = content.encode('utf-8')
+                encoding = None
+                if len(content) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    content = gzip.compress(content)
+                    encoding = 'gzip'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                for name, value in (headers[0] if headers else {}).items():
+                    self.send_header(name, value)
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = __respond
+            do_POST = __respond
+            do_PUT = __respond
+            do_DELETE = __respond
+
+        return Handler
+
+
+LOGIN_PAGE = '''<html><body>
+<form action="/banking" method="post" name="login">
+<input type="text" name="j_username" value="">
+<input type="password" name="j_password" value="">
+<input type="hidden" name="$event" value="login">
+</form>
+</body></html>'''
+
+FINANZSTATUS_PAGE = '''<html><body>
+<h1>Finanzstatus</h1>
+<a id="logout" href="/logout">Abmelden</a>
+</body></html>'''
+
+
+class FakeDKB(FakeServer):
+    """
+    DKB online banking stand-in serving synthetic csv exports
+
+    `accounts` are account dicts as returned by `DKBSession.get_accounts`,
+    every export contains `rows` transactions which are new for each `run`
+    """
+
+    def __init__(self, accounts=[], rows=100):
+        super().__init__()
+        self.accounts = accounts
+        self.rows = rows
+        self.run = 0
+        # cookie of the last login
+        self.session_id = None
+
+    def __selectable(self):
+        return [a for a in self.accounts if a['account_type'] != 'DEPOT']
+
+    def __depots(self):
+        return [a for a in self.accounts if a['account_type'] == 'DEPOT']
+
+    def __init_page(self):
+        options = []
+        for i, account in enumerate(self.__selectable()):
+            number = account['account_number']
+            if account['account_type'] == 'CREDIT':
+                number = number[:4] + '*' * (len(number) - 8) + number[-4:]
+            else:
+                number = ' '.join(
+                    number[x:x + 4] for x in range(0, len(number), 4)
+                )
+            options.append('<option value="{0}" tid="{0}">{1} / {2}</option>'.format(
+                i, number, account['product_name']
+            ))
+        return '<html><body><select name="slAllAccounts">{}</select></body></html>'.format(
+            ''.join(options)
+        )
+
+    def __export(self, account):
+        # imported lazily as config is read from the environment on import
+        from bench.generator import generate_export
+
+        seed = int(re.sub(r'\D', '', account['account_number'])[-6:]) * 1000
+        return generate_export(
+            account['account_type'],
+            self.rows,
+            seed=seed + self.run,
+            end_date=datetime(2019, 4, 1) + timedelta(days=30 * self.run),
+            days=29
+        )
+
+    def handle(self, method, path, query, body):
+        event = query.get('$event', [None])[0]
+        if path == '/banking' and method == 'GET':
+            self.record(method, 'login_page')
+            return 200, 'text/html', LOGIN_PAGE
+        if path == '/banking' and method == 'POST':
+            self.record(method, 'login')
+            self.session_id = uuid4().hex
+            return 200, 'text/html', FINANZSTATUS_PAGE, {
+                'Set-Cookie': 'JSESSIONID={}; Path=/'.format(self.session_id)
+            }
+        if path == '/banking/logout':
+            self.record(method, 'logout')
+            return 200, 'text/html', '<html><body>Logged out</body></html>'
+
+        if event == 'init':
+            self.record(method, 'init')
+            return 200, 'text/html', self.__init_page()
+        if event == 'search':
+            self.record(method, 'search')
+            return 200, 'text/html', '<html><body>Umsätze</body></html>'
+        if event == 'csvExport':
+            self.record(method, 'export')
+            if path.endswith('depotstatus'):
+                account = self.__depots()[int(query['slPortfolio'][0])]
+            else:
+                account = self.__selectable()[int(query['slAllAccounts'][0])]
+            return 200, 'text/csv; charset=utf-8', self.__export(account)
+
+        self.record(method, 'unknown')
+        return 404, 'text/plain', 'not found'
+
+
+class FakeFinTSClient(object):
+    """
+    FinTS client stand-in discovering the accounts of a FakeDKB, the account
+    discovery is not counted
+    Usage
+    -----
+    >>> FakeFinTSClient.dkb = FakeDKB().start()
+    >>> src.dkb.FinTS3PinTanClient = FakeFinTSClient
+    """
+
+    dkb = None
+
+    def __init__(self, blz, username, pin, url):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_information(self):
+        return {'accounts': [
+            dict(account, supported_operations={}, bank_identifier=None)
+            for account in self.dkb.accounts
+        ]}
+
+    def deconstruct(self):
+        pass
+
+
+def col_to_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def parse_a1(label):
+    """
+    "Sheet!A1:C3" -> (title, start_row, start_col, end_row, end_col)
+    with zero based indices and None for unbounded ends
+    """
+
+    title, _, cells = label.rpartition('!')
+    if not title:
+        return cells.strip("'"), 0, 0, None, None
+    bounds = []
+    for part in cells.split(':'):
+        letters, digits = re.match(r'([A-Z]*)(\d*)', part).groups()
+        bounds.append((
+            int(digits) - 1 if digits else None,
+            col_to_index(letters) if letters else None,
+        ))
+    if len(bounds) == 1:
+        bounds.append(bounds[0])
+    (start_row, start_col), (end_row, end_col) = bounds
+    return title.strip("'"), start_row or 0, start_col or 0, end_row, end_col
+
+
+class FakeGoogle(FakeServer):
+    """
+    Google token, Drive v3 and Sheets v4 stand-in keeping sheets in memory
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.spreadsheets = {}
+        self.__next_id = 1
+
+    def reset(self):
+        with self.lock:
+            self.spreadsheets = {}
+
+    def __new_id(self):
+        with self.lock:
+            self.__next_id += 1
+            return self.__next_id
+
+    def __add_sheet(self, spreadsheet, properties):
+        sheet_id = properties.get('sheetId', self.__new_id())
+        grid = properties.get('gridProperties', {})
+        props = {
+            **properties,
+            'sheetId': sheet_id,
+            'index': len(spreadsheet['sheets']),
+            'sheetType': 'GRID',
+            'gridProperties': {
+                'rowCount': int(grid.get('rowCount', 1000)),
+                'columnCount': int(grid.get('columnCount', 26)),
+            }
+        }
+        spreadsheet['sheets'].append({'properties': props})
+        spreadsheet['values'][props['title']] = []
+        return props
+
+    def __create(self, body):
+        spreadsheet_id = 'sheet{}'.format(self.__new_id())
+        spreadsheet = {
+            'spreadsheetId': spreadsheet_id,
+            'properties': body.get('properties', {}),
+            'sheets': [],
+            'values': {},
+        }
+        for sheet in body.get('sheets', []):
+            self.__add_sheet(spreadsheet, sheet['properties'])
+        self.spreadsheets[spreadsheet_id] = spreadsheet
+        return self.__metadata(spreadsheet)
+
+    def __metadata(self, spreadsheet):
+        return {
+            'spreadsheetId': spreadsheet['spreadsheetId'],
+            'properties': spreadsheet['properties'],
+            'sheets': spreadsheet['sheets'],
+        }
+
+    def __grid_data(self, spreadsheet, labels):
+        """
+        sheets with the cells of the requested ranges, values as entered
+        """
+
+        sheets = []
+        for sheet in spreadsheet['sheets']:
+            data = [
+                {'rowData': [
+                    {'values': [{
+                        'effectiveValue': {'stringValue': value},
+                        'formattedValue': value,
+                    } for value in row]}
+                    for row in self.__values_get(spreadsheet, label).get('values', [])
+                ]}
+                for label in labels
+                if parse_a1(label)[0] == sheet['properties']['title']
+            ]
+            sheets.append(dict(sheet, data=data) if data else sheet)
+        return sheets
+
+    def __batch_update(self, spreadsheet, body):
+        replies = []
+        for request in body.get('requests', []):
+            reply = {}
+            if 'addSheet' in request:
+                props = self.__add_sheet(
+                    spreadsheet, request['addSheet']['properties']
+                )
+                reply = {'addSheet': {'properties': props}}
+            elif 'deleteSheet' in request:
+                sheet_id = request['deleteSheet']['sheetId']
+                for sheet in list(spreadsheet['sheets']):
+                    if sheet['properties']['sheetId'] == sheet_id:
+                        spreadsheet['sheets'].remove(sheet)
+                        del spreadsheet['values'][sheet['properties']['title']]
+            elif 'updateSheetProperties' in request:
+                props = request['updateSheetProperties']['properties']
+                for sheet in spreadsheet['sheets']:
+                    if sheet['properties']['sheetId'] == props['sheetId']:
+                        grid = props.get('gridProperties', {})
+                        sheet['properties']['gridProperties'].update(grid)
+            replies.append(reply)
+        return {'spreadsheetId': spreadsheet['spreadsheetId'], 'replies': replies}
+
+    def __values_get(self, spreadsheet, label, unformatted=False):
+        title, start_row, start_col, end_row, end_col = parse_a1(label)
+        rows = spreadsheet['values'][title]
+        end_row = len(rows) - 1 if end_row is None else end_row
+        values = []
+        for row in rows[start_row:end_row + 1]:
+            row = row[start_col:None if end_col is None else end_col + 1]
+            values.append([
+                '' if v is None else v if unformatted else str(v) for v in row
+            ])
+        for row in values:
+            while row and row[-1] == '':
+                row.pop()
+        while values and not values[-1]:
+            values.pop()
+        res = {'range': label, 'majorDimension': 'ROWS'}
+        if values:
+            res['values'] = values
+        return res
+
+    def __values_update(self, spreadsheet, label, body):
+        title, start_row, start_col, _, _ = parse_a1(label)
+        rows = spreadsheet['values'][title]
+        updated = 0
+        for x, values in enumerate(body.get('values', [])):
+            while len(rows) <= start_row + x:
+                rows.append([])
+            row = rows[start_row + x]
+            for y, value in enumerate(values):
+                if value is None:
+                    continue
+                while len(row) <= start_col + y:
+                    row.append('')
+                row[start_col + y] = value
+                updated += 1
+        return {'updatedRange': label, 'updatedCells': updated}
+
+    def __values_clear(self, spreadsheet, label):
+        title, start_row, start_col, end_row, end_col = parse_a1(label)
+        rows = spreadsheet['values'][title]
+        end_row = len(rows) - 1 if end_row is None else end_row
+        for row in rows[start_row:end_row + 1]:
+            stop = len(row) if end_col is None else min(len(row), end_col + 1)
+            for y in range(start_col, stop):
+                row[y] = ''
+        return {'clearedRange': label}
+
+    def handle(self, method, path, query, body):
+        data = json.loads(body.decode('utf-8')) if body and body[:1] in b'{[' else {}
+
+        if path == '/token':
+            self.record(method, 'token')
+            return 200, 'application/json', json.dumps({
+                'access_token': 'fake-token',
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+            })
+
+        if path == '/drive/v3/files' and method == 'GET':
+            self.record(method, 'drive.list')
+            return 200, 'application/json', json.dumps({'files': [
+                {
+                    'id': s['spreadsheetId'],
+                    'name': s['properties'].get('title'),
+                    'mimeType': 'application/vnd.google-apps.spreadsheet',
+                } for s in self.spreadsheets.values()
+            ]})
+
+        if path.startswith('/drive/v3/files/') and path.endswith('/permissions'):
+            self.record(method, 'drive.permissions')
+            return 200, 'application/json', '{}'
+
+        if path == '/v4/spreadsheets' and method == 'POST':
+            self.record(method, 'spreadsheets.create')
+            return 200, 'application/json', json.dumps(self.__create(data))
+
+        match = re.match(r'^/v4/spreadsheets/([^/:]+)(.*)$', path)
+        if not match or match.group(1) not in self.spreadsheets:
+            self.record(method, 'unknown')
+            return 404, 'application/json', json.dumps({'error': {
+                'code': 404, 'message': 'Requested entity was not found.'
+            }})
+
+        spreadsheet = self.spreadsheets[match.group(1)]
+        rest = match.group(2)
+        if rest == '' and any(
+            parse_a1(label)[0] not in spreadsheet['values'] for label in query.get('ranges', [])
+        ):
+            self.record(method, 'spreadsheets.get')
+            return 400, 'application/json', json.dumps({'error': {
+                'code': 400, 'message': 'Unable to parse range', 'status': 'INVALID_ARGUMENT'
+            }})
+        with self.lock:
+            if rest == '':
+                self.calls.append((method, 'spreadsheets.get'))
+                res = self.__metadata(spreadsheet)
+                if query.get('includeGridData', ['false'])[0] == 'true':
+                    res['sheets'] = self.__grid_data(spreadsheet, query.get('ranges', []))
+            elif rest == ':batchUpdate':
+                self.calls.append((method, 'spreadsheets.batchUpdate'))
+                res = self.__batch_update(spreadsheet, data)
+            elif rest == '/values:batchUpdate':
+                self.calls.append((method, 'values.batchUpdate'))
+                res = {'responses': [
+                    self.__values_update(spreadsheet, item['range'], item)
+                    for item in data.get('data', [])
+                ]}
+            elif rest.startswith('/values/') and rest.endswith(':clear'):
+                self.calls.append((method, 'values.clear'))
+                label = unquote(rest[len('/values/'):-len(':clear')])
+                res = self.__values_clear(spreadsheet, label)
+            elif rest.startswith('/values/') and method == 'GET':
+                self.calls.append((method, 'values.get'))
+                res = self.__values_get(
+                    spreadsheet, unquote(rest[len('/values/'):]),
+                    query.get('valueRenderOption', [None])[0] == 'UNFORMATTED_VALUE'
+                )
+            elif rest.startswith('/values/') and method == 'PUT':
+                self.calls.append((method, 'values.update'))
+                res = self.__values_update(
+                    spreadsheet, unquote(rest[len('/values/'):]), data
+                )
+            else:
+                self.calls.append((method, 'unknown'))
+                return 404, 'application/json', '{}'
+
+        return 200, 'application/json', json.dumps(res)
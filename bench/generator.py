@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+
+from config import get_config
+
+PAYEES = [
+    'REWE Markt GmbH',
+    'EDEKA Zentrale',
+    'Amazon EU S.a.r.l.',
+    'Deutsche Bahn AG',
+    'Stadtwerke Muenchen',
+    'Vodafone GmbH',
+    'Hausverwaltung Schmidt',
+    'Arbeitgeber GmbH',
+    'Finanzamt Berlin',
+    'Netflix International B.V.',
+    'Spotify AB',
+    'Allianz Versicherungs-AG',
+]
+BOOKING_TEXTS = [
+    'Lastschrift',
+    'Gutschrift',
+    'Kartenzahlung',
+    'Dauerauftrag',
+    'Überweisung',
+    'Folgelastschrift',
+]
+PURPOSES = [
+    'Miete {}',
+    'Einkauf {}',
+    'Gehalt {}',
+    'Rechnung Nr. {}',
+    'Vertragsnummer {}',
+    'Abo {}',
+]
+SECURITIES = [
+    ('DE0005140008 / 514000', 'DEUTSCHE BANK AG NA O.N.'),
+    ('IE00B4L5Y983 / A0RPWH', 'ISHSIII-CORE MSCI WORLD U.ETF'),
+    ('US0378331005 / 865985', 'APPLE INC.'),
+    ('DE0007164600 / 716460', 'SAP SE O.N.'),
+    ('LU0274208692 / DBX1MW', 'XTR.MSCI WORLD 1C'),
+]
+
+
+def format_amount(value):
+    """
+    format a float the way DKB exports amounts (1.234,56)
+    """
+
+    formatted = '{:,.2f}'.format(value)
+    return formatted.replace(',', ' ').replace('.', ',').replace(' ', '.')
+
+
+def quote(row):
+    return ';'.join('"{}"'.format(cell) for cell in row) + ';'
+
+
+def __dates(rnd, rows, end_date, days):
+    """
+    descending booking dates spread over the last `days` days
+    """
+
+    offsets = sorted(rnd.randint(0, days) for _ in range(rows))
+    return [end_date - timedelta(days=offset) for offset in offsets]
+
+
+def __sepa_row(rnd, day, date_format):
+    booked = day.strftime(date_format)
+    amount = rnd.uniform(-1500, 300)
+    if rnd.random() < 0.02:
+        amount = rnd.uniform(1500, 4500)
+    return [
+        booked,
+        booked,
+        rnd.choice(BOOKING_TEXTS),
+        rnd.choice(PAYEES),
+        rnd.choice(PURPOSES).format(rnd.randint(10000, 99999)),
+        'DE{:020d}'.format(rnd.randint(0, 10 ** 20 - 1)),
+        'BYLADEM1001',
+        format_amount(amount),
+        'DE98ZZZ{:011d}'.format(rnd.randint(0, 10 ** 11 - 1)),
+        'M{:08d}'.format(rnd.randint(0, 10 ** 8 - 1)),
+        'K{:08d}'.format(rnd.randint(0, 10 ** 8 - 1)),
+    ]
+
+
+def __credit_row(rnd, day, date_format):
+    amount = rnd.uniform(-400, 50)
+    return [
+        'Ja' if rnd.random() < 0.9 else 'Nein',
+        day.strftime(date_format),
+        (day - timedelta(days=rnd.randint(0, 3))).strftime(date_format),
+        '{} {}'.format(rnd.choice(PAYEES), rnd.randint(100, 999)),
+        format_amount(amount),
+        '' if rnd.random() < 0.8 else '{} USD'.format(format_amount(amount * 1.1)),
+    ]
+
+
+def __depot_row(rnd, day, date_format):
+    isin, name = rnd.choice(SECURITIES)
+    stock = rnd.randint(1, 500)
+    price = rnd.uniform(5, 300)
+    cost = stock * price * rnd.uniform(0.7, 1.3)
+    return [
+        format_amount(stock),
+        'Stück',
+        isin,
+        name,
+        format_amount(price),
+        format_amount(stock * price - cost),
+        'EUR',
+        format_amount(cost),
+        'EUR',
+        format_amount(1),
+        format_amount(stock * price),
+        'Frei',
+    ]
+
+
+__ROW_FACTORIES = {
+    'SEPA': __sepa_row,
+    'CREDIT': __credit_row,
+    'DEPOT': __depot_row,
+}
+
+
+def generate_export(account_type, rows, seed=0, end_date=None, days=3 * 365):
+    """
+    generate a synthetic DKB csv export matching the configured fieldnames
+    """
+
+    cfg = get_config('dkb')
+    account_cfg = cfg[account_type]
+    date_format = cfg['formats']['date']
+    fieldnames = account_cfg['fieldnames']
+    end_date = end_date or datetime(2019, 4, 1)
+
+    rnd = random.Random(seed)
+    factory = __ROW_FACTORIES[account_type]
+    total_label = account_cfg['keys']['total']
+    if not total_label.endswith(':'):
+        total_label = '{} vom {}:'.format(
+            total_label, end_date.strftime(date_format)
+        )
+    lines = [
+        quote(['Kontonummer:', 'DE12120300001234567890 / Girokonto']),
+        quote(['']),
+        quote(['Von:', (end_date - timedelta(days=days)).strftime(date_format)]),
+        quote(['Bis:', end_date.strftime(date_format)]),
+        quote([
+            total_label,
+            '{} EUR'.format(format_amount(rnd.uniform(-5000, 50000)))
+        ]),
+        quote(['']),
+        quote(fieldnames[:-1]),
+    ]
+    for day in __dates(rnd, rows, end_date, days):
+        lines.append(quote(factory(rnd, day, date_format)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_account(account_type, number=1):
+    """
+    account info as returned by the FinTS discovery
+    """
+
+    account_number = '{:010d}'.format(number)
+    if account_type == 'CREDIT':
+        account_number = '4748{:012d}'.format(number)
+
+    return {
+        'account_number': account_number,
+        'customer_id': 'user',
+        'currency': 'EUR',
+        'owner_name': 'Max Mustermann',
+        'product_name': {
+            'SEPA': 'Girokonto',
+            'CREDIT': 'Visa Kreditkarte',
+            'DEPOT': 'Depot',
+        }[account_type],
+        'type': {'SEPA': 1, 'CREDIT': 50, 'DEPOT': 30}[account_type],
+        'account_type': account_type,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic DKB csv export'
+    )
+    parser.add_argument('account_type', choices=sorted(__ROW_FACTORIES))
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.stdout.write(generate_export(args.account_type, args.rows, args.seed))
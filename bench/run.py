@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import csv
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+from gspread.models import Cell
+
+from config import get_config
+from src.dkb import DKBSession
+from src.sheets import merge_rows, merge_sorted, fill_cells, monthly_sums
+from src.utils import to_cents
+from bench.generator import generate_export, get_account
+
+
+def measure(fn, repeat):
+    """
+    run `fn` `repeat` times and return the timings in seconds
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def result(name, account_type, rows, timings):
+    best = min(timings)
+    return {
+        'name': name,
+        'account_type': account_type,
+        'rows': rows,
+        'repeat': len(timings),
+        'best_s': best,
+        'mean_s': sum(timings) / len(timings),
+        'rows_per_s': rows / best if best else None,
+    }
+
+
+def bench_account(session, account_type, rows, repeat):
+    account = get_account(account_type)
+    text = generate_export(account_type, rows)
+    results = []
+
+    parsed = session.parse_export(dict(account), text)
+    results.append(result(
+        'parse_export', account_type, rows,
+        measure(lambda: session.parse_export(dict(account), text), repeat)
+    ))
+
+    lines = text.splitlines()
+    currency_col = parsed['indices']['currency'][0]
+    amounts = [
+        row[currency_col] for row in csv.reader(
+            lines[len(lines) - len(parsed['transactions']):], delimiter=';'
+        )
+    ]
+    results.append(result(
+        'to_cents', account_type, rows,
+        measure(lambda: [to_cents(x) for x in amounts], repeat)
+    ))
+
+    if 'date' not in parsed['indices']:
+        return results
+
+    indices = parsed['indices']
+    new_rows = [';'.join(map(str, x)) for x in parsed['transactions']]
+    existing_rows = new_rows[len(new_rows) // 10:]
+    results.append(result(
+        'merge_rows', account_type, rows,
+        measure(lambda: merge_rows(new_rows, existing_rows, indices), repeat)
+    ))
+
+    # the export split into date windows, merged with the existing rows at once
+    size = len(new_rows) // 4 + 1
+    windows = [new_rows[i:i + size] for i in range(0, len(new_rows), size)]
+    results.append(result(
+        'merge_sorted windows', account_type, rows,
+        measure(lambda: merge_sorted(windows + [existing_rows], indices), repeat)
+    ))
+
+    merged = merge_rows(new_rows, existing_rows, indices)
+    results.append(result(
+        'monthly_sums', account_type, rows,
+        measure(lambda: monthly_sums(merged, indices), repeat)
+    ))
+
+    header = parsed['fieldnames']
+    unique_rows = [';'.join(header)] + merged
+
+    def cells():
+        grid = [
+            Cell(x, y)
+            for x in range(1, len(unique_rows) + 1)
+            for y in range(1, len(header) + 1)
+        ]
+        return fill_cells(grid, unique_rows, indices)
+
+    results.append(result(
+        'fill_cells', account_type, rows,
+        measure(cells, repeat)
+    ))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks of the parsing and sheet preparation steps'
+    )
+    parser.add_argument(
+        '--sizes', default='1000,10000,100000',
+        help='comma separated row counts (1k - 500k)'
+    )
+    parser.add_argument('--types', default='SEPA,CREDIT,DEPOT')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the json report to this file')
+    args = parser.parse_args(argv)
+
+    session = DKBSession(username=None, password=None, verbose=False)
+    results = []
+    for account_type in args.types.split(','):
+        for rows in map(int, args.sizes.split(',')):
+            print('Benchmarking {} with {} rows'.format(account_type, rows),
+                  file=sys.stderr)
+            results += bench_account(session, account_type, rows, args.repeat)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'locale': get_config('gsheet.locale'),
+        },
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from os import environ
+from copy import deepcopy
 import locale
 import jmespath
 from dotenv import load_dotenv
@@ -19,24 +20,220 @@ def __merge(source, destination):
     return destination
 
 
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenConfig(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class FrozenConfig(dict):
+    """
+    Immutable configuration node, values are available as items and
+    attributes (unless they clash with dict methods like "keys")
+    Usage
+    -----
+    >>> config.dkb.formats.date
+    >>> config['dkb']['formats']['date']
+    """
+
+    def __init__(self, data):
+        dict.__init__(self, (
+            (key, freeze(value)) for key, value in data.items()
+        ))
+        for key, value in self.items():
+            if key.isidentifier() and not hasattr(dict, key):
+                object.__setattr__(self, key, value)
+
+    def __immutable(self, *args, **kwargs):
+        raise TypeError('Configuration is immutable')
+
+    __setitem__ = __immutable
+    __delitem__ = __immutable
+    __setattr__ = __immutable
+    __delattr__ = __immutable
+    clear = __immutable
+    pop = __immutable
+    popitem = __immutable
+    setdefault = __immutable
+    update = __immutable
+
+    def plain(self):
+        """
+        mutable plain dict/list copy, built once per node
+        """
+
+        try:
+            return self.__plain
+        except AttributeError:
+            object.__setattr__(self, '_FrozenConfig__plain', thaw(self))
+            return self.__plain
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenConfig, (thaw(self),))
+
+    def __repr__(self):
+        return 'FrozenConfig({})'.format(dict.__repr__(self))
+
+
+__SIMPLE_PATH = jmespath.compile('a.b').parsed['type']
+__expressions = {}
+
+
+def compile_path(path):
+    """
+    compile a jmespath expression once, plain dotted paths become key tuples
+    which are looked up directly
+    """
+
+    expression = __expressions.get(path)
+    if expression is None:
+        compiled = jmespath.compile(path)
+        parsed = compiled.parsed
+        if parsed['type'] == 'field':
+            expression = (parsed['value'],)
+        elif parsed['type'] == __SIMPLE_PATH and all(
+            child['type'] == 'field' for child in parsed['children']
+        ):
+            expression = tuple(child['value'] for child in parsed['children'])
+        else:
+            expression = compiled
+        __expressions[path] = expression
+    return expression
+
+
 def get_config(path=None, data=None):
-    cfg = config['default']
-    if env in config:
-        cfg = __merge(config[env], cfg)
-    if path and data:
-        return jmespath.search(path, data)
-    if path:
-        return jmespath.search(path, cfg)
+    if data is None:
+        data = config
+    if not path:
+        return data
+
+    expression = compile_path(path)
+    if not isinstance(expression, tuple):
+        # jmespath only indexes/projects lists, not the frozen tuples
+        return expression.search(
+            data.plain() if isinstance(data, FrozenConfig) else data
+        )
+    for key in expression:
+        try:
+            data = data[key]
+        except (KeyError, TypeError):
+            return None
+    return data
+
+
+def __validate(cfg):
+    """
+    check the merged configuration once on import
+    """
+
+    dkb = cfg['dkb']
+    for account_type in ['CREDIT', 'SEPA', 'DEPOT']:
+        account_cfg = dkb[account_type]
+        fieldnames = account_cfg['fieldnames']
+        for key in ['display_sums', 'merge_values', 'keys', 'url', 'fieldnames']:
+            if key not in account_cfg:
+                raise ValueError('"dkb.{}.{}" has to be configured'.format(
+                    account_type, key
+                ))
+        for key in ['currency', 'date']:
+            names = account_cfg['keys'].get(key, [])
+            for name in [names] if isinstance(names, str) else names:
+                if name not in fieldnames:
+                    raise ValueError('"{}" of "dkb.{}.keys.{}" is not in fieldnames'.format(
+                        name, account_type, key
+                    ))
+        reconcile = account_cfg.get('reconcile')
+        if reconcile:
+            for name in [reconcile['status']] + list(reconcile['match']):
+                if name not in fieldnames:
+                    raise ValueError('"{}" of "dkb.{}.reconcile" is not in fieldnames'.format(
+                        name, account_type
+                    ))
+
+    transport = dkb['transport']
+    for key in ['pool_connections', 'pool_size']:
+        if transport[key] < 1:
+            raise ValueError('"dkb.transport.{}" has to be at least 1'.format(key))
+    if transport['retries'] < 0:
+        raise ValueError('"dkb.transport.retries" must not be negative')
+
+    if cfg['profile']['sort'] not in ['cumulative', 'tottime', 'calls', 'ncalls', 'time']:
+        raise ValueError('Unknown profile sort key "{}"'.format(cfg['profile']['sort']))
+    if cfg['cassette']['mode'] not in ['off', 'record', 'replay']:
+        raise ValueError('Unknown cassette mode "{}"'.format(cfg['cassette']['mode']))
+    if not 1 <= cfg['archive']['level'] <= 22:
+        raise ValueError('"archive.level" has to be between 1 and 22')
+    if cfg['schedule']['reserve'] < 0:
+        raise ValueError('"schedule.reserve" must not be negative')
+    if cfg['batch']['concurrency'] < 1:
+        raise ValueError('"batch.concurrency" has to be at least 1')
+    if cfg['lock']['ttl'] < 1:
+        raise ValueError('"lock.ttl" has to be at least 1')
+    if cfg['lock']['wait'] < 0:
+        raise ValueError('"lock.wait" must not be negative')
+    if cfg['queue']['window_days'] < 0:
+        raise ValueError('"queue.window_days" must not be negative')
+    for name, column in cfg['holdings']['columns'].items():
+        if column not in dkb['DEPOT']['fieldnames']:
+            raise ValueError('"{}" of "holdings.columns.{}" is not in fieldnames'.format(
+                column, name
+            ))
+
+    for section in ['categories', 'search']:
+        for account_type, names in cfg[section]['fields'].items():
+            if account_type not in ['CREDIT', 'SEPA']:
+                raise ValueError('Unsupported account type "{}.fields.{}"'.format(
+                    section, account_type
+                ))
+            for name in names:
+                if name not in dkb[account_type]['fieldnames']:
+                    raise ValueError('"{}" of "{}.fields.{}" is not in fieldnames'.format(
+                        name, section, account_type
+                    ))
+
+    for name in cfg['sinks']:
+        if name.strip() not in ['gsheet', 'columnar', 'holdings', 'search', '']:
+            raise ValueError('Unknown sink "{}"'.format(name))
+    if cfg['columnar']['format'] not in ['parquet', 'arrow']:
+        raise ValueError('Unknown columnar format "{}"'.format(
+            cfg['columnar']['format']
+        ))
+    if cfg['gsheet']['partition'] not in ['none', 'year', 'quarter']:
+        raise ValueError('Unknown partition mode "{}"'.format(
+            cfg['gsheet']['partition']
+        ))
+    if cfg['gsheet']['dashboard_sums'] not in ['values', 'formula']:
+        raise ValueError('Unknown dashboard sums mode "{}"'.format(
+            cfg['gsheet']['dashboard_sums']
+        ))
     return cfg
 
 
-__base_url = 'https://www.dkb.de/banking'
-config = {
+__base_url = environ.get('DKB_BASE_URL', 'https://www.dkb.de/banking')
+# seconds an invocation may run, the timeout of the function (serverless.yml)
+__function_timeout = int(environ.get('FUNCTION_TIMEOUT', 900))
+__schedule_reserve = int(environ.get('SCHEDULE_RESERVE_MS', 10000))
+stages = {
     'default': {
         'env': env,
+        # the DKB credentials are checked per tenant (DKB_USER/DKB_PASSWORD by default)
         'needed_env_vars': [
-            'DKB_USER',
-            'DKB_PASSWORD',
             'GOOGLE_SHEET_WRITER',
             'CREDS_CLIENT_EMAIL',
             'CREDS_PRIVATE_KEY',
@@ -44,6 +241,137 @@ config = {
             'CREDS_PRIVATE_KEY_ID',
             'CREDS_TOKEN_URI'
         ],
+        # persisted state between runs (snapshots, caches)
+        'state_dir': environ.get('STATE_DIR', '/tmp/dkb-scraper/state'),
+        # comma separated outputs: "gsheet", "columnar", "holdings", "search"
+        'sinks': environ.get('SINKS', 'gsheet').split(','),
+        'memory': {
+            # fetch, write and release one account at a time
+            'low': environ.get('LOW_MEMORY', 'false').lower() == 'true',
+            # tracemalloc peak memory per phase, adds overhead while enabled
+            'report': environ.get('MEMORY_REPORT', 'false').lower() == 'true',
+        },
+        'profile': {
+            # cProfile every scrape invocation, adds overhead while enabled
+            'enabled': environ.get('PROFILE', 'false').lower() == 'true',
+            # local directory or s3://bucket/prefix of the pstats files
+            'target': environ.get('PROFILE_TARGET', '/tmp/dkb-scraper/profiles'),
+            # hot functions in the log, ordered by a pstats sort key
+            'top': int(environ.get('PROFILE_TOP', 25)),
+            'sort': environ.get('PROFILE_SORT', 'cumulative'),
+        },
+        'cassette': {
+            # "record" the http requests of handler.scrape, "replay" them without network or "off"
+            'mode': environ.get('CASSETTE_MODE', 'off'),
+            # local directory or s3://bucket/prefix of the gzip compressed cassettes
+            'target': environ.get('CASSETTE_TARGET', '/tmp/dkb-scraper/cassettes'),
+            'name': environ.get('CASSETTE_NAME', 'scrape.json.gz'),
+        },
+        'archive': {
+            # keep every raw csv export, zstd compressed and stored by content hash
+            'enabled': environ.get('ARCHIVE', 'false').lower() == 'true',
+            # local directory or s3://bucket/prefix of the archived exports
+            'target': environ.get('ARCHIVE_TARGET', '/tmp/dkb-scraper/archive'),
+            # zstd compression level, 1 (fast) to 22
+            'level': int(environ.get('ARCHIVE_LEVEL', 10)),
+        },
+        'schedule': {
+            # stop before a lambda invocation times out and resume with the pending accounts
+            'enabled': environ.get('SCHEDULE', 'true').lower() == 'true',
+            # milliseconds kept for the logout and the dashboard
+            'reserve': __schedule_reserve,
+        },
+        'batch': {
+            # json list of tenant profiles for the batch handler
+            'tenants_file': environ.get('TENANTS_FILE', None),
+            # tenants scraped at the same time
+            'concurrency': int(environ.get('BATCH_CONCURRENCY', 4)),
+        },
+        'holdings': {
+            # local directory or s3://bucket/prefix of the depot holdings history
+            'target': environ.get('HOLDINGS_TARGET', '/tmp/dkb-scraper/holdings'),
+            # DEPOT export columns of a position
+            'columns': {
+                'key': 'ISIN / WKN',
+                'name': 'Bezeichnung',
+                'quantity': 'Bestand',
+                'price': 'Kurs',
+                'value': 'Kurswert in Euro',
+            },
+        },
+        'lock': {
+            # one run per dkb user and spreadsheet, overlapping runs wait for it and share its result
+            'enabled': environ.get('LOCK', 'true').lower() == 'true',
+            # sqlite:///path/to.db, memory:// (in-process) or dynamodb://<table>
+            'url': environ.get('LOCK_URL', 'sqlite:///tmp/dkb-scraper/lock.db'),
+            'dynamodb_endpoint_url': environ.get('DYNAMODB_ENDPOINT_URL', None),
+            # seconds until a lease of a crashed run expires, the function timeout
+            'ttl': int(environ.get('LOCK_TTL', __function_timeout)),
+            # seconds an overlapping run waits for the run in flight, it has
+            # to answer before its own invocation times out
+            'wait': int(environ.get(
+                'LOCK_WAIT', max(1, __function_timeout - __schedule_reserve // 1000)
+            )),
+            'poll_interval': float(environ.get('LOCK_POLL_INTERVAL', 1)),
+        },
+        'queue': {
+            # sqlite:///path/to.db, memory:// (in-process) or an SQS queue url
+            'url': environ.get('QUEUE_URL', 'sqlite:///tmp/dkb-scraper/queue.db'),
+            'sqs_endpoint_url': environ.get('SQS_ENDPOINT_URL', None),
+            # local directory or s3://bucket/prefix shared by coordinator and workers
+            'results_target': environ.get('QUEUE_RESULTS_TARGET', '/tmp/dkb-scraper/runs'),
+            # split the queried range into windows of this many days, 0 for one window
+            'window_days': int(environ.get('QUEUE_WINDOW_DAYS', 0)),
+            # seconds until an unacked item is delivered again
+            'visibility_timeout': int(environ.get('QUEUE_VISIBILITY_TIMEOUT', 300)),
+            'max_attempts': int(environ.get('QUEUE_MAX_ATTEMPTS', 3)),
+        },
+        'categories': {
+            # json list of rules, [{"category": "...", "keywords": [...], "patterns": [...]}],
+            # the first matching rule wins, no category column without rules
+            'rules': environ.get('CATEGORY_RULES', None),
+            'column': environ.get('CATEGORY_COLUMN', 'Kategorie'),
+            # matched columns per account type
+            'fields': {
+                'SEPA': [
+                    'Auftraggeber / Begünstigter',
+                    'Verwendungszweck',
+                    'Buchungstext',
+                ],
+                'CREDIT': [
+                    'Beschreibung',
+                ],
+            },
+        },
+        'search': {
+            # local directory or s3://bucket/prefix of the transaction search index
+            'target': environ.get('SEARCH_TARGET', '/tmp/dkb-scraper/search'),
+            # indexed columns per account type, the category is indexed too
+            'fields': {
+                'SEPA': [
+                    'Buchungstext',
+                    'Auftraggeber / Begünstigter',
+                    'Verwendungszweck',
+                    'Kontonummer',
+                    'Gläubiger-ID',
+                    'Mandatsreferenz',
+                    'Kundenreferenz',
+                ],
+                'CREDIT': [
+                    'Beschreibung',
+                    'Ursprünglicher Betrag',
+                ],
+            },
+        },
+        'storage': {
+            's3_endpoint_url': environ.get('S3_ENDPOINT_URL', None),
+        },
+        'columnar': {
+            # local directory or s3://bucket/prefix
+            'target': environ.get('COLUMNAR_TARGET', '/tmp/dkb-scraper/columnar'),
+            # "parquet" or "arrow" (ipc file format)
+            'format': environ.get('COLUMNAR_FORMAT', 'parquet'),
+        },
         'dkb': {
             'currency': environ.get('DKB_CURRENCY', '€'),
             'creds': {
@@ -54,8 +382,26 @@ config = {
                 'date': '%d.%m.%Y',
             },
             'blz': '12030000',
-            'fints_url': 'https://banking-dkb.s-fints-pt-dkb.de/fints30',
+            'fints_url': environ.get('DKB_FINTS_URL', 'https://banking-dkb.s-fints-pt-dkb.de/fints30'),
             'base_url': __base_url,
+            # persist the init page account options, fetch them only on a miss
+            'cache_account_options': environ.get('DKB_CACHE_ACCOUNT_OPTIONS', 'true').lower() == 'true',
+            # skip the accounts whose export did not change since the last run
+            'fingerprint': environ.get('DKB_FINGERPRINT', 'true').lower() == 'true',
+            'transport': {
+                'user_agent': environ.get(
+                    'DKB_USER_AGENT',
+                    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'
+                ),
+                'pool_connections': int(environ.get('DKB_POOL_CONNECTIONS', 4)),
+                'pool_size': int(environ.get('DKB_POOL_SIZE', 10)),
+                # seconds
+                'connect_timeout': float(environ.get('DKB_CONNECT_TIMEOUT', 5)),
+                'read_timeout': float(environ.get('DKB_READ_TIMEOUT', 60)),
+                # retries of idempotent requests (GET), sleeping backoff_factor * 2 ** (n - 1)
+                'retries': int(environ.get('DKB_RETRIES', 3)),
+                'backoff_factor': float(environ.get('DKB_RETRY_BACKOFF', 0.5)),
+            },
             'CREDIT': {
                 'display_sums': True,
                 'merge_values': True,
@@ -76,7 +422,14 @@ config = {
                     'Betrag (EUR)',
                     'Ursprünglicher Betrag',
                     ''
-                ]
+                ],
+                # a pending transaction is replaced by its settled version
+                'reconcile': {
+                    'status': 'Umsatz abgerechnet und nicht im Saldo enthalten',
+                    'pending': 'Nein',
+                    # columns a transaction keeps when it settles
+                    'match': ['Belegdatum', 'Beschreibung', 'Betrag (EUR)'],
+                },
             },
             'SEPA': {
                 'display_sums': True,
@@ -147,7 +500,19 @@ config = {
             'locale':  locale.setlocale(locale.LC_ALL, environ.get('GOOGLE_SHEET_LOCALE', '')),
             'sheet_name': environ.get('GOOGLE_SHEET_NAME', 'dkb-finance-dashboard'),
             'generated_values_ws_name': environ.get('GOOGLE_SHEET_GENVALUES_WS', 'GENERATED VALUES'),
+            # monthly sums on the dashboard: "values" (computed locally) or "formula" (QUERY)
+            'dashboard_sums': environ.get('GOOGLE_SHEET_DASHBOARD_SUMS', 'values'),
+            # account worksheets per "year" or "quarter", "none" for one worksheet per account
+            'partition': environ.get('GOOGLE_SHEET_PARTITION', 'none'),
+            # only write dashboard cells changed since the last run
+            'dashboard_diff': environ.get('GOOGLE_SHEET_DASHBOARD_DIFF', 'true').lower() == 'true',
             'sheet_writer': environ.get('GOOGLE_SHEET_WRITER', None),
+            # redirect all google api calls e.g. to a local stand-in server
+            'api_base_url': environ.get('GOOGLE_API_BASE_URL', None),
+            'api_hosts': [
+                'https://sheets.googleapis.com',
+                'https://www.googleapis.com'
+            ],
             'formats': {
                 'currency': '[<0][Red]-#,##0.00;[>0][Green]#,##0.00;[Blue]#,##0.00;'
             },
@@ -169,3 +534,8 @@ config = {
     'dev': {
     }
 }
+
+__merged = deepcopy(stages['default'])
+if env in stages:
+    __merge(deepcopy(stages[env]), __merged)
+config = freeze(__validate(__merged))
@@ -1,12 +1,15 @@
 import json
 import traceback
-from datetime import date, timedelta, datetime
 from dotenv import load_dotenv
 
-from config import get_config
-from src.dkb import DKBSession
-from src.sheets import GSheet
-from src.utils import init, parse_range
+from src.batch import get_tenant_target, load_tenants, run_batch, scrape_tenant
+from src.cassette import get_cassette
+from src.lease import RunInProgress
+from src.profiling import Profiler
+from src.scheduler import Deadline
+from src.search import get_index
+from src.utils import init
+from src.worker import Worker, coordinate
 
 load_dotenv()
 init()
@@ -27,42 +30,129 @@ def scrape(event, context):
         else:
             raise Exception('start_date has to be specified')
 
-        dkb_cfg = get_config('dkb')
-        session = DKBSession(
-            username=dkb_cfg['creds']['username'],
-            password=dkb_cfg['creds']['password'],
-            verbose=True
-        )
+        profiler = Profiler()
+        cassette = get_cassette()
+        cassette.rewind()
+        try:
+            with profiler.profile('scrape', getattr(context, 'aws_request_id', None)):
+                res = scrape_tenant({
+                    'name': 'default',
+                    'credentials': 'DKB',
+                    'time_span': time_span_string,
+                    'end_date': end_date_string,
+                }, deadline=Deadline(context))
+        finally:
+            # failed runs are recorded too
+            cassette.save()
+        if profiler.artifact:
+            res['info']['profile'] = profiler.artifact
+        if cassette.recording:
+            res['info']['cassette'] = cassette.name
 
-        date_format = get_config('formats.date', dkb_cfg)
-        end_date = datetime.now()
-        if end_date_string:
-            end_date = datetime.strptime(end_date_string, date_format)
+        message = 'query successful'
+        if res['info'].get('pending'):
+            message = 'query checkpointed, {} accounts pending'.format(
+                len(res['info']['pending'])
+            )
+        response = {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': message,
+                'res': res
+            })
+        }
+        print(response)
+        return response
+    except RunInProgress as e:
+        # answered before the invocation times out, the run in flight writes
+        response = {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': 'run in progress',
+                'run': e.holder,
+                'err': str(e),
+            })
+        }
+        print(response)
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        response = {
+            'statusCode': 400,
+            'body': json.dumps({
+                'err': str(e),
+                'stacktrace': traceback.format_exc().split('\n')
+            })
+        }
+        print(response)
+        return response
 
-        start_date = parse_range(time_span_string, end_date, date_format)
-        if start_date < (datetime.today() - timedelta(days=((3*365) + 1))):
-            raise ValueError('start_date can only be 3 years in the past')
 
-        if end_date < start_date:
-            raise ValueError('start_date must be after end_date')
+def batch(event, context):
+    """
+    scrape several tenants, `event.tenants` or the profiles in TENANTS_FILE
+    """
 
-        session.login()
-        res = session.query(start_date, end_date)
-        session.logout()
+    try:
+        res = run_batch(
+            load_tenants(event.get('tenants')),
+            time_span=event.get('time_span'),
+            end_date=event.get('end_date', ''),
+        )
+
+        status_code = 200
+        if res['failed']:
+            status_code = 207 if res['succeeded'] else 400
+        response = {
+            'statusCode': status_code,
+            'body': json.dumps({
+                'message': 'batch finished',
+                'res': res
+            })
+        }
+        print(response)
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        response = {
+            'statusCode': 400,
+            'body': json.dumps({
+                'err': str(e),
+                'stacktrace': traceback.format_exc().split('\n')
+            })
+        }
+        print(response)
+        return response
 
-        gsheet = GSheet()
-        gsheet.update_dashboard(res)
-        gsheet.add_data(res)
 
-        for account in res['accounts']:
-            account_values = res['accounts'][account]
-            if 'transactions' in account_values:
-                del account_values['transactions']
+def coordinator(event, context):
+    """
+    enqueue the accounts of the default tenant or of `event.tenants`
+    """
+
+    try:
+        tenants = [{'name': 'default', 'credentials': 'DKB'}]
+        if 'tenants' in event:
+            tenants = [
+                {
+                    'columnar_target': get_tenant_target(tenant),
+                    'search_target': get_tenant_target(tenant, 'search.target'),
+                    **tenant
+                } for tenant in load_tenants(event['tenants'])
+            ]
+
+        res = [
+            coordinate({
+                'time_span': event.get('time_span'),
+                'end_date': event.get('end_date', ''),
+                **tenant
+            }) for tenant in tenants
+        ]
 
         response = {
             'statusCode': 200,
             'body': json.dumps({
-                'message': 'query successful',
+                'message': 'work enqueued',
                 'res': res
             })
         }
@@ -81,5 +171,78 @@ def scrape(event, context):
         return response
 
 
+def worker(event, context):
+    """
+    process the records of an SQS event, or drain the configured queue
+    """
+
+    queue_worker = Worker()
+    try:
+        if 'Records' in event:
+            # a failing record raises so that SQS delivers the batch again
+            for record in event['Records']:
+                queue_worker.process(json.loads(record['body']))
+            res = {'processed': len(event['Records']), 'failed': 0}
+        else:
+            res = queue_worker.drain(wait=event.get('wait', 0))
+    finally:
+        queue_worker.close()
+
+    response = {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'work processed',
+            'res': res
+        })
+    }
+    print(response)
+    return response
+
+
+def search(event, context):
+    """
+    full-text search over the indexed transactions, "q" holds the terms
+    ("miet*" for prefixes), "from"/"to" the inclusive date range
+    """
+
+    try:
+        params = event.get('queryStringParameters') or {}
+        if 'queryStringParameters' not in event:
+            params = event
+
+        target = None
+        if params.get('tenant'):
+            target = get_tenant_target({'name': params['tenant']}, 'search.target')
+
+        res = get_index(target).search(
+            params.get('q', ''),
+            start=params.get('from'),
+            end=params.get('to'),
+            account=params.get('account'),
+            limit=int(params.get('limit', 50)),
+        )
+
+        response = {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'search successful',
+                'res': res
+            })
+        }
+        print('Found {} transactions in {} ms'.format(res['total'], res['took_ms']))
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        response = {
+            'statusCode': 400,
+            'body': json.dumps({
+                'err': str(e),
+                'stacktrace': traceback.format_exc().split('\n')
+            })
+        }
+        print(response)
+        return response
+
+
 if __name__ == '__main__':
     scrape({'time_span': '1'}, '')
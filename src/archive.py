@@ -0,0 +1,272 @@
+"""
+Rebuild the sinks from the archived raw exports, without the bank
+"""
+
+import argparse
+import json
+import time
+from collections import Counter
+from datetime import datetime
+from hashlib import sha256
+
+from config import get_config
+from src.storage import get_store
+
+# query params holding the date window of an export
+WINDOW_PARAMS = [
+    ('postingDate', 'toPostingDate'),
+    ('transactionDate', 'toTransactionDate'),
+]
+
+
+def get_window(params):
+    """
+    ISO (start_date, end_date) of the export params, (None, None) for depots
+    """
+
+    date_format = get_config('dkb.formats.date')
+    for start, end in WINDOW_PARAMS:
+        if start in params and end in params:
+            return tuple(
+                datetime.strptime(params[key], date_format).strftime('%Y-%m-%d')
+                for key in [start, end]
+            )
+    return None, None
+
+
+class ExportArchive(object):
+    """
+    Raw csv exports, zstd compressed and stored by content hash, with one
+    metadata file per account and date window
+    Usage
+    -----
+    >>> archive = ExportArchive()
+    >>> archive.add(account, params, download.content, download.encoding)
+    >>> for entry in archive.entries('0000000003'):
+    >>>     archive.read(entry)
+
+    Layout
+    ------
+    blobs/<sha256[:2]>/<sha256>.csv.zst
+    exports/<account_number>/<start_date>_<end_date>-<sha256[:16]>.json
+    exports/<account_number>/snapshot-<sha256[:16]>.json (depots)
+    """
+
+    def __init__(self, target=None, level=None):
+        cfg = get_config('archive')
+        self.__store = get_store(target or cfg.target)
+        self.level = level or cfg.level
+
+    def add(self, account, params, content, encoding=None):
+        """
+        archive an export, unchanged content of a window is stored once
+        """
+
+        import zstandard
+
+        digest = sha256(content).hexdigest()
+        start_date, end_date = get_window(params)
+        window = '{}_{}'.format(start_date, end_date) if start_date else 'snapshot'
+        key = 'exports/{}/{}-{}.json'.format(account['account_number'], window, digest[:16])
+        if self.__store.read(key) is not None:
+            return key
+
+        self.__store.write(
+            'blobs/{}/{}.csv.zst'.format(digest[:2], digest),
+            zstandard.ZstdCompressor(level=self.level).compress(content)
+        )
+        self.__store.write(key, json.dumps({
+            'sha256': digest,
+            'account': account,
+            'params': params,
+            'start_date': start_date,
+            'end_date': end_date,
+            'fetched_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'encoding': encoding,
+            'bytes': len(content),
+        }).encode('utf-8'))
+        return key
+
+    def entries(self, account_number=None):
+        """
+        metadata of the archived exports, oldest fetch first
+        """
+
+        prefix = 'exports/{}/'.format(account_number) if account_number else 'exports/'
+        entries = [
+            json.loads(self.__store.read(key).decode('utf-8'))
+            for key in self.__store.list(prefix) if key.endswith('.json')
+        ]
+        entries.sort(key=lambda entry: entry['fetched_at'])
+        return entries
+
+    def read(self, entry):
+        """
+        decoded text of an archived export
+        """
+
+        import zstandard
+
+        digest = entry['sha256']
+        content = zstandard.ZstdDecompressor().decompress(
+            self.__store.read('blobs/{}/{}.csv.zst'.format(digest[:2], digest))
+        )
+        return content.decode(entry['encoding'] or 'utf-8')
+
+
+def export_info(entry):
+    """
+    query info of an archived export, like the one of the run that fetched it
+    """
+
+    fetched_at = datetime.strptime(entry['fetched_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
+    start_date, end_date = [
+        datetime.strptime(entry[key], '%Y-%m-%d').date() if entry[key] else fetched_at.date()
+        for key in ['start_date', 'end_date']
+    ]
+    return {
+        'start_date': start_date.strftime('%x'), 'end_date': end_date.strftime('%x'),
+        'request_date': fetched_at.strftime('%x'),
+        'fetched_at': fetched_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+
+
+def reconcile_exports(exports, data):
+    """
+    transactions of the exports of an account, fed oldest to newest through
+    the pending reconciliation: a pending transaction an older export held is
+    dropped once a newer export holds it settled
+    """
+
+    from src.sheets import reconcile_pending
+
+    reconcile = get_config('dkb')[data['account_type']].get('reconcile')
+    transactions = []
+    for export in exports:
+        if not reconcile:
+            transactions += export
+            continue
+        rows = [';'.join(map(str, t)) for t in transactions]
+        _, kept = reconcile_pending(
+            [';'.join(map(str, t)) for t in export], rows,
+            data['fieldnames'].index(reconcile['status']),
+            reconcile['pending'],
+            [data['fieldnames'].index(name) for name in reconcile['match']]
+        )
+        # repeated transactions are kept as often as the reconciliation does
+        kept = Counter(kept)
+        older = []
+        for transaction, row in zip(transactions, rows):
+            if kept[row] > 0:
+                kept[row] -= 1
+                older.append(transaction)
+        transactions = older + export
+    return transactions
+
+
+def reprocess(archive=None, sink_names=None, account_number=None, verbose=True,
+              rebuild=False):
+    """
+    parse the archived exports again and write them to the sinks. The
+    windows of an account are written as one update, depot snapshots one
+    by one in the order they were fetched. With `rebuild` the sinks drop
+    what they hold of an account before, otherwise the exports are merged.
+    """
+
+    from src.dkb import DKBSession
+    from src.sinks import get_sinks
+
+    archive = archive or ExportArchive()
+    session = DKBSession(username=None, password=None, verbose=False)
+    sinks = get_sinks(sink_names, verbose=verbose)
+
+    # accounts in the order they were first fetched
+    accounts = {}
+    for entry in archive.entries(account_number):
+        accounts.setdefault(entry['account']['account_number'], []).append(entry)
+
+    res = {'info': None, 'accounts': {}}
+    for number, entries in accounts.items():
+        data = None
+        exports = []
+        for entry in entries:
+            info = export_info(entry)
+            data = session.parse_export(dict(entry['account']), archive.read(entry))
+            if rebuild and entry is entries[0]:
+                for sink in sinks:
+                    sink.clear(data)
+            if 'date' in data['indices']:
+                exports.append(data['transactions'])
+                continue
+            for sink in sinks:
+                sink.add_data({'info': info, 'accounts': {number: data}})
+        res['info'] = info
+
+        if 'date' in data['indices']:
+            # the latest export holds the current total
+            data['transactions'] = reconcile_exports(exports, data)
+            if verbose:
+                print('Reprocessing {} transactions of {} exports of "{}"'.format(
+                    len(data['transactions']), len(entries), number
+                ))
+            for sink in sinks:
+                sink.add_data({'info': info, 'accounts': {number: data}})
+        del data['transactions']
+        res['accounts'][number] = data
+
+    if res['accounts']:
+        for sink in sinks:
+            sink.update_dashboard(res)
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sinks', help='comma separated sinks, the configured ones by default')
+    parser.add_argument('--account', help='only this account number')
+    parser.add_argument('--list', action='store_true', help='list the archived exports')
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='clear the sheets, partitions and index of the accounts before writing'
+    )
+    parser.add_argument(
+        '--credentials', default='DKB',
+        help='credentials reference of the dkb user whose runs are locked out (<reference>_USER)'
+    )
+    args = parser.parse_args(argv)
+
+    archive = ExportArchive()
+    if args.list:
+        for entry in archive.entries(args.account):
+            print('{} {} {}..{} {} bytes'.format(
+                entry['fetched_at'], entry['account']['account_number'],
+                entry['start_date'] or '', entry['end_date'] or '', entry['bytes']
+            ))
+        return
+
+    start = time.perf_counter()
+
+    def run():
+        return reprocess(
+            archive, args.sinks.split(',') if args.sinks else None, args.account,
+            rebuild=args.rebuild
+        )
+
+    if get_config('lock.enabled'):
+        from src.batch import get_credentials, get_lock_key, get_sheet_name
+        from src.lease import run_exclusive
+
+        # the sinks of the scrape runs, they wait for the reprocessing
+        res, _, _ = run_exclusive(
+            get_lock_key(get_credentials(args.credentials)['username'], get_sheet_name()),
+            run, coalesce=False
+        )
+    else:
+        res = run()
+    print('Reprocessed {} accounts in {}s'.format(
+        len(res['accounts']), round(time.perf_counter() - start, 3)
+    ))
+
+
+if __name__ == '__main__':
+    main()
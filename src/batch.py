@@ -0,0 +1,319 @@
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import environ
+
+from config import get_config
+from src.dkb import DKBSession, query_info
+from src.lease import run_exclusive
+from src.memory import MemoryReport
+from src.scheduler import Deadline, Scheduler, can_checkpoint
+from src.sinks import get_sinks
+from src.state import load_state, save_state
+from src.utils import parse_range
+
+
+def get_credentials(reference):
+    """
+    username and password behind a credentials reference, read from the
+    "<reference>_USER" and "<reference>_PASSWORD" environment variables
+    """
+
+    creds = {}
+    for key, suffix in [('username', 'USER'), ('password', 'PASSWORD')]:
+        var = '{}_{}'.format(reference, suffix)
+        creds[key] = environ.get(var, None)
+        if not creds[key]:
+            raise ValueError(
+                '"{}" environment variable must be set'.format(var)
+            )
+    return creds
+
+
+def get_date_range(time_span, end_date_string=''):
+    date_format = get_config('dkb.formats.date')
+    end_date = datetime.now()
+    if end_date_string:
+        end_date = datetime.strptime(end_date_string, date_format)
+
+    start_date = parse_range(time_span, end_date, date_format)
+    if start_date < (datetime.today() - timedelta(days=((3*365) + 1))):
+        raise ValueError('start_date can only be 3 years in the past')
+
+    if end_date < start_date:
+        raise ValueError('start_date must be after end_date')
+
+    return start_date, end_date
+
+
+def load_tenants(tenants=None):
+    """
+    validated tenant profiles, read from `batch.tenants_file` if none are given
+
+    [{"name": "alice", "credentials": "DKB_ALICE", "sheet_name": "alice-finances", "time_span": "30"}]
+    """
+
+    if tenants is None:
+        tenants_file = get_config('batch.tenants_file')
+        if not tenants_file:
+            raise ValueError('No tenants given and "TENANTS_FILE" is not set')
+        with open(tenants_file) as f:
+            tenants = json.load(f)
+
+    names = set()
+    for tenant in tenants:
+        for key in ['name', 'credentials']:
+            if not tenant.get(key):
+                raise ValueError('"{}" has to be configured for every tenant'.format(key))
+        if tenant['name'] in names:
+            raise ValueError('Tenant "{}" is configured twice'.format(tenant['name']))
+        names.add(tenant['name'])
+    return tenants
+
+
+def get_tenant_target(tenant, setting='columnar.target'):
+    """
+    columnar (or other `setting`) target of a tenant in multi-tenant runs
+    """
+
+    return '{}/tenant={}'.format(
+        get_config(setting).rstrip('/'), tenant['name']
+    )
+
+
+def get_lock_key(username, sheet_name):
+    """
+    lease key of a dkb user and spreadsheet, without the username in clear
+    """
+
+    return '{}/{}'.format(
+        sha256(username.encode('utf-8')).hexdigest()[:16], sheet_name
+    )
+
+
+def get_sheet_name(sink_options={}):
+    return sink_options.get('gsheet', {}).get('sheet_name') or \
+        get_config('gsheet.sheet_name')
+
+
+def get_run_state_name(kind, username, sheet_name):
+    """
+    state of the runs of a dkb user writing to a spreadsheet and the sinks,
+    e.g. the export fingerprints or a checkpoint
+    """
+
+    key = '{}/{}/{}'.format(username, sheet_name, ','.join(get_config('sinks')))
+    return '{}-{}'.format(kind, sha256(key.encode('utf-8')).hexdigest()[:16])
+
+
+def get_fingerprint_scope(sinks):
+    """
+    digest of where and how the sinks write and of the category rules, the
+    fingerprints of another scope do not skip an account
+    """
+
+    digest = sha256(get_config('categories.column').encode('utf-8'))
+    rules = get_config('categories.rules')
+    if rules:
+        with open(rules, 'rb') as f:
+            digest.update(f.read())
+    for sink in sinks:
+        digest.update(sink.scope().encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def scrape_tenant(tenant, sink_options={}, verbose=True, deadline=None):
+    """
+    query the accounts of one tenant and write them to the configured sinks,
+    a run for the same user and spreadsheet in flight is waited for and its
+    result returned instead. With a `deadline` the accounts that do not fit
+    in are left to the next run.
+    """
+
+    if not tenant.get('time_span'):
+        raise ValueError('time_span has to be specified')
+
+    creds = get_credentials(tenant.get('credentials', 'DKB'))
+    if not get_config('lock.enabled'):
+        return __scrape_tenant(tenant, creds, sink_options, verbose, deadline)
+
+    sheet_name = get_sheet_name(sink_options)
+    res, run_id, coalesced = run_exclusive(
+        get_lock_key(creds['username'], sheet_name),
+        lambda: __scrape_tenant(tenant, creds, sink_options, verbose, deadline),
+        verbose=verbose, deadline=deadline
+    )
+    res['info']['run'] = run_id
+    res['info']['coalesced'] = coalesced
+    return res
+
+
+def __scrape_tenant(tenant, creds, sink_options, verbose, deadline=None):
+    """
+    in low memory mode or against a deadline one account at a time
+    """
+
+    memory_cfg = get_config('memory')
+    report = MemoryReport(memory_cfg.report, verbose)
+    deadline = deadline or Deadline()
+    sheet_name = get_sheet_name(sink_options)
+
+    with report.phase('sinks'):
+        sinks = get_sinks(verbose=verbose, options=sink_options)
+
+    # accounts with the same export as in the last run of the same sinks
+    # and settings are not written again
+    fingerprints_name = None
+    fingerprints = {}
+    scope = get_fingerprint_scope(sinks)
+    if get_config('dkb.fingerprint'):
+        fingerprints_name = get_run_state_name('fingerprints', creds['username'], sheet_name)
+        stored = load_state(fingerprints_name, {})
+        if stored.get('scope') == scope:
+            fingerprints = stored['accounts']
+
+    session = DKBSession(
+        username=creds['username'],
+        password=creds['password'],
+        verbose=verbose,
+        fingerprints=fingerprints
+    )
+
+    start_date, end_date = get_date_range(
+        str(tenant['time_span']), tenant.get('end_date', '')
+    )
+
+    with report.phase('login'):
+        session.login()
+
+    # without shared checkpoints the whole run has to fit in the invocation
+    scheduled = get_config('schedule.enabled') and deadline.remaining() is not None \
+        and can_checkpoint(verbose)
+    if memory_cfg.low or scheduled:
+        with report.phase('plan'):
+            exports = session.plan([(start_date, end_date)])
+
+        res = {'info': query_info(start_date, end_date), 'accounts': {}}
+
+        def work(export):
+            account, params = export
+            account_number = account['account_number']
+            with report.phase('fetch {}'.format(account_number)):
+                data = session.fetch_export(data=account, params=params)
+            with report.phase('add_data {}'.format(account_number)):
+                for sink in sinks:
+                    sink.add_data({'info': res['info'], 'accounts': {account_number: data}})
+            # only the account values are kept for the dashboard
+            data.pop('transactions', None)
+            return data
+
+        # finished accounts are checkpointed, a timed out run resumes with the others
+        scheduler = Scheduler(
+            get_run_state_name('checkpoint', creds['username'], sheet_name) if scheduled else None,
+            '{:%Y-%m-%d}_{:%Y-%m-%d}'.format(start_date, end_date),
+            deadline, verbose
+        )
+        done = scheduler.run(
+            [(account['account_number'], (account, params)) for account, params in exports],
+            work
+        )
+        res['accounts'] = {
+            account['account_number']: done[account['account_number']]
+            for account, _ in exports if account['account_number'] in done
+        }
+        session.logout()
+        res['info']['transport'] = session.s.summary()
+
+        if scheduler.pending:
+            # the dashboard is updated by the run that completes the accounts
+            res['info']['pending'] = scheduler.pending
+        else:
+            with report.phase('update_dashboard'):
+                for sink in sinks:
+                    sink.update_dashboard(res)
+            scheduler.finish()
+    else:
+        with report.phase('query'):
+            res = session.query(start_date, end_date)
+        session.logout()
+        res['info']['transport'] = session.s.summary()
+
+        with report.phase('add_data'):
+            for sink in sinks:
+                sink.add_data(res)
+                sink.update_dashboard(res)
+
+        for account in res['accounts']:
+            account_values = res['accounts'][account]
+            if 'transactions' in account_values:
+                del account_values['transactions']
+
+    if fingerprints_name:
+        # only once every sink has the accounts
+        save_state(fingerprints_name, {'scope': scope, 'accounts': {**fingerprints, **{
+            number: values['fingerprint'] for number, values in res['accounts'].items()
+        }}})
+
+    report.stop()
+    if report.enabled:
+        res['info']['memory'] = report.phases
+    return res
+
+
+def run_batch(tenants, time_span=None, end_date='', concurrency=None, verbose=True):
+    """
+    scrape every tenant with at most `concurrency` tenants in flight, a failing
+    tenant does not affect the others
+    """
+
+    batch_cfg = get_config('batch')
+    concurrency = concurrency or batch_cfg.concurrency
+
+    # one google authentication for all tenants
+    client = None
+    if 'gsheet' in [name.strip() for name in get_config('sinks')]:
+        from src.sheets import get_client
+        client = get_client(verbose)
+
+    def run(tenant):
+        tenant = {'time_span': time_span, 'end_date': end_date, **tenant}
+        sink_options = {
+            'gsheet': {'sheet_name': tenant.get('sheet_name'), 'client': client},
+            'columnar': {'target': get_tenant_target(tenant)},
+            'search': {'target': get_tenant_target(tenant, 'search.target')},
+        }
+        start = time.perf_counter()
+        try:
+            result = {
+                'status': 'ok',
+                'res': scrape_tenant(tenant, sink_options, verbose),
+            }
+        except Exception as e:
+            traceback.print_exc()
+            result = {
+                'status': 'failed',
+                'err': str(e),
+                'stacktrace': traceback.format_exc().split('\n'),
+            }
+        result['elapsed_s'] = round(time.perf_counter() - start, 3)
+        if verbose:
+            print('Tenant "{}" {} after {}s'.format(
+                tenant['name'], result['status'], result['elapsed_s']
+            ))
+        return result
+
+    workers = max(1, min(concurrency, len(tenants)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run, tenants))
+
+    failed = [r for r in results if r['status'] != 'ok']
+    return {
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'tenants': {
+            tenant['name']: result for tenant, result in zip(tenants, results)
+        },
+    }
@@ -0,0 +1,317 @@
+import base64
+import gzip
+import io
+import json
+import threading
+from collections import deque
+from datetime import datetime
+from hashlib import sha1
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.response import HTTPResponse
+
+from config import get_config
+from src.storage import get_store
+
+REDACTED = '<redacted>'
+# credentials never written to a cassette
+REDACTED_HEADERS = frozenset(['authorization', 'proxy-authorization', 'cookie', 'set-cookie'])
+REDACTED_FIELDS = frozenset(['j_username', 'j_password', 'access_token', 'refresh_token'])
+VERSION = 1
+
+
+def to_text(body):
+    """
+    json friendly body, base64 if it is not utf-8
+    """
+
+    if body is None:
+        return {'text': ''}
+    if isinstance(body, str):
+        return {'text': body}
+    try:
+        return {'text': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(body).decode('ascii')}
+
+
+def from_text(body):
+    if 'base64' in body:
+        return base64.b64decode(body['base64'])
+    return body['text'].encode('utf-8')
+
+
+def redact_headers(headers):
+    return {
+        name: REDACTED if name.lower() in REDACTED_HEADERS else value
+        for name, value in headers.items()
+    }
+
+
+def redact_form(body):
+    """
+    form encoded body with the credential fields replaced
+    """
+
+    if isinstance(body, bytes):
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return body
+    if not isinstance(body, str) or '=' not in body:
+        return body
+    fields = parse_qsl(body, keep_blank_values=True)
+    if not any(name in REDACTED_FIELDS for name, _ in fields):
+        return body
+    return urlencode([
+        (name, REDACTED if name in REDACTED_FIELDS else value)
+        for name, value in fields
+    ])
+
+
+def request_key(method, url, body=None):
+    """
+    exact and loose replay key of a request, the loose key ignores the
+    query and the body (e.g. the queried date range)
+    """
+
+    parts = urlsplit(url)
+    digest = sha1(body if isinstance(body, bytes) else (body or '').encode('utf-8'))
+    loose = '{} {}://{}{}'.format(method.upper(), parts.scheme, parts.netloc, parts.path)
+    return '{}?{} {}'.format(loose, parts.query, digest.hexdigest()), loose
+
+
+class Cassette(object):
+    """
+    Every http request and response of a run, recorded to a gzip compressed
+    json file with credentials redacted, or replayed from it without network.
+    Usage
+    -----
+    >>> cassette = Cassette('record')
+    >>> cassette.attach(session)
+    >>> ...
+    >>> cassette.save()
+
+    Replayed requests are matched exactly (method, url, body) first, then
+    by method and path in recorded order, so a replay on another day still
+    finds the exports of the recorded date range. The persisted state the
+    run started with is part of the cassette, a replay does not change the
+    state of real runs.
+    """
+
+    def __init__(self, mode=None, target=None, name=None, verbose=True):
+        cfg = get_config('cassette')
+        self.mode = mode or cfg.mode
+        self.name = name or cfg.name
+        self.verbose = verbose
+        self.target = target or cfg.target
+        self.__lock = threading.Lock()
+        self.interactions = []
+        self.state = {}
+        if self.replaying:
+            self.__load()
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def __load(self):
+        content = get_store(self.target).read(self.name)
+        if content is None:
+            raise ValueError('Cassette "{}" not found'.format(self.name))
+        cassette = json.loads(gzip.decompress(content).decode('utf-8'))
+        if cassette['version'] != VERSION:
+            raise ValueError('Unsupported cassette version {}'.format(cassette['version']))
+
+        self.interactions = cassette['interactions']
+        self.state = cassette['state']
+        self.rewind()
+        if self.verbose:
+            print('Replaying {} requests from cassette "{}"'.format(
+                len(self.interactions), self.name
+            ))
+
+    def rewind(self):
+        """
+        start over, a warm process records or replays the next run from scratch
+        """
+
+        if self.recording:
+            self.interactions = []
+            self.state = {}
+            return
+        self.__saved = {}
+        self.__exact = {}
+        self.__loose = {}
+        for i, interaction in enumerate(self.interactions):
+            request = interaction['request']
+            exact, loose = request_key(
+                request['method'], request['url'], from_text(request['body'])
+            )
+            self.__exact.setdefault(exact, deque()).append(i)
+            self.__loose.setdefault(loose, deque()).append(i)
+        self.__used = set()
+
+    def attach(self, session):
+        """
+        route all requests of a requests session through the cassette, the
+        mounted adapters (retries, rebasing) are kept for recording
+        """
+
+        if self.mode not in ['record', 'replay']:
+            return session
+        for prefix, adapter in list(session.adapters.items()):
+            if not isinstance(adapter, CassetteAdapter):
+                session.mount(prefix, CassetteAdapter(self, adapter))
+        return session
+
+    def record(self, request, response, url=None):
+        """
+        add an interaction, `url` as requested before any adapter rebased it
+        """
+
+        interaction = {
+            'request': {
+                'method': request.method,
+                'url': url or request.url,
+                'headers': redact_headers(request.headers),
+                'body': to_text(redact_form(request.body)),
+            },
+            'response': {
+                'status': response.status_code,
+                'reason': response.reason,
+                'url': response.url,
+                'headers': redact_headers(response.headers),
+                'body': to_text(response.content),
+            },
+        }
+        with self.__lock:
+            self.interactions.append(interaction)
+
+    def record_state(self, name, value):
+        """
+        the state a run found, later loads of the run see its own saves
+        """
+
+        with self.__lock:
+            self.state.setdefault(name, value)
+
+    def load_state(self, name):
+        with self.__lock:
+            if name in self.__saved:
+                return json.loads(self.__saved[name])
+            return self.state.get(name)
+
+    def save_state(self, name, value):
+        # kept as json, like the state files
+        with self.__lock:
+            self.__saved[name] = json.dumps(value)
+
+    def __next(self, key, index):
+        queue = index.get(key)
+        while queue:
+            i = queue.popleft()
+            if i not in self.__used:
+                self.__used.add(i)
+                return self.interactions[i]
+        return None
+
+    def play(self, request):
+        """
+        recorded response of a request
+        """
+
+        exact, loose = request_key(
+            request.method, request.url, redact_form(request.body)
+        )
+        with self.__lock:
+            interaction = self.__next(exact, self.__exact) or self.__next(loose, self.__loose)
+        if interaction is None:
+            raise LookupError('{} {} is not in cassette "{}"'.format(
+                request.method, request.url, self.name
+            ))
+
+        recorded = interaction['response']
+        response = Response()
+        response.status_code = recorded['status']
+        response.reason = recorded['reason']
+        response.headers = CaseInsensitiveDict(recorded['headers'])
+        # the recorded body is already decoded
+        response.headers.pop('Content-Encoding', None)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = from_text(recorded['body'])
+        response.raw = HTTPResponse(
+            body=io.BytesIO(response._content),
+            headers=response.headers,
+            status=recorded['status'],
+            preload_content=False,
+        )
+        response.url = request.url
+        response.request = request
+        return response
+
+    def save(self):
+        """
+        write the recorded interactions, returns the cassette name
+        """
+
+        if not self.recording:
+            return None
+        with self.__lock:
+            content = json.dumps({
+                'version': VERSION,
+                'recorded': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'interactions': self.interactions,
+                'state': self.state,
+            })
+        get_store(self.target).write(self.name, gzip.compress(content.encode('utf-8')))
+        if self.verbose:
+            print('Recorded {} requests to cassette "{}"'.format(
+                len(self.interactions), self.name
+            ))
+        return self.name
+
+
+class CassetteAdapter(BaseAdapter):
+    """
+    Transport adapter recording the responses of the wrapped adapter, or
+    serving them from the cassette
+    """
+
+    def __init__(self, cassette, adapter):
+        super().__init__()
+        self.cassette = cassette
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        if self.cassette.replaying:
+            return self.cassette.play(request)
+        url = request.url
+        response = self.adapter.send(request, **kwargs)
+        self.cassette.record(request, response, url)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+__cassettes = {}
+
+
+def get_cassette(name=None):
+    """
+    one cassette per name and process, shared by the sessions of all tenants
+    """
+
+    name = name or get_config('cassette.name')
+    if name not in __cassettes:
+        __cassettes[name] = Cassette(name=name)
+    return __cassettes[name]
@@ -0,0 +1,228 @@
+import json
+import re
+import sre_constants
+import sre_parse
+
+from config import get_config
+
+# trie node keys, never a single character of a keyword
+END = ''
+PATTERNS = 'patterns'
+# shorter literal prefixes of regex rules match too often to be worth it
+MIN_PREFIX = 3
+# group references change their meaning in a combined regex
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def literal_prefix(pattern):
+    """
+    lowercased literal text every match of a regex starts with
+    """
+
+    prefix = ''
+    for op, av in sre_parse.parse(pattern, re.IGNORECASE):
+        if op != sre_constants.LITERAL:
+            break
+        prefix += chr(av)
+    return prefix.lower()
+
+
+def trie_pattern(node):
+    """
+    regex matching wherever one of the keywords of a trie starts, shared
+    prefixes are only matched once
+    """
+
+    if END in node or PATTERNS in node:
+        # longer keywords are found by the trie walk
+        return ''
+    branches = [
+        re.escape(char) + trie_pattern(child) for char, child in sorted(node.items())
+    ]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:{})'.format('|'.join(branches))
+
+
+class Categorizer(object):
+    """
+    Assigns the category of the first matching rule to a text. The keywords
+    and the literal prefixes of the regexes of all rules are compiled into
+    one trie and one regex, so a text is scanned once instead of once per
+    rule and only the regexes whose prefix was found are tried. Regexes
+    without a literal prefix are combined into regexes of CHUNK_SIZE rules.
+    Usage
+    -----
+    >>> categorizer = Categorizer([
+    >>>     {'category': 'groceries', 'keywords': ['rewe', 'edeka']},
+    >>>     {'category': 'rent', 'patterns': ['miete \\d{2}/\\d{4}']},
+    >>> ])
+    >>> categorizer.categorize('REWE Markt GmbH')
+    'groceries'
+    """
+
+    CHUNK_SIZE = 100
+
+    def __init__(self, rules):
+        self.categories = []
+        self.__trie = {}
+        self.__patterns = []
+        unprefixed = []
+        for i, rule in enumerate(rules):
+            if not rule.get('category'):
+                raise ValueError('Rule {} has no category'.format(i))
+            self.categories.append(rule['category'])
+            for keyword in rule.get('keywords', []):
+                if keyword:
+                    node = self.__node(keyword.lower())
+                    # the first rule of a keyword wins
+                    node[END] = min(node.get(END, i), i)
+            for pattern in rule.get('patterns', []):
+                regex = re.compile(pattern, re.IGNORECASE)
+                prefix = literal_prefix(pattern)
+                if len(prefix) < MIN_PREFIX:
+                    unprefixed.append((i, regex))
+                    continue
+                self.__node(prefix).setdefault(PATTERNS, []).append(len(self.__patterns))
+                self.__patterns.append((i, regex))
+
+        self.__keywords = None
+        if self.__trie:
+            # zero width, finds overlapping keyword starts
+            self.__keywords = re.compile('(?={})'.format(trie_pattern(self.__trie)))
+
+        # (combined regex or None, [(rule index, regex)]) in rule order
+        groups = []
+        for i, regex in unprefixed:
+            alone = GROUP_REFERENCE.search(regex.pattern) is not None
+            if alone or not groups or groups[-1][0] or len(groups[-1][1]) == self.CHUNK_SIZE:
+                groups.append((alone, []))
+            groups[-1][1].append((i, regex))
+        self.__chunks = [
+            (None if alone else self.__combine(members), members)
+            for alone, members in groups
+        ]
+
+    def __combine(self, members):
+        try:
+            return re.compile('|'.join(
+                '(?:{})'.format(regex.pattern) for _, regex in members
+            ), re.IGNORECASE)
+        except re.error:
+            # e.g. the same group name twice, the members are tried one by one
+            return None
+
+    def __node(self, text):
+        node = self.__trie
+        for char in text:
+            node = node.setdefault(char, {})
+        return node
+
+    def __scan(self, text):
+        """
+        (lowest rule index of the keywords, candidate regexes) of `text`
+        """
+
+        best = len(self.categories)
+        candidates = set()
+        if self.__keywords is None:
+            return best, candidates
+
+        text = text.lower()
+        length = len(text)
+        for match in self.__keywords.finditer(text):
+            node = self.__trie
+            pos = match.start()
+            while pos < length:
+                node = node.get(text[pos])
+                if node is None:
+                    break
+                if node.get(END, best) < best:
+                    best = node[END]
+                if PATTERNS in node:
+                    candidates.update(node[PATTERNS])
+                pos += 1
+        return best, candidates
+
+    def rule(self, text):
+        """
+        index of the first matching rule, None if no rule matches
+        """
+
+        best, candidates = self.__scan(text)
+        for n in sorted(candidates):
+            i, regex = self.__patterns[n]
+            if i >= best:
+                break
+            if regex.search(text):
+                best = i
+                break
+
+        for combined, members in self.__chunks:
+            if members[0][0] >= best:
+                break
+            if combined is not None and not combined.search(text):
+                continue
+            for i, regex in members:
+                if i >= best:
+                    break
+                if regex.search(text):
+                    best = i
+                    break
+        return best if best < len(self.categories) else None
+
+    def categorize(self, text):
+        i = self.rule(text)
+        return '' if i is None else self.categories[i]
+
+
+__categorizers = {}
+
+
+def get_categorizer(path=None):
+    """
+    compiled categorizer of a json rules file, None if no rules are configured
+    """
+
+    path = path or get_config('categories.rules')
+    if not path:
+        return None
+    if path not in __categorizers:
+        with open(path, encoding='utf-8') as f:
+            __categorizers[path] = Categorizer(json.load(f))
+    return __categorizers[path]
+
+
+def get_field_indices(data):
+    """
+    indices of the matched columns of an account, empty if it is not categorized
+    """
+
+    fields = get_config('categories.fields').get(data['account_type'], [])
+    return [data['fieldnames'].index(name) for name in fields]
+
+
+def row_text(row, idx):
+    return '\n'.join(row[i] for i in idx if i < len(row))
+
+
+def add_categories(data, categorizer):
+    """
+    insert the category column into a parsed export, before its trailing
+    empty column, for the account types with configured fields
+    """
+
+    idx = get_field_indices(data)
+    if not idx:
+        return data
+
+    fieldnames = list(data['fieldnames'])
+    position = len(fieldnames) - 1 if fieldnames[-1] == '' else len(fieldnames)
+    fieldnames.insert(position, get_config('categories.column'))
+
+    for row in data['transactions']:
+        row.insert(position, categorizer.categorize(row_text(row, idx)))
+
+    data['fieldnames'] = fieldnames
+    data['indices'] = {**data['indices'], 'category': [position]}
+    return data
@@ -0,0 +1,254 @@
+import locale
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import get_config
+from src.sinks import Sink
+from src.storage import get_store
+from src.utils import to_decimal
+
+AMOUNT_TYPE = pa.decimal128(18, 2)
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%x').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_amount(value):
+    """
+    decimal of integer cents, or of a localized amount of older data
+    """
+
+    if isinstance(value, int):
+        return to_decimal(value)
+    try:
+        return Decimal(locale.delocalize(value)).quantize(Decimal('0.01'))
+    except (TypeError, ValueError, InvalidOperation):
+        return None
+
+
+def get_schema(data):
+    """
+    arrow schema for an account, dates and amounts typed, everything else strings
+    """
+
+    indices = data['indices']
+    fields = []
+    columns = []
+    for i, name in enumerate(data['fieldnames']):
+        if name == '':
+            continue
+        if i in indices.get('date', []):
+            fields.append(pa.field(name, pa.date32()))
+        elif i in indices['currency']:
+            fields.append(pa.field(name, AMOUNT_TYPE))
+        else:
+            fields.append(pa.field(name, pa.string()))
+        columns.append(i)
+
+    if 'date' not in indices:
+        fields.append(pa.field('snapshot_date', pa.date32()))
+    return pa.schema(fields), columns
+
+
+def to_records(data, columns, snapshot_date):
+    """
+    typed row tuples for the transactions of an account
+    """
+
+    indices = data['indices']
+    parsers = []
+    for i in columns:
+        if i in indices.get('date', []):
+            parsers.append((i, parse_date))
+        elif i in indices['currency']:
+            parsers.append((i, parse_amount))
+        else:
+            parsers.append((i, None))
+
+    records = []
+    for transaction in data['transactions']:
+        record = tuple(
+            (parse(transaction[i]) if parse else transaction[i])
+            if i < len(transaction) else None
+            for i, parse in parsers
+        )
+        if 'date' not in indices:
+            record += (snapshot_date,)
+        records.append(record)
+    return records
+
+
+class ColumnarSink(Sink):
+    """
+    Columnar sink writing per account and month partitions
+    Usage
+    -----
+    >>> sink = ColumnarSink()
+    >>> sink.add_data(data)
+
+    Layout
+    ------
+    accounts/month=YYYY-MM/data.parquet
+    transactions/account=<account_number>/month=YYYY-MM/data.parquet
+    """
+
+    def __init__(self, verbose=True, target=None):
+        self.verbose = verbose
+        self.__cfg = get_config('columnar')
+        self.__target = target or self.__cfg['target']
+        self.__store = get_store(self.__target)
+        self.__format = self.__cfg['format']
+        if self.__format not in ['parquet', 'arrow']:
+            raise ValueError('Unknown columnar format "{}"'.format(self.__format))
+
+    def __key(self, *parts):
+        return '/'.join(parts + ('data.{}'.format(self.__format),))
+
+    def __read(self, key):
+        raw = self.__store.read(key)
+        if raw is None:
+            return None
+        if self.__format == 'parquet':
+            return pq.read_table(pa.BufferReader(raw))
+        return pa.ipc.open_file(pa.BufferReader(raw)).read_all()
+
+    def __write(self, key, table):
+        sink = pa.BufferOutputStream()
+        if self.__format == 'parquet':
+            pq.write_table(table, sink, compression='snappy')
+        else:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.__store.write(key, sink.getvalue().to_pybytes())
+
+    def __merge(self, key, schema, records, sort_idx, category_idx=None):
+        """
+        merge records into an existing partition, dedup and sort date descending.
+        The partition keeps the columns of both schemas, matched by name and
+        filled with nulls where a side does not have them. The category column
+        and the columns only the partition has are not part of the dedup key.
+        """
+
+        existing = self.__read(key)
+        width = len(schema)
+        if existing is not None:
+            types = {f.name: f.type for f in schema}
+            for f in existing.schema:
+                if f.name in types and not types[f.name].equals(f.type):
+                    raise TypeError('Column "{}" of {} is {}, not {}'.format(
+                        f.name, key, f.type, types[f.name]
+                    ))
+            # columns dropped since the partition was written are kept
+            schema = pa.schema(list(schema) + [f for f in existing.schema if f.name not in types])
+            extra = [None] * (len(schema) - width)
+            columns = existing.to_pydict()
+            missing = [None] * existing.num_rows
+            records = [x + tuple(extra) for x in records] + \
+                list(zip(*[columns.get(n, missing) for n in schema.names]))
+
+        key_idx = [i for i in range(width) if i != category_idx]
+        extra_idx = range(width, len(schema))
+        positions = {}
+        unique = []
+        for x in records:
+            dedup_key = tuple(x[i] for i in key_idx)
+            if dedup_key not in positions:
+                positions[dedup_key] = len(unique)
+                unique.append(x)
+                continue
+            kept = unique[positions[dedup_key]]
+            if any(kept[i] is None and x[i] is not None for i in extra_idx):
+                # the values of dropped columns come from the partition
+                unique[positions[dedup_key]] = kept[:width] + tuple(
+                    x[i] if kept[i] is None else kept[i] for i in extra_idx
+                )
+        if sort_idx is not None:
+            unique.sort(key=lambda x: x[sort_idx] or date.min, reverse=True)
+
+        columns = list(zip(*unique)) if unique else [[] for _ in schema]
+        table = pa.Table.from_arrays(
+            [pa.array(list(c), type=f.type) for c, f in zip(columns, schema)],
+            schema=schema
+        )
+        self.__write(key, table)
+        return table.num_rows
+
+    def update_dashboard(self, data):
+        if self.verbose:
+            print('Writing account values')
+
+        whitelisted = get_config('gsheet.whitelisted')
+        request_date = parse_date(data['info']['request_date']) or date.today()
+        fields = [pa.field('request_date', pa.date32())]
+        for key in whitelisted:
+            fields.append(pa.field(
+                key, AMOUNT_TYPE if key == 'total' else pa.string()
+            ))
+        schema = pa.schema(fields)
+
+        records = []
+        for account_values in data['accounts'].values():
+            record = (request_date,)
+            for key in whitelisted:
+                value = account_values.get(key)
+                record += (
+                    parse_amount(value) if key == 'total' else
+                    None if value is None else str(value),
+                )
+            records.append(record)
+
+        self.__merge(
+            self.__key('accounts', 'month={:%Y-%m}'.format(request_date)),
+            schema, records, None
+        )
+
+    def scope(self):
+        return 'columnar {} {}'.format(self.__target, self.__format)
+
+    def clear(self, account_values):
+        prefix = 'transactions/account={}/'.format(account_values['account_number'])
+        for key in self.__store.list(prefix):
+            self.__store.delete(key)
+
+    def add_data(self, data):
+        if self.verbose:
+            print('Writing columnar partitions')
+
+        snapshot_date = parse_date(data['info']['request_date']) or date.today()
+        for account_values in data['accounts'].values():
+            if 'transactions' in account_values:
+                self.__add(account_values, snapshot_date)
+
+    def __add(self, data, snapshot_date):
+        schema, columns = get_schema(data)
+        records = to_records(data, columns, snapshot_date)
+
+        if 'date' in data['indices']:
+            sort_idx = columns.index(data['indices']['date'][0])
+        else:
+            sort_idx = len(columns)
+        category_idx = None
+        if 'category' in data['indices']:
+            category_idx = columns.index(data['indices']['category'][0])
+
+        partitions = {}
+        for record in records:
+            day = record[sort_idx]
+            month = 'unknown' if day is None else '{:%Y-%m}'.format(day)
+            partitions.setdefault(month, []).append(record)
+
+        for month, partition in sorted(partitions.items()):
+            key = self.__key(
+                'transactions',
+                'account={}'.format(data['account_number']),
+                'month={}'.format(month)
+            )
+            rows = self.__merge(key, schema, partition, sort_idx, category_idx)
+            if self.verbose:
+                print('Wrote {} rows to {}'.format(rows, key))
@@ -2,14 +2,77 @@
 # encoding: utf-8
 
 import csv
+import locale
 import re
 from datetime import date, datetime
-import requests
+from hashlib import sha256
+from html import unescape
 from lxml.html import fromstring
 from fints.client import FinTS3PinTanClient
 
 from config import get_config
-from src.utils import normalize_currency
+from src.archive import ExportArchive
+from src.cassette import get_cassette
+from src.categories import add_categories, get_categorizer
+from src.state import load_state, save_state
+from src.transport import TransportSession
+from src.utils import to_cents
+
+OPTION_RE = re.compile(r'<option\b([^>]*)>(.*?)</option\s*>', re.S | re.I)
+ATTRIBUTE_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+TAG_RE = re.compile(r'<[^>]+>')
+IBAN_RE = re.compile(r'^[A-Z]{2}\d{20}$')
+
+
+def mask_card_number(account):
+    return account[:4] + ((len(account) - 8) * '*') + account[len(account) - 4:]
+
+
+def index_account_options(html):
+    """
+    map the account numbers of the init page <option> elements
+    (plain, masked or IBAN and its account number) to their @value/@tid
+    """
+
+    index = {}
+    for match in OPTION_RE.finditer(html):
+        attributes = {
+            m.group(1).lower(): unescape(m.group(2) or m.group(3) or m.group(4) or '')
+            for m in ATTRIBUTE_RE.finditer(match.group(1))
+        }
+        text = unescape(TAG_RE.sub('', match.group(2))).strip()
+        number = re.sub(r'\s', '', text.split('/')[0])
+        if not number:
+            continue
+
+        entry = {'value': attributes.get('value'), 'tid': attributes.get('tid')}
+        keys = [number]
+        if IBAN_RE.match(number):
+            keys += [number[-10:], number[-10:].lstrip('0')]
+        for key in keys:
+            index.setdefault(key, entry)
+    return index
+
+
+def find_account_option(index, account):
+    """
+    exact lookup, falling back to a substring match like the former xpath
+    """
+
+    if account in index:
+        return index[account]
+    for key, entry in index.items():
+        if account in key:
+            return entry
+    return None
+
+
+def query_info(start_date, end_date):
+    return {
+        'start_date': start_date.strftime('%x'), 'end_date': end_date.strftime('%x'),
+        'request_date': date.today().strftime('%x'),
+        'fetched_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
 
 
 class DKBSession(object):
@@ -23,18 +86,18 @@ class DKBSession(object):
     >>> dkbs.logout()
     """
 
-    def __init__(self, username, password, verbose=True):
-
-        # Initialize HTTP session
-        self.s = requests.Session()
-        self.s.headers = {
-            'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'
-        }
+    def __init__(self, username, password, verbose=True, fingerprints=None):
 
         self.verbose = verbose
+        # export fingerprints of the previous run per account number
+        self.fingerprints = fingerprints or {}
         self.__username = username
         self.__password = password
         self.__dkb_cfg = get_config('dkb')
+        self.__archive = ExportArchive() if get_config('archive.enabled') else None
+
+        # Initialize HTTP session
+        self.s = get_cassette().attach(TransportSession(self.__dkb_cfg.transport))
 
     def login(self):
         """
@@ -84,15 +147,30 @@ class DKBSession(object):
 
         if self.verbose:
             print('Logged out from DKB Online Banking')
+            print('{requests} requests, {elapsed_ms} ms, {bytes} bytes ({wire_bytes} on the wire)'.format(
+                **self.s.summary()
+            ))
 
         return ret
 
-    def query(self, start_date, end_date=date.today()):
-        formatted_from = start_date.strftime('%x')
-        formatted_to = end_date.strftime('%x')
-        print('Querying transactions and balances between "{}" and "{}"'.format(
-            start_date.strftime('%x'), end_date.strftime('%x')
-        ))
+    def get_accounts(self):
+        """
+        Discover accounts via FinTS
+        """
+
+        # FinTS does not use the http session, the discovered accounts are
+        # kept in the cassette instead of its requests
+        cassette = get_cassette()
+        state_name = 'fints-accounts-{}'.format(
+            sha256((self.__username or '').encode('utf-8')).hexdigest()[:16]
+        )
+        if cassette.replaying:
+            accounts = cassette.load_state(state_name)
+            if accounts is None:
+                raise LookupError('FinTS accounts are not in cassette "{}"'.format(
+                    cassette.name
+                ))
+            return [dict(account) for account in accounts]
 
         client = FinTS3PinTanClient(
             self.__dkb_cfg['blz'],  # Your bank's BLZ
@@ -101,130 +179,155 @@ class DKBSession(object):
             self.__dkb_cfg['fints_url']
         )
 
-        depot_accounts = {}
-        credit_accounts = {}
-        sepa_accounts = {}
-        accounts = {}
+        accounts = []
         with client:
             info = client.get_information()
             for account in info['accounts']:
                 del account['supported_operations']
                 del account['bank_identifier']
-                account_number = account['account_number']
+                account_type = 'SEPA'
                 if account['type'] == 30:
-                    depot_accounts[account_number] = {
-                        **account,
-                        'account_type': 'DEPOT',
-                    }
+                    account_type = 'DEPOT'
                 elif account['type'] == 50:
-                    credit_accounts[account_number] = {
-                        **account,
-                        'account_type': 'CREDIT',
-                    }
-                else:
-                    sepa_accounts[account_number] = {
-                        **account,
-                        'account_type': 'SEPA',
-                    }
+                    account_type = 'CREDIT'
+                accounts.append({
+                    **account,
+                    'account_type': account_type,
+                })
 
         client.deconstruct()
+        if cassette.recording:
+            cassette.record_state(state_name, [dict(account) for account in accounts])
+        return accounts
+
+    def query(self, start_date, end_date=date.today()):
+        print('Querying transactions and balances between "{}" and "{}"'.format(
+            start_date.strftime('%x'), end_date.strftime('%x')
+        ))
 
+        accounts = {}
+        for account, params in self.plan([(start_date, end_date)]):
+            accounts[account['account_number']] = self.fetch_export(
+                data=account,
+                params=params,
+            )
+
+        return {
+            'info': query_info(start_date, end_date),
+            'accounts': accounts
+        }
+
+    def plan(self, windows):
+        """
+        (account, query params) of every export to fetch, depot accounts
+        once and the other accounts once per (start_date, end_date) window
+        """
+
+        depot_accounts = {}
+        credit_accounts = {}
+        sepa_accounts = {}
+        for account in self.get_accounts():
+            account_number = account['account_number']
+            if account['account_type'] == 'DEPOT':
+                depot_accounts[account_number] = account
+            elif account['account_type'] == 'CREDIT':
+                credit_accounts[account_number] = account
+            else:
+                sepa_accounts[account_number] = account
+
+        exports = []
         for i, account in enumerate(depot_accounts):
             qp = {
                 'slPortfolio': i,
                 '$event': 'search',
                 '$javascript': 'disabled'
             }
-            # Parse transactions page
-            res = self.__parse_csv(
-                data=depot_accounts[account],
-                params=qp,
-            )
-
-            accounts[account] = {
-                **depot_accounts[account],
-                **res,
-            }
+            exports.append((depot_accounts[account], qp))
 
-        r = self.s.get(
-            get_config('SEPA.url', self.__dkb_cfg),
-            params={'$event': 'init'}
+        options = self.__account_options(
+            [mask_card_number(account) for account in credit_accounts] +
+            list(sepa_accounts)
         )
-        init_page = fromstring(r.text)
-
-        date_format = get_config('formats.date', self.__dkb_cfg)
 
-        from_date = start_date.strftime(date_format)
-        to_date = end_date.strftime(date_format)
+        date_format = self.__dkb_cfg.formats.date
+
+        for start_date, end_date in windows:
+            from_date = start_date.strftime(date_format)
+            to_date = end_date.strftime(date_format)
+
+            for account in credit_accounts:
+                found = options.get(mask_card_number(account))
+                if not found:
+                    continue
+                qp = {
+                    'slAllAccounts': found['value'],
+                    'slTransactionStatus': 0,
+                    'slSearchPeriod': 4,
+                    'filterType': 'DATE_RANGE',
+                    'postingDate': from_date,
+                    'toPostingDate': to_date,
+                    '$event': 'search',
+                    '$javascript': 'disabled'
+                }
+                exports.append((credit_accounts[account], qp))
+
+            for account in sepa_accounts:
+                found = options.get(account)
+                if not found:
+                    continue
+                qp = {
+                    'slAllAccounts': found['tid'],
+                    'slTransactionStatus': 0,
+                    'slSearchPeriod': 1,
+                    'searchPeriodRadio': 1,
+                    'transactionDate': from_date,
+                    'toTransactionDate': to_date,
+                    '$event': 'search',
+                    '$javascript': 'disabled'
+                }
+                exports.append((sepa_accounts[account], qp))
+
+        return exports
+
+    def __account_options(self, accounts):
+        """
+        Look up the init page option of each account, the init page is only
+        fetched if the persisted index misses an account
+        """
 
-        for account in credit_accounts:
-            retained = account[:4] + (
-                (len(account) - 8) * '*'
-            ) + account[len(account) - 4:]
-            found = init_page.xpath(
-                '//*/option[contains(text(), "{}")]/@value'.format(retained)
-            )
-            if len(found) == 0:
-                continue
-            qp = {
-                'slAllAccounts': found[0],
-                'slTransactionStatus': 0,
-                'slSearchPeriod': 4,
-                'filterType': 'DATE_RANGE',
-                'postingDate': from_date,
-                'toPostingDate': to_date,
-                '$event': 'search',
-                '$javascript': 'disabled'
-            }
+        if not accounts:
+            return {}
 
-            # Parse transactions page
-            res = self.__parse_csv(
-                data=credit_accounts[account],
-                params=qp,
-            )
+        state_name = 'account-options-{}'.format(
+            sha256((self.__username or '').encode('utf-8')).hexdigest()[:16]
+        )
+        index = {}
+        if self.__dkb_cfg.cache_account_options:
+            index = load_state(state_name, {})
 
-            accounts[account] = {
-                **credit_accounts[account],
-                **res,
-            }
+        found = {a: find_account_option(index, a) for a in accounts}
+        if all(found.values()):
+            return found
 
-        for account in sepa_accounts:
-            found = init_page.xpath(
-                '//*/option[contains(translate(text(), " ", ""), "{}")]/@tid'.format(account))
-            if len(found) == 0:
-                continue
-            qp = {
-                'slAllAccounts': found[0],
-                'slTransactionStatus': 0,
-                'slSearchPeriod': 1,
-                'searchPeriodRadio': 1,
-                'transactionDate': from_date,
-                'toTransactionDate': to_date,
-                '$event': 'search',
-                '$javascript': 'disabled'
-            }
+        if self.verbose:
+            print('Fetching account options')
+        r = self.s.get(
+            self.__dkb_cfg.SEPA.url,
+            params={'$event': 'init'}
+        )
+        index = index_account_options(r.text)
+        if self.__dkb_cfg.cache_account_options:
+            save_state(state_name, index)
 
-            # Parse transactions page
-            accounts[account] = self.__parse_csv(
-                data=sepa_accounts[account],
-                params=qp,
-            )
-
-        return {
-            'info': {
-                'start_date': formatted_from, 'end_date': formatted_to,
-                'request_date': date.today().strftime('%x')
-            },
-            'accounts': accounts
-        }
+        return {a: find_account_option(index, a) for a in accounts}
 
     def __sanitize_transactions(self, indices, transactions):
+        date_format = self.__dkb_cfg.formats.date
         for transaction in transactions:
             for i in indices['currency']:
-                transaction[i] = normalize_currency(transaction[i])
+                transaction[i] = to_cents(transaction[i])
             if 'date' in indices:
                 for i in indices['date']:
-                    date_format = get_config('formats.date', self.__dkb_cfg)
                     try:
                         date = datetime.strptime(transaction[i], date_format)
                         transaction[i] = date.strftime('%x')
@@ -235,13 +338,15 @@ class DKBSession(object):
 
         return transactions
 
-    def __parse_csv(self, data, params):
+    def fetch_export(self, data, params):
+        """
+        Search and download the csv export of an account
+        """
+
         account_type = data['account_type']
         cfg = self.__dkb_cfg[account_type]
 
         endpoint = cfg['url']
-        total_key = cfg['keys']['total']
-        fieldnames = cfg['fieldnames']
 
         url_string = endpoint + '?'
         ps = []
@@ -253,9 +358,27 @@ class DKBSession(object):
         self.s.get(endpoint, params=params)
         params['$event'] = 'csvExport'
         download = self.s.get(endpoint, params=params)
+        if self.__archive:
+            self.__archive.add(
+                data, params, download.content,
+                download.encoding or download.apparent_encoding
+            )
+
+        return self.parse_export(data, download.text, url_string)
+
+    def parse_export(self, data, text, url_string=''):
+        """
+        Parse a raw DKB csv export into the account structure
+        """
+
+        account_type = data['account_type']
+        cfg = self.__dkb_cfg[account_type]
+
+        total_key = cfg['keys']['total']
+        fieldnames = cfg['fieldnames']
 
         cr = csv.reader(
-            download.text.splitlines(),
+            text.splitlines(),
             delimiter=';'
         )
 
@@ -275,6 +398,9 @@ class DKBSession(object):
                     transaction_begin = i + 1
                     break
 
+        fingerprint = self.__fingerprint(data, total, csv_rows[transaction_begin:])
+        unchanged = self.fingerprints.get(data['account_number']) == fingerprint
+
         indices = {}
         for i, name in enumerate(fieldnames):
             for key, value in cfg['keys'].items():
@@ -282,20 +408,45 @@ class DKBSession(object):
                     indices[key] = [
                         i] if key not in indices else indices[key] + [i]
 
-        transactions = self.__sanitize_transactions(
+        transactions = [] if unchanged else self.__sanitize_transactions(
             indices,
             csv_rows[transaction_begin:]
         )
 
-        total = normalize_currency(total)
-        return {
+        res = {
             **data,
             'title': '{} / {}'.format(data['product_name'], data['account_number']),
-            'total': total,
-            'has_decimal_comma': total[len(total) - 3] == ',',
+            # integer cents, like the amounts of the transactions
+            'total': to_cents(total),
+            'has_decimal_comma': locale.localeconv()['mon_decimal_point'] == ',',
             'url_string': url_string,
             'indices': indices,
             'total_key': total_key,
             'fieldnames': fieldnames,
+            'fingerprint': fingerprint,
             'transactions': transactions
         }
+
+        categorizer = get_categorizer()
+        if categorizer is not None:
+            add_categories(res, categorizer)
+        if unchanged:
+            # same export as in the previous run, nothing to write
+            if self.verbose:
+                print('No changes in "{}"'.format(res['title']))
+            del res['transactions']
+            res['unchanged'] = True
+        return res
+
+    def __fingerprint(self, data, total, rows):
+        """
+        hash of the raw transaction rows and total of an export
+        """
+
+        digest = sha256('{};{};{}\n'.format(
+            data['account_number'], data['account_type'], total
+        ).encode('utf-8'))
+        for row in rows:
+            digest.update(';'.join(row).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
@@ -0,0 +1,263 @@
+import json
+import locale
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from config import get_config
+from src.sinks import Sink
+from src.storage import get_store
+from src.utils import to_decimal
+
+# a position is recorded again only if one of these changed
+TRACKED = ['quantity', 'price', 'value']
+
+
+def parse_decimal(value, localized=True):
+    """
+    decimal string of integer cents, a localized amount or of a raw DKB
+    number ("1.234,5")
+    """
+
+    if isinstance(value, int):
+        # integer cents
+        return str(to_decimal(value))
+    try:
+        if localized:
+            value = locale.delocalize(value)
+        else:
+            value = value.replace('.', '').replace(',', '.')
+        return str(Decimal(value.strip()))
+    except (AttributeError, InvalidOperation):
+        return None
+
+
+def to_timestamp(when):
+    """
+    comparable utc timestamp string, a date means the end of that day
+    """
+
+    if isinstance(when, datetime):
+        return when.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(when, date):
+        return when.strftime('%Y-%m-%dT23:59:59Z')
+    return when
+
+
+def diff_positions(old, new):
+    """
+    (changed, removed) between two {key: position} snapshots
+    """
+
+    changed = {
+        key: position for key, position in new.items()
+        if key not in old or any(old[key].get(f) != position.get(f) for f in TRACKED)
+    }
+    removed = sorted(key for key in old if key not in new)
+    return changed, removed
+
+
+def apply_delta(positions, line):
+    if line.get('base'):
+        return dict(line['positions'])
+    positions = dict(positions)
+    positions.update(line['changed'])
+    for key in line['removed']:
+        positions.pop(key, None)
+    return positions
+
+
+class HoldingsStore(object):
+    """
+    Append-only, delta encoded depot holdings per account. Every monthly
+    segment starts with the full holdings carried over from the previous
+    one, followed by one line per snapshot with the changed positions.
+    Usage
+    -----
+    >>> store = HoldingsStore()
+    >>> store.record('0000000003', positions)
+    >>> store.as_of('0000000003', date(2019, 4, 1))
+    >>> store.series('0000000003', 'DE0005140008', start=date(2019, 1, 1))
+
+    Layout
+    ------
+    account=<account_number>/month=YYYY-MM/holdings.jsonl
+    """
+
+    def __init__(self, target=None):
+        self.__store = get_store(target or get_config('holdings.target'))
+
+    def __segments(self, account_number):
+        prefix = 'account={}/'.format(account_number)
+        return [
+            key for key in self.__store.list(prefix) if key.endswith('/holdings.jsonl')
+        ]
+
+    def __read(self, key):
+        content = self.__store.read(key)
+        if content is None:
+            return []
+        return [json.loads(line) for line in content.decode('utf-8').splitlines() if line]
+
+    def __segment(self, account_number, timestamp):
+        return 'account={}/month={}/holdings.jsonl'.format(account_number, timestamp[:7])
+
+    def __latest(self, account_number, timestamp):
+        """
+        (segment key, lines) of the latest segment up to the month of `timestamp`
+        """
+
+        target = self.__segment(account_number, timestamp)
+        keys = [key for key in self.__segments(account_number) if key <= target]
+        if not keys:
+            return None, []
+        return keys[-1], self.__read(keys[-1])
+
+    def remove(self, account_number):
+        """
+        drop the holdings history of an account
+        """
+
+        for key in self.__segments(account_number):
+            self.__store.delete(key)
+
+    def record(self, account_number, positions, when=None):
+        """
+        append the positions that changed since the last snapshot, returns
+        the number of changed and removed positions
+        """
+
+        timestamp = to_timestamp(when or datetime.utcnow())
+        key, lines = self.__latest(account_number, timestamp)
+
+        current = {}
+        for line in lines:
+            current = apply_delta(current, line)
+
+        changed, removed = diff_positions(current, positions)
+        if not changed and not removed:
+            return 0
+
+        segment = self.__segment(account_number, timestamp)
+        if key != segment:
+            lines = [{'ts': lines[-1]['ts'] if lines else timestamp, 'base': True, 'positions': current}]
+        lines.append({'ts': timestamp, 'changed': changed, 'removed': removed})
+        self.__store.write(segment, ''.join(
+            json.dumps(line, sort_keys=True) + '\n' for line in lines
+        ).encode('utf-8'))
+        return len(changed) + len(removed)
+
+    def as_of(self, account_number, when):
+        """
+        holdings {key: position} at `when` (datetime, date or timestamp)
+        """
+
+        timestamp = to_timestamp(when)
+        _, lines = self.__latest(account_number, timestamp)
+
+        positions = {}
+        for line in lines:
+            if not line.get('base') and line['ts'] > timestamp:
+                break
+            positions = apply_delta(positions, line)
+        return positions
+
+    def series(self, account_number, security, start=None, end=None):
+        """
+        [(timestamp, key, position or None once sold)] of one ISIN or WKN,
+        the holding at `start` followed by one entry per change
+        """
+
+        start = to_timestamp(start) if start else ''
+        end = to_timestamp(end) if end else '9999'
+        first = self.__segment(account_number, start or '0000-00')
+        last = self.__segment(account_number, end)
+        keys = self.__segments(account_number)
+        # the last segment before the range carries the holdings at its start
+        keys = [k for k in keys if k <= first][-1:] + [k for k in keys if first < k <= last]
+
+        def select(positions):
+            return {
+                key: position for key, position in positions.items()
+                if security in (key, position.get('isin'), position.get('wkn'))
+            }
+
+        held = {}
+        series = None if start else []
+        for key in keys:
+            for line in self.__read(key):
+                if line['ts'] > end:
+                    break
+                new = select(apply_delta(held, line))
+                if series is None and line['ts'] >= start:
+                    series = [(start, k, position) for k, position in sorted(held.items())]
+                if series is not None:
+                    series += [
+                        (line['ts'], k, new.get(k))
+                        for k in sorted(set(held) | set(new)) if held.get(k) != new.get(k)
+                    ]
+                held = new
+
+        if series is None:
+            series = [(start, k, position) for k, position in sorted(held.items())]
+        return series
+
+
+def to_positions(data):
+    """
+    {key: position} of the rows of a depot export, keyed by its ISIN / WKN
+    """
+
+    columns = get_config('holdings.columns')
+    fieldnames = data['fieldnames']
+    idx = {name: fieldnames.index(column) for name, column in columns.items()}
+
+    positions = {}
+    for row in data['transactions']:
+        if len(row) <= max(idx.values()) or not row[idx['key']].strip():
+            continue
+        key = row[idx['key']].strip()
+        isin, _, wkn = [part.strip() for part in key.partition('/')]
+        position = {
+            'isin': isin,
+            'wkn': wkn,
+            'name': row[idx['name']],
+            'quantity': parse_decimal(row[idx['quantity']], localized=False),
+            'price': parse_decimal(row[idx['price']]),
+            'value': parse_decimal(row[idx['value']]),
+        }
+        # the same security can be listed more than once (e.g. blocked shares)
+        n = 1
+        unique = key
+        while unique in positions:
+            n += 1
+            unique = '{} #{}'.format(key, n)
+        positions[unique] = position
+    return positions
+
+
+class HoldingsSink(Sink):
+    """
+    Records the holdings of depot accounts in the HoldingsStore
+    """
+
+    def __init__(self, verbose=True, target=None):
+        self.verbose = verbose
+        self.target = target or get_config('holdings.target')
+        self.store = HoldingsStore(self.target)
+
+    def scope(self):
+        return 'holdings {}'.format(self.target)
+
+    def clear(self, account_values):
+        self.store.remove(account_values['account_number'])
+
+    def add_data(self, data):
+        # the time the export was fetched, reprocessed snapshots keep theirs
+        when = data['info'].get('fetched_at') or datetime.utcnow()
+        for account_number, account_values in data['accounts'].items():
+            if account_values.get('account_type') != 'DEPOT' or \
+                    'transactions' not in account_values:
+                continue
+            changes = self.store.record(account_number, to_positions(account_values), when)
+            if self.verbose:
+                print('Recorded {} changed holdings of "{}"'.format(changes, account_number))
@@ -0,0 +1,269 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+from config import get_config
+
+
+class RunInProgress(RuntimeError):
+    """
+    the run in flight did not finish while an overlapping run could wait
+    """
+
+    def __init__(self, message, holder):
+        super().__init__(message)
+        self.holder = holder
+
+
+class Lease(object):
+    """
+    Expiring exclusive lease per key, released with the result of the run
+    that held it
+    Usage
+    -----
+    >>> lease = get_lease()
+    >>> if lease.acquire(key, owner, ttl=900):
+    >>>     lease.release(key, owner, {'status': 'ok', ...})
+    >>> lease.get(key)
+
+    A lease record is {"owner", "expires_at", "last_owner", "result"}, the
+    owner is None once released.
+    """
+
+    def acquire(self, key, owner, ttl):
+        """
+        take the lease if it is free, released or expired
+        """
+
+        raise NotImplementedError
+
+    def release(self, key, owner, result=None):
+        """
+        release a held lease and keep the result for runs waiting on it
+        """
+
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+
+class SQLiteLease(Lease):
+    """
+    Leases in a SQLite database, shared by the processes of one machine or
+    in-process for ':memory:'
+    """
+
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS leases (
+            key TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0,
+            last_owner TEXT,
+            result TEXT
+        )''')
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.__db.execute(
+                    'SELECT owner, expires_at FROM leases WHERE key = ?', (key,)
+                ).fetchone()
+                acquired = row is None or row[0] is None or row[1] <= now
+                if row is None:
+                    self.__db.execute(
+                        'INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)',
+                        (key, owner, now + ttl)
+                    )
+                elif acquired:
+                    self.__db.execute(
+                        'UPDATE leases SET owner = ?, expires_at = ? WHERE key = ?',
+                        (owner, now + ttl, key)
+                    )
+            finally:
+                self.__db.execute('COMMIT')
+        return acquired
+
+    def release(self, key, owner, result=None):
+        with self.__lock:
+            self.__db.execute(
+                'UPDATE leases SET owner = NULL, expires_at = 0, last_owner = ?, result = ? '
+                'WHERE key = ? AND owner = ?',
+                (owner, json.dumps(result), key, owner)
+            )
+
+    def get(self, key):
+        with self.__lock:
+            row = self.__db.execute(
+                'SELECT owner, expires_at, last_owner, result FROM leases WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'owner': row[0],
+            'expires_at': row[1],
+            'last_owner': row[2],
+            'result': json.loads(row[3]) if row[3] else None,
+        }
+
+
+class DynamoDBLease(Lease):
+    """
+    Leases in a DynamoDB table with the string hash key "key", taken with
+    conditional writes
+    """
+
+    def __init__(self, table):
+        import boto3
+
+        self.table = table
+        self.client = boto3.client(
+            'dynamodb', endpoint_url=get_config('lock.dynamodb_endpoint_url')
+        )
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'key': {'S': key}},
+                UpdateExpression='SET #owner = :owner, expires_at = :expires_at',
+                ConditionExpression=(
+                    'attribute_not_exists(#owner) OR expires_at <= :now'
+                ),
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    ':expires_at': {'N': repr(now + ttl)},
+                    ':now': {'N': repr(now)},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release(self, key, owner, result=None):
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'key': {'S': key}},
+                UpdateExpression=(
+                    'SET last_owner = :owner, #result = :result, expires_at = :zero REMOVE #owner'
+                ),
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner', '#result': 'result'},
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    ':result': {'S': json.dumps(result)},
+                    ':zero': {'N': '0'},
+                },
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # expired and taken over meanwhile
+            pass
+
+    def get(self, key):
+        item = self.client.get_item(
+            TableName=self.table, Key={'key': {'S': key}}, ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        return {
+            'owner': item['owner']['S'] if 'owner' in item else None,
+            'expires_at': float(item.get('expires_at', {'N': '0'})['N']),
+            'last_owner': item['last_owner']['S'] if 'last_owner' in item else None,
+            'result': json.loads(item['result']['S']) if 'result' in item else None,
+        }
+
+
+__leases = {}
+
+
+def get_lease(url=None):
+    """
+    leases in sqlite:///path/to.db, memory:// (in-process) or a DynamoDB
+    table (dynamodb://<table>)
+    """
+
+    url = url or get_config('lock.url')
+    if url not in __leases:
+        if url.startswith('sqlite://'):
+            lease = SQLiteLease(url[len('sqlite://'):])
+        elif url.startswith('memory://'):
+            lease = SQLiteLease(':memory:')
+        elif url.startswith('dynamodb://'):
+            lease = DynamoDBLease(url[len('dynamodb://'):])
+        else:
+            raise ValueError('Unknown lock "{}"'.format(url))
+        __leases[url] = lease
+    return __leases[url]
+
+
+def run_exclusive(key, run, lease=None, verbose=True, deadline=None, coalesce=True):
+    """
+    `run()` while holding the lease of `key`. A run arriving while another
+    one holds it waits for that run and returns its result instead, or runs
+    after it without `coalesce`. A lease that expired (crashed holder) is
+    taken over. With the `deadline` of the
+    invocation the lease expires with it and waiting stops in time to
+    answer, by raising RunInProgress.
+
+    returns (result, owner of the run that produced it, coalesced)
+    """
+
+    cfg = get_config('lock')
+    lease = lease or get_lease()
+    owner = uuid4().hex
+    ttl = cfg.ttl
+    wait = cfg.wait
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None:
+        # the run can not outlive its invocation
+        ttl = min(ttl, int(remaining / 1000) + 1)
+        wait = min(wait, max(0, (remaining - get_config('schedule.reserve')) / 1000))
+    wait_until = time.time() + wait
+    holder = None
+    record = None
+    while True:
+        # while the holder runs only its release is waited for
+        if record is None or record.get('owner') is None or record['expires_at'] <= time.time():
+            if lease.acquire(key, owner, ttl):
+                break
+
+        record = lease.get(key) or {}
+        if holder is None:
+            # the run in flight when this one arrived, it may have just finished
+            holder = record.get('owner') or record.get('last_owner')
+            if verbose:
+                print('Run {} in flight for "{}", waiting for it'.format(holder, key))
+        if coalesce and record.get('owner') is None and record.get('last_owner') == holder:
+            result = record['result'] or {}
+            if result.get('status') != 'ok':
+                raise RuntimeError('Attached run {} failed: {}'.format(holder, result.get('err')))
+            return result['res'], holder, True
+        if record.get('owner') not in [None, holder]:
+            # the holder expired and another run took over
+            holder = record['owner']
+
+        if time.time() >= wait_until:
+            raise RunInProgress('Run {} for "{}" is still in flight after {}s'.format(
+                holder, key, round(wait, 3)
+            ), holder)
+        time.sleep(min(cfg.poll_interval, max(0, wait_until - time.time())))
+
+    try:
+        res = run()
+    except Exception as e:
+        lease.release(key, owner, {'status': 'failed', 'err': str(e)})
+        raise
+    lease.release(key, owner, {'status': 'ok', 'res': res})
+    return res, owner, False
@@ -0,0 +1,54 @@
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class MemoryReport(object):
+    """
+    tracemalloc peak memory per phase, phases must not be nested
+    Usage
+    -----
+    >>> report = MemoryReport(enabled=True)
+    >>> with report.phase('query'):
+    >>>     ...
+    >>> report.phases
+    """
+
+    def __init__(self, enabled=True, verbose=True):
+        self.enabled = enabled
+        self.verbose = verbose
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # resets the peak, memory allocated before the phase is not counted
+        tracemalloc.clear_traces()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            record = {
+                'phase': name,
+                'peak_kib': round(peak / 1024, 1),
+                'retained_kib': round(current / 1024, 1),
+                # linux reports kilobytes
+                'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'elapsed_s': round(time.perf_counter() - start, 3),
+            }
+            self.phases.append(record)
+            if self.verbose:
+                print('Memory {phase}: peak {peak_kib} KiB, retained {retained_kib} KiB, max rss {max_rss_kib} KiB'.format(
+                    **record
+                ))
+
+    def stop(self):
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
@@ -0,0 +1,75 @@
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from uuid import uuid4
+
+from config import get_config
+from src.storage import get_store
+
+
+class Profiler(object):
+    """
+    cProfile of a whole invocation, written as a pstats file to the profile
+    target. Nothing is imported or hooked while disabled.
+    Usage
+    -----
+    >>> profiler = Profiler(enabled=True)
+    >>> with profiler.profile('scrape'):
+    >>>     ...
+    >>> profiler.artifact
+    """
+
+    def __init__(self, enabled=None, verbose=True):
+        self.cfg = get_config('profile')
+        self.enabled = self.cfg.enabled if enabled is None else enabled
+        self.verbose = verbose
+        self.artifact = None
+
+    @contextmanager
+    def profile(self, name, invocation_id=None):
+        if not self.enabled:
+            yield
+            return
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.artifact = '{}/{}-{}.prof'.format(
+                name,
+                datetime.utcnow().strftime('%Y%m%dT%H%M%S'),
+                invocation_id or uuid4().hex[:8]
+            )
+            self.__write(profile)
+            if self.verbose:
+                print('Wrote profile {}/{}'.format(self.cfg.target.rstrip('/'), self.artifact))
+                print(self.summary(profile))
+
+    def __write(self, profile):
+        # pstats only dumps to files
+        fd, path = tempfile.mkstemp(suffix='.prof')
+        os.close(fd)
+        try:
+            profile.dump_stats(path)
+            with open(path, 'rb') as f:
+                get_store(self.cfg.target).write(self.artifact, f.read())
+        finally:
+            os.remove(path)
+
+    def summary(self, profile):
+        """
+        the `profile.top` hottest functions, ordered by `profile.sort`
+        """
+
+        import pstats
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.strip_dirs().sort_stats(self.cfg.sort).print_stats(self.cfg.top)
+        return out.getvalue()
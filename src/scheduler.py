@@ -0,0 +1,153 @@
+import time
+from os import environ
+
+from config import get_config
+from src.state import load_state, save_state
+
+
+class Deadline(object):
+    """
+    Remaining time of an invocation, from the lambda context
+    Usage
+    -----
+    >>> deadline = Deadline(context)
+    >>> deadline.remaining()  # milliseconds, None without a context
+    """
+
+    def __init__(self, context=None):
+        self.__remaining = getattr(context, 'get_remaining_time_in_millis', None)
+
+    def remaining(self):
+        if self.__remaining is None:
+            return None
+        return self.__remaining()
+
+
+def can_checkpoint(verbose=True):
+    """
+    whether checkpoints reach the next invocation, lambda containers only
+    share an s3:// STATE_DIR
+    """
+
+    if 'AWS_LAMBDA_FUNCTION_NAME' not in environ or get_config('state_dir').startswith('s3://'):
+        return True
+    if verbose:
+        print(
+            'Warning: checkpoints need a STATE_DIR shared by the lambda containers '
+            '(s3://bucket/prefix), running without them'
+        )
+    return False
+
+
+class Scheduler(object):
+    """
+    Runs the units of work of a run (accounts) while the deadline allows it
+    and checkpoints every finished unit, a later invocation of the same run
+    resumes with the pending units.
+    Usage
+    -----
+    >>> scheduler = Scheduler('checkpoint-...', run_key, Deadline(context))
+    >>> done = scheduler.run([(unit, payload), ...], work)
+    >>> if not scheduler.pending:
+    >>>     scheduler.finish()
+
+    The checkpoint is kept as state, a run key (e.g. the queried date range)
+    different from the checkpointed one starts over. Without a name nothing
+    is checkpointed. Every invocation runs at least one unit, the units left
+    pending by earlier invocations first.
+    """
+
+    def __init__(self, name=None, key=None, deadline=None, verbose=True):
+        if name and not can_checkpoint(verbose=False):
+            raise ValueError(
+                'Checkpoints need a STATE_DIR shared by the lambda containers '
+                '(s3://bucket/prefix), or SCHEDULE=false'
+            )
+        self.name = name
+        self.key = key
+        self.deadline = deadline or Deadline()
+        self.reserve = get_config('schedule.reserve')
+        self.verbose = verbose
+        self.pending = []
+
+        checkpoint = load_state(name, {}) if name else {}
+        # milliseconds of the last run of every unit, kept across runs
+        self.durations = checkpoint.get('durations', {})
+        self.done = {}
+        # invocations a unit has been left pending in
+        self.skipped = {}
+        if checkpoint.get('key') == key:
+            self.done = checkpoint.get('done', {})
+            self.skipped = checkpoint.get('skipped', {})
+
+    def estimate(self, unit):
+        """
+        expected milliseconds of a unit, the mean of the known ones if it
+        never ran
+        """
+
+        if unit in self.durations:
+            return self.durations[unit]
+        if self.durations:
+            return sum(self.durations.values()) / len(self.durations)
+        return 0
+
+    def run(self, units, work):
+        """
+        `work(payload)` for every (unit, payload) that is not done yet, the
+        longest pending and then the shortest first so that most of them fit
+        in. Returns the results of all done units, including the ones of
+        earlier invocations.
+        """
+
+        queue = sorted(
+            (unit for unit in units if unit[0] not in self.done),
+            key=lambda unit: (-self.skipped.get(unit[0], 0), self.estimate(unit[0]))
+        )
+        if self.verbose and len(queue) < len(units):
+            print('Resuming from checkpoint, {} of {} done'.format(
+                len(units) - len(queue), len(units)
+            ))
+
+        ran = False
+        while queue:
+            unit, payload = queue[0]
+            remaining = self.deadline.remaining()
+            # a unit estimated above the whole budget still runs once it is first
+            if ran and remaining is not None and remaining - self.reserve < self.estimate(unit):
+                if self.verbose:
+                    print('{}ms left, checkpointing with {} pending'.format(
+                        remaining, len(queue)
+                    ))
+                break
+
+            start = time.perf_counter()
+            self.done[unit] = work(payload)
+            self.durations[unit] = int((time.perf_counter() - start) * 1000)
+            self.skipped.pop(unit, None)
+            queue.pop(0)
+            ran = True
+            if queue:
+                self.__save()
+
+        self.pending = [unit for unit, _ in queue]
+        for unit in self.pending:
+            self.skipped[unit] = self.skipped.get(unit, 0) + 1
+        self.__save()
+        return self.done
+
+    def finish(self):
+        """
+        the run is complete, only the durations are kept
+        """
+
+        self.done = {}
+        self.skipped = {}
+        self.__save()
+
+    def __save(self):
+        if self.name:
+            save_state(self.name, {
+                'key': self.key, 'done': self.done, 'durations': self.durations,
+                'skipped': self.skipped,
+            })
@@ -0,0 +1,361 @@
+import json
+import re
+import time
+from bisect import bisect_left
+from datetime import date, datetime
+from hashlib import sha1
+from uuid import uuid4
+
+from config import get_config
+from src.lease import run_exclusive
+from src.sinks import Sink
+from src.storage import get_store
+from src.utils import format_cents
+
+TOKEN = re.compile(r'\w+')
+# segments merged into one once there are more
+MAX_SEGMENTS = 8
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def to_iso_date(value):
+    """
+    ISO date string of a date, an ISO or DKB formatted string or a sheet
+    formatted ('%x') date
+    """
+
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m-%d')
+    for date_format in ['%Y-%m-%d', get_config('dkb.formats.date'), '%x']:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def to_documents(data):
+    """
+    search documents of the transactions of an account, the category is
+    indexed but not part of the document key
+    """
+
+    fields = get_config('search.fields').get(data['account_type'])
+    if not fields:
+        return []
+
+    fieldnames = list(data['fieldnames'])
+    indices = data['indices']
+    idx = [fieldnames.index(name) for name in fields]
+    category = indices.get('category', [None])[0]
+    if category is not None:
+        idx.append(category)
+    date_idx = indices['date'][0]
+
+    currency = set(indices['currency'])
+    docs = []
+    for row in data['transactions']:
+        # amounts are integer cents, documents keep them as displayed
+        row = [
+            format_cents(x) if i in currency and isinstance(x, int) else x
+            for i, x in enumerate(row)
+        ]
+        key_cells = [x for i, x in enumerate(row) if i != category]
+        docs.append({
+            'key': sha1('{};{}'.format(
+                data['account_number'], ';'.join(key_cells)
+            ).encode('utf-8')).hexdigest()[:16],
+            'account': data['account_number'],
+            'date': to_iso_date(row[date_idx]) if date_idx < len(row) else None,
+            'text': '\n'.join(row[i] for i in idx if i < len(row)),
+            'fieldnames': fieldnames,
+            'cells': row,
+        })
+    return docs
+
+
+class SearchIndex(object):
+    """
+    Incremental inverted index of transaction texts. Every update appends
+    a segment with the new documents and their postings, segments are
+    merged once there are more than MAX_SEGMENTS.
+    Usage
+    -----
+    >>> index = SearchIndex()
+    >>> index.add(to_documents(account_values))
+    >>> index.search('rewe miet*', start='2019-01-01', end='2019-03-31')
+
+    Layout
+    ------
+    manifest.json
+    segments/<uuid>.json
+
+    A segment holds the distinct fieldnames of its documents ("layouts"),
+    the documents as [key, account, date, layout, cells] and the postings
+    {term: [document]}. Updates of processes sharing the index hold its
+    lease while they read and write the manifest.
+    """
+
+    def __init__(self, target=None):
+        self.target = target or get_config('search.target')
+        self.__store = get_store(self.target)
+        self.__reset()
+
+    def __reset(self):
+        self.__segments = []
+        self.__layouts = []
+        self.__docs = []
+        self.__keys = set()
+        self.__postings = {}
+        self.__terms = None
+
+    def __load(self):
+        """
+        read the segments written since the last load, by other processes too
+        """
+
+        content = self.__store.read('manifest.json')
+        manifest = json.loads(content.decode('utf-8')) if content else {'segments': []}
+        if manifest['segments'][:len(self.__segments)] != self.__segments:
+            # merged by another process
+            self.__reset()
+        for name in manifest['segments'][len(self.__segments):]:
+            self.__append(json.loads(self.__store.read(name).decode('utf-8')))
+            self.__segments.append(name)
+
+    def __layout(self, fieldnames):
+        if fieldnames not in self.__layouts:
+            self.__layouts.append(fieldnames)
+        return self.__layouts.index(fieldnames)
+
+    def __append(self, segment):
+        docs = segment['docs']
+        layouts = [self.__layout(fieldnames) for fieldnames in segment['layouts']]
+        if layouts != list(range(len(layouts))):
+            for doc in docs:
+                doc[3] = layouts[doc[3]]
+
+        offset = len(self.__docs)
+        self.__docs += docs
+        self.__keys.update(doc[0] for doc in docs)
+        if offset == 0:
+            # copied, the postings of the index grow in place
+            self.__postings = {term: list(ids) for term, ids in segment['postings'].items()}
+        else:
+            for term, ids in segment['postings'].items():
+                self.__postings.setdefault(term, []).extend(offset + i for i in ids)
+        self.__terms = None
+
+    def __write(self, name, layouts, docs, postings):
+        # sorted terms keep the term list nearly sorted after loading
+        self.__store.write(name, json.dumps({
+            'layouts': layouts, 'docs': docs, 'postings': postings
+        }, sort_keys=True).encode('utf-8'))
+
+    def __save_manifest(self):
+        self.__store.write('manifest.json', json.dumps({
+            'segments': self.__segments
+        }).encode('utf-8'))
+
+    def __exclusive(self, update):
+        """
+        `update()` holding the lease of the index, a concurrent update waits
+        and loads the manifest written by this one
+        """
+
+        if not get_config('lock.enabled'):
+            return update()
+        res, _, _ = run_exclusive(
+            'search {}'.format(self.target), update, verbose=False, coalesce=False
+        )
+        return res
+
+    def add(self, docs):
+        """
+        index the documents not indexed yet, returns their number
+        """
+
+        return self.__exclusive(lambda: self.__add(docs))
+
+    def __add(self, docs):
+        self.__load()
+        layouts = []
+        new = []
+        postings = {}
+        for doc in docs:
+            if doc['key'] in self.__keys:
+                continue
+            self.__keys.add(doc['key'])
+            if doc['fieldnames'] not in layouts:
+                layouts.append(doc['fieldnames'])
+            for term in set(tokenize(doc['text'])):
+                postings.setdefault(term, []).append(len(new))
+            new.append([
+                doc['key'], doc['account'], doc['date'],
+                layouts.index(doc['fieldnames']), doc['cells']
+            ])
+        if not new:
+            return 0
+
+        name = 'segments/{}.json'.format(uuid4().hex)
+        self.__write(name, layouts, new, postings)
+        self.__append({'layouts': layouts, 'docs': new, 'postings': postings})
+        self.__segments.append(name)
+
+        merged = []
+        if len(self.__segments) > MAX_SEGMENTS:
+            merged = self.__segments
+            name = 'segments/{}.json'.format(uuid4().hex)
+            self.__write(name, self.__layouts, self.__docs, self.__postings)
+            self.__segments = [name]
+        self.__save_manifest()
+        for old in merged:
+            self.__store.delete(old)
+        return len(new)
+
+    def remove(self, account):
+        """
+        drop the documents of an account, the index is rewritten as one
+        segment. Returns their number.
+        """
+
+        return self.__exclusive(lambda: self.__remove(account))
+
+    def __remove(self, account):
+        self.__load()
+        ids = {}
+        for i, doc in enumerate(self.__docs):
+            if doc[1] != account:
+                ids[i] = len(ids)
+        removed = len(self.__docs) - len(ids)
+        if not removed:
+            return 0
+
+        postings = {}
+        for term, old_ids in self.__postings.items():
+            kept = [ids[i] for i in old_ids if i in ids]
+            if kept:
+                postings[term] = kept
+        merged = self.__segments
+        name = 'segments/{}.json'.format(uuid4().hex)
+        self.__write(
+            name, self.__layouts, [doc for i, doc in enumerate(self.__docs) if i in ids], postings
+        )
+        self.__segments = [name]
+        self.__save_manifest()
+        for old in merged:
+            self.__store.delete(old)
+        # loaded again from the written segment
+        self.__reset()
+        return removed
+
+    def __matching(self, term):
+        """
+        ids of the documents containing a term, or a term prefix ("miet*")
+        """
+
+        if not term.endswith('*'):
+            return set(self.__postings.get(term, []))
+
+        prefix = term.rstrip('*')
+        if self.__terms is None:
+            self.__terms = sorted(self.__postings)
+        ids = set()
+        for i in range(bisect_left(self.__terms, prefix), len(self.__terms)):
+            if not self.__terms[i].startswith(prefix):
+                break
+            ids.update(self.__postings[self.__terms[i]])
+        return ids
+
+    def search(self, query='', start=None, end=None, account=None, limit=50):
+        """
+        documents containing all terms of the query, newest first, optionally
+        within a date range (inclusive) and of one account
+        """
+
+        began = time.perf_counter()
+        self.__load()
+
+        terms = [
+            token + '*' if part.endswith('*') else token
+            for part in query.lower().split()
+            for token in tokenize(part)
+        ]
+        if terms:
+            sets = sorted((self.__matching(term) for term in terms), key=len)
+            ids = sets[0].intersection(*sets[1:])
+        else:
+            ids = range(len(self.__docs))
+
+        start = to_iso_date(start) if start else ''
+        end = to_iso_date(end) if end else '9999'
+        docs = [
+            self.__docs[i] for i in ids
+            if start <= (self.__docs[i][2] or '') <= end and
+            (account is None or self.__docs[i][1] == account)
+        ]
+        docs.sort(key=lambda doc: doc[2] or '', reverse=True)
+
+        return {
+            'total': len(docs),
+            'took_ms': round((time.perf_counter() - began) * 1000, 3),
+            'results': [
+                {
+                    'account': account_number,
+                    'date': day,
+                    'row': {
+                        name: cell for name, cell in zip(self.__layouts[layout], cells) if name
+                    },
+                }
+                for _, account_number, day, layout, cells in docs[:limit]
+            ],
+        }
+
+
+__indexes = {}
+
+
+def get_index(target=None):
+    """
+    one index per target and process, warm invocations only read new segments
+    """
+
+    target = target or get_config('search.target')
+    if target not in __indexes:
+        __indexes[target] = SearchIndex(target)
+    return __indexes[target]
+
+
+class SearchSink(Sink):
+    """
+    Adds the transactions of SEPA and credit card accounts to the SearchIndex
+    """
+
+    def __init__(self, verbose=True, target=None):
+        self.verbose = verbose
+        self.target = target or get_config('search.target')
+        self.index = get_index(self.target)
+
+    def scope(self):
+        return 'search {} {}'.format(self.target, json.dumps(get_config('search.fields'), sort_keys=True))
+
+    def clear(self, account_values):
+        removed = self.index.remove(account_values['account_number'])
+        if self.verbose:
+            print('Removed {} indexed transactions of "{}"'.format(
+                removed, account_values['account_number']
+            ))
+
+    def add_data(self, data):
+        for account_number, account_values in data['accounts'].items():
+            if 'transactions' not in account_values:
+                continue
+            docs = to_documents(account_values)
+            if not docs:
+                continue
+            added = self.index.add(docs)
+            if self.verbose:
+                print('Indexed {} new transactions of "{}"'.format(added, account_number))
@@ -1,28 +1,388 @@
+import heapq
+import re
+from collections import Counter
 from datetime import datetime
+from operator import itemgetter
+import numpy as np
 import gspread
-from gspread.utils import rowcol_to_a1
+from gspread.utils import fill_gaps, rowcol_to_a1
 from gspread.urls import SPREADSHEETS_API_V4_BASE_URL
 from oauth2client.service_account import ServiceAccountCredentials
 from oauth2client.crypt import Signer
 
 from config import get_config
-from src.utils import format_pattern, get_format_request
+from src.cassette import get_cassette
+from src.categories import get_categorizer, get_field_indices, row_text
+from src.sinks import Sink
+from src.state import load_state, save_state
+from src.utils import format_pattern, get_format_request, get_session, to_cents
 
 DRIVE_V3_URL = 'https://www.googleapis.com/drive/v3/files'
 ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# day zero of the serial numbers of spreadsheet dates
+SERIAL_EPOCH = datetime(1899, 12, 30)
+# formats a sheet may display the updated_at timestamp in
+TIMESTAMP_FORMATS = ['%m/%d/%Y %H:%M:%S', '%d.%m.%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S']
 
 
-def parse_time(row, indices):
-    row = row.split(';')
+def merge_sorted(sources, indices):
+    """
+    merge lists of joined rows sorted by date descending (export windows,
+    existing worksheet rows) into one deduplicated list in linear time.
+    Rows of the same date keep the order of the sources, a source out of
+    order is sorted first.
+    """
+
+    date_idx = indices['date'][0]
+    parsed = {}
+
+    def key(row):
+        value = row.split(';', date_idx + 1)[date_idx]
+        if value not in parsed:
+            try:
+                parsed[value] = datetime.strptime(value, '%x')
+            except ValueError as e:
+                print(e)
+                print(row, date_idx)
+                parsed[value] = datetime.fromtimestamp(0)
+        return parsed[value]
+
+    keyed = []
+    for rows in sources:
+        keys = [key(row) for row in rows]
+        if any(keys[i] < keys[i + 1] for i in range(len(keys) - 1)):
+            rows = sorted(rows, key=key, reverse=True)
+            keys = [key(row) for row in rows]
+        keyed.append(zip(keys, rows))
+
+    seen = set()
+    unique_rows = [
+        row for _, row in heapq.merge(*keyed, key=itemgetter(0), reverse=True)
+        if not (row in seen or seen.add(row))
+    ]
+    return unique_rows
+
+
+def merge_rows(new_rows, existing_rows, indices):
+    """
+    dedup joined rows and sort them by date descending
+    """
+
+    return merge_sorted([new_rows, existing_rows], indices)
+
+
+def reconcile_pending(new_rows, existing_rows, status, pending, match):
+    """
+    new and existing joined rows without the pending transactions of the
+    sheet that have settled, the settled row takes their place when the rows
+    are merged.
+    `status` is the position of the status column, `match` the positions of
+    the columns a transaction keeps when it settles.
+    """
+
+    def split(rows):
+        for row in rows:
+            cells = row.split(';')
+            yield row, len(cells) > status and cells[status] == pending, tuple(
+                cells[i] if i < len(cells) else '' for i in match
+            )
+
+    # each newly settled row replaces at most one pending row of the sheet,
+    # settled rows the sheet already holds have replaced theirs before
+    settled = Counter(
+        key for _, is_pending, key in split(set(new_rows) - set(existing_rows))
+        if not is_pending
+    )
+    if not settled:
+        return new_rows, existing_rows
+
+    # the sheet holds the older pending versions, the pending rows of the
+    # export are current
+    kept = []
+    for row, is_pending, key in split(existing_rows):
+        if is_pending and settled[key] > 0:
+            settled[key] -= 1
+            continue
+        kept.append(row)
+    return new_rows, kept
+
+
+def merge_categorized(new_rows, existing_rows, indices, width, categorize=None):
+    """
+    merge_rows ignoring the category column, a row keeps its newest category.
+    Rows with less than `width` columns were written without categories and
+    are categorized with `categorize(cells)`.
+    """
+
+    position = indices['category'][0]
+    categories = {}
+
+    def strip(rows):
+        keys = []
+        for row in rows:
+            cells = row.split(';')
+            if len(cells) >= width:
+                category = cells.pop(position)
+            else:
+                category = categorize(cells) if categorize else ''
+            key = ';'.join(cells)
+            categories[key] = category
+            keys.append(key)
+        return keys
+
+    existing_keys = strip(existing_rows)
+    # stripped last, the new categories win
+    new_keys = strip(new_rows)
+    unique_rows = merge_rows(new_keys, existing_keys, indices)
+    del new_keys, existing_keys
+
+    for i, key in enumerate(unique_rows):
+        cells = key.split(';')
+        cells.insert(position, categories[key])
+        unique_rows[i] = ';'.join(cells)
+    return unique_rows
+
+
+def monthly_sums(rows, indices):
+    """
+    sum the amounts of joined rows per month, newest month first
+
+    amounts are summed as integer cents, months as datetime64[M]
+    """
+
+    if not rows:
+        return []
+
     date_idx = indices['date'][0]
-    try:
-        return datetime.strptime(row[date_idx], '%x')
-    except ValueError as e:
-        print(e)
-        print(row, date_idx)
-        return datetime.fromtimestamp(0)
-
-class GSheet(object):
+    amount_idx = indices['currency'][0]
+    split = [row.split(';') for row in rows]
+    dates = np.array([row[date_idx] for row in split])
+    amounts = np.array([row[amount_idx] for row in split])
+
+    # only the distinct dates need to be parsed
+    unique_dates, inverse = np.unique(dates, return_inverse=True)
+    parsed = []
+    for value in unique_dates:
+        try:
+            parsed.append(np.datetime64(datetime.strptime(value, '%x').date(), 'M'))
+        except ValueError:
+            parsed.append(np.datetime64('NaT', 'M'))
+    months = np.array(parsed, dtype='datetime64[M]')[inverse]
+
+    valid = ~np.isnat(months) & np.char.isdigit(np.char.lstrip(amounts, '-'))
+    cents = amounts[valid].astype(np.int64)
+    months = months[valid]
+
+    unique_months, inverse = np.unique(months, return_inverse=True)
+    sums = np.zeros(len(unique_months), dtype=np.int64)
+    np.add.at(sums, inverse, cents)
+    return list(zip(unique_months[::-1], sums[::-1]))
+
+
+def dump_monthly_sums(sums):
+    """
+    json serializable monthly sums, [["YYYY-MM", cents], ...]
+    """
+
+    return [[str(month), int(cents)] for month, cents in sums]
+
+
+def load_monthly_sums(sums):
+    return [(np.datetime64(month, 'M'), np.int64(cents)) for month, cents in sums]
+
+
+def same_timestamp(value, written):
+    """
+    a cell value read back is the timestamp written to it, the sheet parses
+    it to a serial number, formats it in its locale or keeps the text
+    """
+
+    if isinstance(value, (int, float)):
+        return abs(value - written['serial']) < 0.5 / 86400
+    if value == written['text']:
+        return True
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.strptime(value, timestamp_format)
+        except (TypeError, ValueError):
+            continue
+        return abs((parsed - SERIAL_EPOCH).total_seconds() / 86400 - written['serial']) < 0.5 / 86400
+    return False
+
+
+def partition_title(title, day, mode):
+    """
+    worksheet of an account for a day, "<title> 2019" or "<title> 2019-Q2"
+    """
+
+    if mode == 'quarter':
+        return '{} {}-Q{}'.format(title, day.year, (day.month - 1) // 3 + 1)
+    return '{} {}'.format(title, day.year)
+
+
+def partition_pattern(title, mode):
+    suffix = r'\d{4}-Q[1-4]' if mode == 'quarter' else r'\d{4}'
+    return re.compile(r'^{} {}$'.format(re.escape(title), suffix))
+
+
+def partition_rows(rows, indices, title, mode):
+    """
+    group joined rows by the partition of their date, rows without a valid
+    date go into the current partition
+    """
+
+    date_idx = indices['date'][0]
+    current = partition_title(title, datetime.now(), mode)
+    titles = {}
+    partitions = {}
+    for row in rows:
+        value = row.split(';')[date_idx]
+        if value not in titles:
+            try:
+                titles[value] = partition_title(
+                    title, datetime.strptime(value, '%x'), mode
+                )
+            except ValueError:
+                titles[value] = current
+        partitions.setdefault(titles[value], []).append(row)
+    return partitions
+
+
+def grow_grid(current, needed):
+    """
+    grid size holding `needed` rows or columns, at least doubled when it has
+    to grow so later resizes stay rare
+    """
+
+    return current if needed <= current else max(needed, 2 * current)
+
+
+def a1_range(title, start_row, start_col, end_row, end_col):
+    return "'{}'!{}:{}".format(
+        title.replace("'", "''"),
+        rowcol_to_a1(start_row, start_col),
+        rowcol_to_a1(end_row, end_col)
+    )
+
+
+def to_grid(rows, height, width):
+    """
+    pad ragged rows to a height x width grid of strings and numbers
+    """
+
+    grid = []
+    for x in range(height):
+        row = rows[x] if x < len(rows) else []
+        grid.append([
+            (row[y] if isinstance(row[y], (int, float)) else str(row[y]))
+            if y < len(row) else '' for y in range(width)
+        ])
+    return grid
+
+
+def diff_ranges(title, old_grid, new_grid):
+    """
+    value ranges for the cells that differ between two grids,
+    one range per run of adjacent changed cells in a row
+    """
+
+    height = max(len(old_grid), len(new_grid))
+    width = max([len(r) for r in old_grid + new_grid] + [0])
+    old_grid = to_grid(old_grid, height, width)
+    new_grid = to_grid(new_grid, height, width)
+
+    ranges = []
+    for x in range(height):
+        y = 0
+        while y < width:
+            if old_grid[x][y] == new_grid[x][y]:
+                y += 1
+                continue
+            start = y
+            while y < width and old_grid[x][y] != new_grid[x][y]:
+                y += 1
+            ranges.append({
+                'range': a1_range(title, x + 1, start + 1, x + 1, y),
+                'values': [new_grid[x][start:y]],
+            })
+    return ranges
+
+
+def fill_cells(cells, rows, indices):
+    """
+    set cell values from joined rows (header first) and split them by value
+    input option, amounts are written as numbers, dates parsed by the sheet
+    """
+
+    user_entered = []
+    raw = []
+    row = None
+    values = []
+    currency = set(indices['currency'])
+    dates = set(indices.get('date', []))
+    for cell in cells:
+        x = cell.row - 1
+        y = cell.col - 1
+        # cells come row by row, split every row only once
+        if x != row:
+            row = x
+            values = rows[x].split(';') if x < len(rows) else []
+        try:
+            value = values[y]
+            cell.value = value
+        except:
+            cell.value = ''
+
+        if x and y in currency and cell.value:
+            try:
+                cell.value = int(cell.value) / 100
+            except ValueError:
+                pass
+
+        if x and y in dates:
+            user_entered.append(cell)
+        else:
+            raw.append(cell)
+
+    return user_entered, raw
+
+
+def get_client(verbose=True):
+    """
+    authenticated gspread client for the configured service account
+    """
+
+    sheet_cfg = get_config('gsheet')
+    if verbose:
+        print('Authenticating for Google Sheets')
+
+    cassette = get_cassette()
+    session = cassette.attach(get_session(
+        sheet_cfg['api_base_url'],
+        sheet_cfg['api_hosts']
+    ))
+    if cassette.replaying:
+        # the token is fetched outside the session, recorded requests need none
+        return gspread.Client(auth=None, session=session)
+
+    creds = sheet_cfg['creds']
+    signer = Signer.from_string(creds['private_key'])
+    client = gspread.Client(
+        auth=ServiceAccountCredentials(
+            client_id=creds['client_id'],
+            service_account_email=creds['client_email'],
+            private_key_id=creds['private_key_id'],
+            token_uri=creds['token_uri'],
+            scopes=sheet_cfg['scope'],
+            signer=signer
+        ),
+        session=session
+    )
+    client.login()
+    return client
+
+
+class GSheet(Sink):
     """
     Google Sheet
     Usage
@@ -31,20 +391,31 @@ class GSheet(object):
     >>> gsheet.add_data(data)
     """
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, sheet_name=None, client=None, monthly=None):
         self.verbose = verbose
+        # title -> monthly sums of the written rows, can be seeded when the
+        # dashboard is updated apart from the data (worker mode)
+        self.__monthly = dict(monthly or {})
+        # account title -> partition worksheet titles, newest first
+        self.__partitions = {}
+        # title -> worksheet, from one metadata fetch per instance
+        self.__worksheets = None
+        # whether the stored state matches the spreadsheet, checked once, and
+        # the updated_at of the dashboard the monthly sums were saved with
+        self.__current = None
+        self.__base = None
         cfg = get_config()
         self.__sheet_cfg = cfg['gsheet']
         self.__dkb_cfg = cfg['dkb']
-        self.__creds = self.__authenticate()
-        self.__gc = gspread.authorize(self.__creds)
+        # an authenticated client can be shared between instances (batch mode)
+        self.__gc = client or get_client(verbose)
 
         self.currency_pattern = format_pattern(
-            get_config('formats.currency', self.__sheet_cfg),
+            self.__sheet_cfg.formats.currency,
             ' ' + self.__dkb_cfg['currency']
         )
 
-        sheet_name = self.__sheet_cfg['sheet_name']
+        sheet_name = sheet_name or self.__sheet_cfg['sheet_name']
         try:
             # self.__delete_spreadsheet(sheet_name)
             self.__sh = self.__gc.open(sheet_name)
@@ -56,22 +427,144 @@ class GSheet(object):
                 sheet_name)
             )
 
-    def __authenticate(self):
-        if self.verbose:
-            print('Authenticating for Google Sheets')
+    @property
+    def monthly(self):
+        return self.__monthly
 
-        creds = self.__sheet_cfg['creds']
-        signer = Signer.from_string(creds['private_key'])
-        scope = self.__sheet_cfg['scope']
+    def __worksheet_index(self):
+        """
+        worksheets by title, the spreadsheet metadata is only fetched once and
+        kept up to date locally. The updated_at cell of the dashboard is
+        fetched along to check the stored state.
+        """
 
-        return ServiceAccountCredentials(
-            client_id=creds['client_id'],
-            service_account_email=creds['client_email'],
-            private_key_id=creds['private_key_id'],
-            token_uri=creds['token_uri'],
-            scopes=scope,
-            signer=signer
+        if self.__worksheets is None:
+            snapshot = self.__snapshot()
+            metadata = None
+            if snapshot:
+                try:
+                    metadata = self.__gc.request(
+                        'get',
+                        '{}/{}'.format(SPREADSHEETS_API_V4_BASE_URL, self.__sh.id),
+                        params={
+                            'includeGridData': 'true',
+                            'ranges': "'{}'!{}".format(
+                                self.__sheet_cfg['generated_values_ws_name'],
+                                snapshot['updated_at']['cell']
+                            ),
+                            'fields': 'sheets(properties,data.rowData.values(effectiveValue,formattedValue))',
+                        }
+                    ).json()
+                except gspread.exceptions.APIError:
+                    # the dashboard worksheet was deleted
+                    self.__stale()
+            if metadata is None:
+                metadata = self.__sh.fetch_sheet_metadata()
+            self.__worksheets = {
+                sheet['properties']['title']: gspread.models.Worksheet(self.__sh, sheet['properties'])
+                for sheet in metadata['sheets']
+            }
+            if self.__current is None:
+                self.__check_updated_at(metadata, snapshot)
+        return self.__worksheets
+
+    def __snapshot(self):
+        """
+        dashboard snapshot while the stored state is not checked yet and the
+        check needs the updated_at cell, None otherwise
+        """
+
+        if self.__current is not None:
+            return None
+
+        snapshot = load_state('dashboard-{}'.format(self.__sh.id))
+        if snapshot is None:
+            # not written yet (new spreadsheet, checkpointed invocations),
+            # only sums saved without a dashboard are used
+            self.__current = True
+            return None
+        if 'updated_at' not in snapshot:
+            self.__stale()
+            return None
+        return snapshot
+
+    def __check_updated_at(self, metadata, snapshot):
+        title = self.__sheet_cfg['generated_values_ws_name']
+        sheet = next(
+            (s for s in metadata['sheets'] if s['properties']['title'] == title), None
         )
+        if sheet is None or sheet['properties']['sheetId'] != snapshot['sheet_id']:
+            self.__stale()
+            return
+
+        rows = [row for data in sheet.get('data', []) for row in data.get('rowData', [])]
+        cell = rows[0]['values'][0] if rows and rows[0].get('values') else {}
+        value = cell.get('effectiveValue', {}).get('numberValue', cell.get('formattedValue'))
+        if value is not None and same_timestamp(value, snapshot['updated_at']):
+            self.__current = True
+            self.__base = snapshot['updated_at']['text']
+        else:
+            self.__stale()
+
+    def __stale(self):
+        self.__current = False
+        if self.verbose:
+            print('Dashboard changed since the last run, the stored state is not used')
+
+    def __state_current(self):
+        """
+        whether the persisted state of the spreadsheet (dashboard snapshot,
+        monthly sums) was saved by the run that wrote the dashboard last, the
+        updated_at cell of the dashboard has to hold the stored timestamp
+        """
+
+        if self.__current is None:
+            self.__worksheet_index()
+        return self.__current
+
+    def __load_monthly(self):
+        """
+        stored monthly sums by worksheet title, empty unless they were saved
+        since the current dashboard was written
+        """
+
+        stored = load_state('monthly-{}'.format(self.__sh.id), {})
+        if not self.__state_current() or stored.get('base') != self.__base:
+            return {}
+        return stored.get('sums', {})
+
+    def __save_monthly(self, sums):
+        save_state('monthly-{}'.format(self.__sh.id), {'base': self.__base, 'sums': sums})
+
+    def __worksheet(self, title, rows=None, cols=None):
+        """
+        worksheet with a grid of at least rows x cols, added if it is missing
+        """
+
+        worksheets = self.__worksheet_index()
+        ws = worksheets.get(title)
+        if ws is None:
+            if rows is None:
+                raise gspread.exceptions.WorksheetNotFound(title)
+            ws = self.__sh.add_worksheet(
+                title=title, rows=grow_grid(100, rows), cols=grow_grid(20, cols)
+            )
+            worksheets[title] = ws
+            return ws
+
+        grid = ws._properties['gridProperties']
+        planned = {
+            'rowCount': grow_grid(grid['rowCount'], rows or 0),
+            'columnCount': grow_grid(grid['columnCount'], cols or 0),
+        }
+        if planned != {key: grid[key] for key in planned}:
+            ws.resize(rows=planned['rowCount'], cols=planned['columnCount'])
+            grid.update(planned)
+        return ws
+
+    def __del_worksheet(self, ws):
+        self.__sh.del_worksheet(ws)
+        self.__worksheet_index().pop(ws.title, None)
 
     def __delete_spreadsheet(self, title):
         res = self.__gc.list_spreadsheet_files()
@@ -144,9 +637,9 @@ class GSheet(object):
         if self.verbose:
             print('Updating dashboard "{}"'.format(title))
 
-        ws = self.__sh.worksheet(title=title)
-
         whitelisted = self.__sheet_cfg['whitelisted']
+        # checked before the dashboard worksheet is added
+        self.__state_current()
 
         account_values = []
         row = -1
@@ -156,15 +649,20 @@ class GSheet(object):
             list(accounts[list(accounts.keys())[0]].keys())
         ))
 
-        now = datetime.now().strftime('%x %X')
+        now = datetime.now().replace(microsecond=0)
         sheet_header = [
             title,
             '(changes will be overwritten)'
         ]
         sheet_header = sheet_header + \
             ([''] * (len(header) - len(sheet_header)))
-        sheet_header[len(sheet_header) - 1] = now
+        sheet_header[len(sheet_header) - 1] = now.strftime('%x %X')
         sheet_header[len(sheet_header) - 2] = 'updated_at'
+        updated_at = {
+            'cell': rowcol_to_a1(1, len(sheet_header)),
+            'text': now.strftime('%x %X'),
+            'serial': (now - SERIAL_EPOCH).total_seconds() / 86400,
+        }
 
         rows = [
             sheet_header,
@@ -180,30 +678,56 @@ class GSheet(object):
         start_idx = len(rows)
         query_row = []
         query_header = []
+        sums_columns = []
         for i, account in enumerate(accounts):
             row = i + (start_idx)
             rows.append([])
             col = 0
             account_values = accounts[account]
             account_cfg = self.__dkb_cfg[account_values['account_type']]
-            if account_cfg['display_sums']:
+            monthly = self.__monthly.get(account_values.get('title'))
+            if monthly is None and account_cfg['display_sums']:
+                # not written by this run (unchanged or checkpointed before)
+                monthly = self.__stored_monthly(account_values['title'])
+            if account_cfg['display_sums'] and monthly is not None:
+                query_header = query_header + [account, '', '']
+                query_row = query_row + ['MONTHS', 'SUM', '']
+                sums_columns.append([
+                    [month.astype(datetime).strftime('%B %Y'), int(cents) / 100]
+                    for month, cents in monthly
+                ])
+            elif account_cfg['display_sums']:
                 indices = account_values['indices']
+                separators = {
+                    'array_separator': ' \\ ' if account_values['has_decimal_comma'] else ', ',
+                    'arg_separator': ';' if account_values['has_decimal_comma'] else ','
+                }
+                # one (month, amount) array per worksheet, stacked across partitions
+                arrays = [
+                    '''{{ARRAYFORMULA(IF(LEN('{sheet}'!{date_col}2:{date_col}){arg_separator} EOMONTH('{sheet}'!{date_col}2:{date_col};0){arg_separator} "")){array_separator}'{sheet}'!{amount_col}2:{amount_col}}}'''.format(
+                        sheet=sheet,
+                        date_col=ALPHABET[indices['date'][0]],
+                        amount_col=ALPHABET[indices['currency'][0]],
+                        **separators
+                    )
+                    for sheet in self.__account_sheets(account_values)
+                ]
                 query = '''=QUERY(
-                        {{ARRAYFORMULA(IF(LEN('{sheet}'!{date_col}2:{date_col}){arg_separator} EOMONTH('{sheet}'!{date_col}2:{date_col};0){arg_separator} "")){array_separator}'{sheet}'!{amount_col}2:{amount_col}}}{arg_separator}
+                        {data}{arg_separator}
                         "{formula}"
                     )'''.format(**{
-                    'sheet': account_values['title'],
-                    'date_col': ALPHABET[indices['date'][0]],
-                    'amount_col': ALPHABET[indices['currency'][0]],
+                    'data': arrays[0] if len(arrays) == 1 else '{{{}}}'.format('; '.join(arrays)),
                     'formula': 'select Col1, sum(Col2) group by Col1 order by Col1 desc label Col1\'MONTHS\', sum(Col2)\'SUM\' format Col1\'MMMM YYYY\'',
-                    'array_separator': ' \\ ' if account_values['has_decimal_comma'] else ', ',
-                    'arg_separator': ';' if account_values['has_decimal_comma'] else ','
+                    **separators
                 })
                 query_header = query_header + [account, '', '']
                 query_row = query_row + [query, '', '']
+                sums_columns.append([])
 
             for key in header:
-                if key in account_values:
+                if key == 'total':
+                    rows[row].append(account_values[key] / 100)
+                elif key in account_values:
                     rows[row].append(str(account_values[key]))
                 if key == 'total':
                     if not start_row_format:
@@ -225,38 +749,73 @@ class GSheet(object):
         rows.append(footer)
 
         rows.append([])
+        query_header_row = len(rows)
         rows.append(query_header)
         rows.append(query_row)
 
+        # locally computed monthly sums, formulas spill into these rows themselves
+        for x in range(max([len(c) for c in sums_columns] + [0])):
+            sums_row = []
+            for column in sums_columns:
+                sums_row += (column[x] if x < len(column) else ['', '']) + ['']
+            rows.append(sums_row)
+
         max_row = len(rows)
-        block_range = 'A1:{}'.format(
-            rowcol_to_a1(max_row, max(max_col, len(query_header)))
-        )
+        max_grid_col = max(max_col, len(query_header))
+        grid = to_grid(rows, max_row, max_grid_col)
+        ws = self.__worksheet(title, max_row, max_grid_col)
+        layout = {
+            'header': header,
+            'query_header': query_header,
+            'rows': max_row,
+            'cols': max_grid_col,
+        }
 
-        cells = ws.range(block_range)
+        snapshot_name = 'dashboard-{}'.format(self.__sh.id)
+        snapshot = None
+        if self.__sheet_cfg['dashboard_diff'] and self.__state_current():
+            snapshot = load_state(snapshot_name)
 
-        for cell in cells:
-            x = cell.row - 1
-            y = cell.col - 1
-            try:
-                value = rows[x][y]
-                cell.value = value
-            except:
-                pass
+        if snapshot:
+            # only send the cells changed since the last written grid
+            ranges = diff_ranges(title, snapshot['grid'], grid)
+            if self.verbose:
+                print('Updating {} changed dashboard ranges'.format(len(ranges)))
+            if ranges:
+                self.__values_batch_update(ranges)
+        else:
+            cells = ws.range('A1:{}'.format(rowcol_to_a1(max_row, max_grid_col)))
 
-        ws.clear()
+            for cell in cells:
+                cell.value = grid[cell.row - 1][cell.col - 1]
 
-        ws.update_cells(
-            cells,
-            value_input_option='USER_ENTERED'
-        )
+            ws.clear()
+
+            ws.update_cells(
+                cells,
+                value_input_option='USER_ENTERED'
+            )
+
+        if self.__sheet_cfg['dashboard_sums'] == 'values':
+            # the monthly sums saved so far belong to the written dashboard
+            monthly = self.__load_monthly()
+            self.__current, self.__base = True, updated_at['text']
+            self.__save_monthly(monthly)
+
+        snapshot_value = {
+            'sheet_id': ws.id, 'grid': grid, 'layout': layout, 'updated_at': updated_at
+        }
+        if snapshot and snapshot['layout'] == layout:
+            # formatting only depends on the layout
+            save_state(snapshot_name, snapshot_value)
+            return
 
         query_end_col = len(query_header)
 
         repeat_cells = [
             {
                 'start_row': start_row_format,
-                'end_row': max_row - 2,
+                'end_row': query_header_row,
                 'start_col': start_col_format,
                 'end_col': max_col,
                 'fields': 'userEnteredFormat.numberFormat',
@@ -302,8 +861,8 @@ class GSheet(object):
                 }
             },
             {
-                'start_row': max_row - 2,
-                'end_row': max_row - 1,
+                'start_row': query_header_row,
+                'end_row': query_header_row + 1,
                 'start_col': 0,
                 'end_col': query_end_col,
                 'fields': 'userEnteredFormat.backgroundColor',
@@ -318,8 +877,8 @@ class GSheet(object):
                 }
             },
             {
-                'start_row': max_row - 1,
-                'end_row': max_row,
+                'start_row': query_header_row + 1,
+                'end_row': query_header_row + 2,
                 'start_col': 0,
                 'end_col': query_end_col,
                 'fields': 'userEnteredFormat.backgroundColor',
@@ -335,8 +894,8 @@ class GSheet(object):
             },
             # SUM ROW
             {
-                'start_row': max_row - 4,
-                'end_row': max_row - 3,
+                'start_row': query_header_row - 2,
+                'end_row': query_header_row - 1,
                 'start_col': end_col_format - 2,
                 'end_col': max_col,
                 'fields': 'userEnteredFormat.backgroundColor',
@@ -356,7 +915,7 @@ class GSheet(object):
             if i % 3 == 1:
                 repeat_cells.append(
                     {
-                        'start_row': max_row,
+                        'start_row': query_header_row + 2,
                         'end_row': 999999,
                         'start_col': i,
                         'end_col': i + 1,
@@ -396,8 +955,8 @@ class GSheet(object):
                     }
                 },
                 {
-                    'start_row': max_row - 4,
-                    'end_row': max_row - 3,
+                    'start_row': query_header_row - 2,
+                    'end_row': query_header_row - 1,
                     'start_col': max_col - 2,
                     'end_col': max_col,
                     'borders': {
@@ -413,8 +972,8 @@ class GSheet(object):
                     }
                 },
                 {
-                    'start_row': max_row - 1,
-                    'end_row': max_row,
+                    'start_row': query_header_row + 1,
+                    'end_row': query_header_row + 2,
                     'start_col': 0,
                     'end_col': query_end_col,
                     'borders': {
@@ -433,6 +992,48 @@ class GSheet(object):
         )
 
         self.__sh.batch_update(req)
+        save_state(snapshot_name, snapshot_value)
+
+    def __values_batch_update(self, ranges, value_input_option='USER_ENTERED'):
+        return self.__gc.request(
+            'post',
+            '{}/{}/values:batchUpdate'.format(
+                SPREADSHEETS_API_V4_BASE_URL, self.__sh.id
+            ),
+            json={
+                'valueInputOption': value_input_option,
+                'data': ranges,
+            }
+        ).json()
+
+    def scope(self):
+        return 'gsheet {} {} {}'.format(
+            self.__sh.id, self.__sheet_cfg['partition'], self.__sheet_cfg['dashboard_sums']
+        )
+
+    def clear(self, account_values):
+        """
+        delete the worksheet of an account and its partitions
+        """
+
+        title = account_values['title']
+        pattern = partition_pattern(title, self.__sheet_cfg['partition'])
+        worksheets = self.__worksheet_index()
+        titles = [t for t in worksheets if t == title or pattern.match(t)]
+        if self.verbose:
+            print('Deleting {} worksheets of {}'.format(len(titles), title))
+        for t in titles:
+            if len(worksheets) > 1:
+                self.__del_worksheet(worksheets[t])
+            else:
+                # a spreadsheet keeps at least one worksheet
+                worksheets[t].clear()
+
+        self.__partitions.pop(title, None)
+        self.__monthly.pop(title, None)
+        stored = self.__load_monthly()
+        if any(t in stored for t in titles):
+            self.__save_monthly({t: sums for t, sums in stored.items() if t not in titles})
 
     def add_data(self, data):
         if self.verbose:
@@ -444,82 +1045,220 @@ class GSheet(object):
                 self.__add(account_values)
 
     def __add(self, data):
-        ws = None
         title = data['title']
         if self.verbose:
             print('Adding data to {}'.format(title))
 
-        try:
-            ws = self.__sh.worksheet(title=title)
-        except:
-            ws = self.__sh.add_worksheet(title=title, rows='100', cols='20')
+        new_rows = list(
+            map(lambda x: ';'.join(map(str, x)), data['transactions'])
+        )
+        account_cfg = self.__dkb_cfg[data['account_type']]
+        mode = self.__sheet_cfg['partition']
 
-        header = data['fieldnames']
-        max_col = len(header)
+        if mode != 'none' and account_cfg['merge_values'] and 'date' in data['indices']:
+            self.__add_partitioned(data, new_rows, mode)
+            return
 
-        suffix = ' ' + self.__dkb_cfg['currency']
+        sums = self.__write(title, data, new_rows)
+        if sums is not None:
+            self.__monthly[title] = sums
+            # kept for the runs that skip the unchanged account
+            stored = self.__load_monthly()
+            stored[title] = dump_monthly_sums(sums)
+            self.__save_monthly(stored)
 
-        new_rows = list(
-            map(lambda x: ';'.join(x), data['transactions'])
+    def __stored_monthly(self, title):
+        """
+        monthly sums of an account as written by an earlier run, None if they
+        were not kept
+        """
+
+        if self.__sheet_cfg['dashboard_sums'] != 'values':
+            return None
+        stored = self.__load_monthly()
+        mode = self.__sheet_cfg['partition']
+        if mode != 'none':
+            pattern = partition_pattern(title, mode)
+            partitions = sorted((t for t in stored if pattern.match(t)), reverse=True)
+            if partitions:
+                return [sums for t in partitions for sums in load_monthly_sums(stored[t])]
+        if title in stored:
+            return load_monthly_sums(stored[title])
+        return None
+
+    def __existing_rows(self, ws, indices):
+        """
+        joined rows of a worksheet without its header, amounts as cents
+        """
+
+        res = self.__sh.values_get(ws.title, params={
+            'valueRenderOption': 'UNFORMATTED_VALUE',
+            'dateTimeRenderOption': 'FORMATTED_STRING',
+        })
+        if 'values' not in res:
+            return []
+
+        currency = set(indices['currency'])
+
+        def to_cell(i, value):
+            if i not in currency or value == '':
+                return str(value)
+            if isinstance(value, str):
+                # amount the sheet did not parse
+                try:
+                    return str(to_cents(value))
+                except ValueError:
+                    return value
+            return str(int(round(value * 100)))
+
+        return [
+            ';'.join(to_cell(i, value) for i, value in enumerate(row)) + ';'
+            for row in fill_gaps(res['values'])[1:]
+        ]
+
+    def __categorize(self, data):
+        """
+        categorizes the cells of rows written before categories were added
+        """
+
+        categorizer = get_categorizer()
+        if categorizer is None:
+            return None
+        idx = get_field_indices(data)
+        return lambda cells: categorizer.categorize(row_text(cells, idx))
+
+    def __account_sheets(self, data):
+        """
+        worksheet titles of an account, its partitions newest first
+        """
+
+        title = data['title']
+        account_cfg = self.__dkb_cfg[data['account_type']]
+        mode = self.__sheet_cfg['partition']
+        if mode == 'none' or not account_cfg['merge_values'] or 'date' not in data['indices']:
+            return [title]
+        if title not in self.__partitions:
+            # dashboard updated apart from the data (worker mode)
+            pattern = partition_pattern(title, mode)
+            self.__partitions[title] = sorted(
+                (t for t in self.__worksheet_index() if pattern.match(t)),
+                reverse=True
+            )
+        return self.__partitions[title] or [title]
+
+    def __add_partitioned(self, data, new_rows, mode):
+        """
+        write the rows into the partitions of their dates, only the partitions
+        with new rows are read and written
+        """
+
+        title = data['title']
+        indices = data['indices']
+        account_cfg = self.__dkb_cfg[data['account_type']]
+
+        worksheets = dict(self.__worksheet_index())
+        unpartitioned = worksheets.get(title)
+        if unpartitioned:
+            if self.verbose:
+                print('Moving "{}" into {} partitions'.format(title, mode))
+            new_rows = new_rows + self.__existing_rows(unpartitioned, indices)
+
+        partitions = partition_rows(new_rows, indices, title, mode)
+        del new_rows
+
+        stored = self.__load_monthly()
+        stored.pop(title, None)
+        for partition, rows in sorted(partitions.items()):
+            sums = self.__write(partition, data, rows)
+            if sums is not None:
+                stored[partition] = dump_monthly_sums(sums)
+
+        pattern = partition_pattern(title, mode)
+        titles = sorted(
+            set(t for t in worksheets if pattern.match(t)) | set(partitions),
+            reverse=True
         )
+        self.__partitions[title] = titles
+
+        if account_cfg['display_sums'] and self.__sheet_cfg['dashboard_sums'] == 'values':
+            for partition in titles:
+                if partition not in stored:
+                    # partition written before its sums were kept, or by
+                    # another run
+                    stored[partition] = dump_monthly_sums(monthly_sums(
+                        self.__existing_rows(worksheets[partition], indices), indices
+                    ))
+            self.__save_monthly(stored)
+            # partitions hold distinct months, newest partition first
+            self.__monthly[title] = [
+                sums for partition in titles for sums in load_monthly_sums(stored[partition])
+            ]
+
+        if unpartitioned:
+            self.__del_worksheet(unpartitioned)
+
+    def __write(self, title, data, new_rows):
+        """
+        merge the rows into a worksheet, returns the monthly sums of all its
+        rows if they are shown as values on the dashboard
+        """
+
+        ws = self.__worksheet_index().get(title)
+
+        header = data['fieldnames']
+        max_col = len(header)
+
         account_cfg = self.__dkb_cfg[data['account_type']]
 
         indices = data['indices']
+        sums = None
         if account_cfg['merge_values']:
-            existing_rows = list(
-                map(
-                    lambda x: ';'.join(
-                        map(lambda x: x.replace(suffix, ''), x)
-                    ) + ';',
-                    ws.get_all_values()[1:]
+            existing_rows = self.__existing_rows(ws, indices) if ws else []
+            reconcile = account_cfg.get('reconcile')
+            if reconcile:
+                new_rows, existing_rows = reconcile_pending(
+                    new_rows, existing_rows,
+                    header.index(reconcile['status']),
+                    reconcile['pending'],
+                    [header.index(name) for name in reconcile['match']]
                 )
-            )
-            seen = set()
-            unique_rows = [
-                x for x in (new_rows + existing_rows)
-                if not (x in seen or seen.add(x))
-            ]
-            unique_rows = sorted(
-                unique_rows,
-                key=lambda x: parse_time(x, indices),
-                reverse=True
-            )
+            if 'category' in indices:
+                unique_rows = merge_categorized(
+                    new_rows, existing_rows, indices, max_col, self.__categorize(data)
+                )
+            else:
+                unique_rows = merge_rows(new_rows, existing_rows, indices)
+            del new_rows, existing_rows
+            if account_cfg['display_sums'] and self.__sheet_cfg['dashboard_sums'] == 'values':
+                sums = monthly_sums(unique_rows, indices)
         else:
             unique_rows = new_rows
 
-        unique_rows = [';'.join(header)] + unique_rows
+        unique_rows.insert(0, ';'.join(header))
 
         max_row = len(unique_rows)
         block_range = 'A1:{}'.format(
             rowcol_to_a1(max_row, max_col)
         )
+        ws = self.__worksheet(title, max_row, max_col)
 
-        user_entered = []
-        raw = []
-        for cell in ws.range(block_range):
-            x = cell.row - 1
-            y = cell.col - 1
-            try:
-                value = unique_rows[x].split(';')[y]
-                cell.value = value
-            except:
-                cell.value = ''
-
-            if y in indices['currency'] or ('date' in indices and y in indices['date']):
-                user_entered.append(cell)
-            else:
-                raw.append(cell)
+        user_entered, raw = fill_cells(
+            ws.range(block_range), unique_rows, indices
+        )
+        del unique_rows
 
         ws.clear()
-        ws.update_cells(
-            user_entered,
-            value_input_option='USER_ENTERED'
-        )
+        if user_entered:
+            ws.update_cells(
+                user_entered,
+                value_input_option='USER_ENTERED'
+            )
 
         ws.update_cells(
             raw,
             value_input_option='RAW'
         )
+        del user_entered, raw
 
         repeat_cells = [
             {
@@ -601,3 +1340,4 @@ class GSheet(object):
         )
 
         self.__sh.batch_update(req)
+        return sums
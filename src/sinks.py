@@ -0,0 +1,69 @@
+from config import get_config
+
+
+class Sink(object):
+    """
+    Output for queried account data
+    Usage
+    -----
+    >>> for sink in get_sinks():
+    >>>     sink.update_dashboard(data)
+    >>>     sink.add_data(data)
+    """
+
+    def update_dashboard(self, data):
+        """
+        Write account level values (totals etc.)
+        """
+
+        pass
+
+    def add_data(self, data):
+        """
+        Write the transactions of all accounts
+        """
+
+        raise NotImplementedError
+
+    def scope(self):
+        """
+        Where and how the sink writes, an unchanged export is only skipped
+        for the same scope
+        """
+
+        return type(self).__name__
+
+    def clear(self, account_values):
+        """
+        Remove the transactions of an account, before it is written again
+        """
+
+        raise NotImplementedError
+
+
+def get_sink(name, verbose=True, **options):
+    if name == 'gsheet':
+        from src.sheets import GSheet
+        return GSheet(verbose=verbose, **options)
+    if name == 'columnar':
+        from src.columnar import ColumnarSink
+        return ColumnarSink(verbose=verbose, **options)
+    if name == 'holdings':
+        from src.holdings import HoldingsSink
+        return HoldingsSink(verbose=verbose, **options)
+    if name == 'search':
+        from src.search import SearchSink
+        return SearchSink(verbose=verbose, **options)
+    raise ValueError('Unknown sink "{}"'.format(name))
+
+
+def get_sinks(names=None, verbose=True, options={}):
+    """
+    instantiate the configured sinks, `options` holds constructor
+    arguments per sink name
+    """
+
+    return [
+        get_sink(name.strip(), verbose=verbose, **options.get(name.strip(), {}))
+        for name in (names or get_config('sinks')) if name.strip()
+    ]
@@ -0,0 +1,52 @@
+import json
+
+from config import get_config
+from src.cassette import get_cassette
+from src.storage import get_store
+
+__stores = {}
+
+
+def __store():
+    """
+    store of the state, a local directory or s3://bucket/prefix shared by
+    all containers
+    """
+
+    target = get_config('state_dir')
+    if target not in __stores:
+        __stores[target] = get_store(target)
+    return __stores[target]
+
+
+def load_state(name, default=None):
+    """
+    load persisted json state, `default` if there is none (yet)
+    """
+
+    cassette = get_cassette()
+    if cassette.replaying:
+        value = cassette.load_state(name)
+    else:
+        content = __store().read('{}.json'.format(name))
+        try:
+            value = json.loads(content.decode('utf-8')) if content else None
+        except ValueError:
+            value = None
+        if cassette.recording:
+            cassette.record_state(name, value)
+    return default if value is None else value
+
+
+def save_state(name, value):
+    """
+    persist json state atomically
+    """
+
+    cassette = get_cassette()
+    if cassette.replaying:
+        # a replay leaves the state of real runs alone
+        cassette.save_state(name, value)
+        return
+
+    __store().write('{}.json'.format(name), json.dumps(value).encode('utf-8'))
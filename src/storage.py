@@ -0,0 +1,100 @@
+import os
+
+from config import get_config
+
+
+class LocalStore(object):
+    """
+    Key/value blob store in a local directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def __path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def read(self, key):
+        try:
+            with open(self.__path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, data):
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=''):
+        keys = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(
+                    os.path.join(root, name), self.root
+                ).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+
+class S3Store(object):
+    """
+    Key/value blob store in an S3 compatible bucket
+    """
+
+    def __init__(self, url):
+        import boto3
+
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client(
+            's3', endpoint_url=get_config('storage.s3_endpoint_url')
+        )
+
+    def __key(self, key):
+        return '{}/{}'.format(self.prefix, key) if self.prefix else key
+
+    def read(self, key):
+        try:
+            res = self.client.get_object(Bucket=self.bucket, Key=self.__key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return res['Body'].read()
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.__key(key), Body=data)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.__key(key))
+
+    def list(self, prefix=''):
+        keys = []
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.__key(prefix)):
+            for item in page.get('Contents', []):
+                keys.append(item['Key'][strip:])
+        return sorted(keys)
+
+
+def get_store(target):
+    """
+    blob store for a local directory or an s3://bucket/prefix url
+    """
+
+    if target.startswith('s3://'):
+        return S3Store(target)
+    return LocalStore(target)
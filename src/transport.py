@@ -0,0 +1,90 @@
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# only requests without side effects are retried
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransportSession(requests.Session):
+    """
+    requests session with pooled, retrying adapters, default timeouts and a
+    timing/byte record per request
+    Usage
+    -----
+    >>> s = TransportSession(get_config('dkb.transport'))
+    >>> s.get(url)
+    >>> s.records[-1]['elapsed_ms'], s.summary()
+    """
+
+    def __init__(self, cfg):
+        super().__init__()
+
+        self.timeout = (cfg.connect_timeout, cfg.read_timeout)
+        self.records = []
+
+        retry = Retry(
+            total=cfg.retries,
+            connect=cfg.retries,
+            read=cfg.retries,
+            status=cfg.retries,
+            method_whitelist=IDEMPOTENT_METHODS,
+            status_forcelist=RETRY_STATUSES,
+            backoff_factor=cfg.backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=cfg.pool_connections,
+            pool_maxsize=cfg.pool_size,
+            max_retries=retry,
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+        self.headers.update({
+            'User-Agent': cfg.user_agent,
+            'Accept-Encoding': 'gzip, deflate',
+        })
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        start = time.perf_counter()
+        r = super().request(method, url, **kwargs)
+        # the body is read at this point unless streamed, so the timing covers the download
+        elapsed = time.perf_counter() - start
+
+        size = len(r.content) if not kwargs.get('stream') else None
+        try:
+            # bytes read from the socket, before gzip decoding
+            wire = r.raw.tell()
+        except Exception:
+            wire = None
+
+        self.records.append({
+            'method': method.upper(),
+            'url': urlsplit(r.url)._replace(query='', fragment='').geturl(),
+            'status': r.status_code,
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'bytes': size,
+            'wire_bytes': wire,
+            'content_encoding': r.headers.get('Content-Encoding'),
+        })
+        return r
+
+    def summary(self):
+        """
+        totals over all recorded requests
+        """
+
+        return {
+            'requests': len(self.records),
+            'elapsed_ms': round(sum(r['elapsed_ms'] for r in self.records), 3),
+            'bytes': sum(r['bytes'] or 0 for r in self.records),
+            'wire_bytes': sum(r['wire_bytes'] or 0 for r in self.records),
+        }
@@ -1,7 +1,10 @@
 from os import environ
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import re
 import locale
+import requests
+from requests.adapters import HTTPAdapter
 
 from config import get_config
 
@@ -19,6 +22,37 @@ def init():
             )
 
 
+class RebaseAdapter(HTTPAdapter):
+    """
+    Transport adapter sending requests for `hosts` to `base_url` instead
+    """
+
+    def __init__(self, base_url, hosts, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+        self.hosts = hosts
+
+    def send(self, request, **kwargs):
+        for host in self.hosts:
+            if request.url.startswith(host):
+                request.url = self.base_url + request.url[len(host):]
+                break
+        return super().send(request, **kwargs)
+
+
+def get_session(base_url=None, hosts=[]):
+    """
+    requests session, optionally rebased onto a different server
+    """
+
+    session = requests.Session()
+    if base_url:
+        adapter = RebaseAdapter(base_url, hosts)
+        for host in hosts:
+            session.mount(host, adapter)
+    return session
+
+
 def parse_range(time_span, end_date, date_format):
     try:
         return end_date - timedelta(days=int(time_span))
@@ -26,7 +60,12 @@ def parse_range(time_span, end_date, date_format):
         return datetime.strptime(time_span, date_format)
 
 
-def normalize_currency(amount):
+def to_cents(amount):
+    """
+    integer cents of a DKB amount ("-1.234,56", "12,5", "" is 0), rounded
+    half up, raises a ValueError if it is not an amount
+    """
+
     res = re.search(r'(.*?)(?:[\.\,]{0,1})(\d+)\s*[a-zA-Z]*$', amount)
     nr = ''
     suffix = '00'
@@ -37,10 +76,27 @@ def normalize_currency(amount):
     else:
         nr = res.group(1)
         suffix = res.group(2)
-    return locale.currency(float('{}.{}'.format(
-        nr.replace(',', '').replace('.', ''),
-        suffix
-    )), grouping=True, symbol=False)
+    try:
+        value = Decimal('{}.{}'.format(nr.replace(',', '').replace('.', ''), suffix))
+    except InvalidOperation:
+        raise ValueError('Invalid amount "{}"'.format(amount))
+    return int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_decimal(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+def format_cents(cents):
+    """
+    locale formatted amount without currency symbol
+    """
+
+    return locale.currency(cents / 100, grouping=True, symbol=False)
+
+
+def normalize_currency(amount):
+    return format_cents(to_cents(amount))
 
 
 def format_pattern(pattern, suffix):
@@ -53,7 +109,7 @@ def format_pattern(pattern, suffix):
 
 
 def get_format_request(sheet_id, max_row, max_col, repeat_cells=[], borders=[]):
-    requests = [
+    request_list = [
         # resize everything
         {
             'autoResizeDimensions': {
@@ -85,7 +141,7 @@ def get_format_request(sheet_id, max_row, max_col, repeat_cells=[], borders=[]):
     ]
 
     for border in borders:
-        requests.append({
+        request_list.append({
             'updateBorders': {
                 'range': {
                     'sheetId': sheet_id,
@@ -99,7 +155,7 @@ def get_format_request(sheet_id, max_row, max_col, repeat_cells=[], borders=[]):
         })
 
     for cells in repeat_cells:
-        requests.append({
+        request_list.append({
             'repeatCell': {
                 'range': {
                     'sheetId': sheet_id,
@@ -117,5 +173,5 @@ def get_format_request(sheet_id, max_row, max_col, repeat_cells=[], borders=[]):
 
     return {
         'includeSpreadsheetInResponse': False,
-        'requests': requests
+        'requests': request_list
     }
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from config import get_config
+
+Message = namedtuple('Message', ['id', 'body', 'receipt'])
+
+
+class WorkQueue(object):
+    """
+    At least once queue of json work items, a message that is not acked
+    becomes visible again after the visibility timeout
+    Usage
+    -----
+    >>> queue = get_queue()
+    >>> queue.put({'account': ...})
+    >>> message = queue.get(wait=5)
+    >>> queue.ack(message)
+    """
+
+    def put(self, body):
+        raise NotImplementedError
+
+    def put_many(self, bodies):
+        for body in bodies:
+            self.put(body)
+
+    def get(self, wait=0):
+        """
+        next visible message, None if there is none within `wait` seconds
+        """
+
+        raise NotImplementedError
+
+    def ack(self, message):
+        raise NotImplementedError
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    Queue in a SQLite database, shared by the processes of one machine or
+    in-process for ':memory:'
+    """
+
+    def __init__(self, path, visibility_timeout=300, max_attempts=3):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body TEXT NOT NULL,
+            visible_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )''')
+
+    def put(self, body):
+        self.put_many([body])
+
+    def put_many(self, bodies):
+        now = time.time()
+        with self.__lock:
+            self.__db.executemany(
+                'INSERT INTO messages (body, visible_at) VALUES (?, ?)',
+                [(json.dumps(body), now) for body in bodies]
+            )
+
+    def get(self, wait=0):
+        deadline = time.time() + wait
+        while True:
+            now = time.time()
+            with self.__lock:
+                self.__db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = self.__db.execute(
+                        'SELECT id, body, attempts FROM messages '
+                        'WHERE visible_at <= ? AND attempts < ? ORDER BY id LIMIT 1',
+                        (now, self.max_attempts)
+                    ).fetchone()
+                    if row:
+                        self.__db.execute(
+                            'UPDATE messages SET visible_at = ?, attempts = ? WHERE id = ?',
+                            (now + self.visibility_timeout, row[2] + 1, row[0])
+                        )
+                finally:
+                    self.__db.execute('COMMIT')
+            if row:
+                return Message(row[0], json.loads(row[1]), row[2] + 1)
+            if now >= deadline:
+                return None
+            time.sleep(min(0.5, max(0, deadline - now)))
+
+    def ack(self, message):
+        with self.__lock:
+            self.__db.execute('DELETE FROM messages WHERE id = ?', (message.id,))
+
+
+class SQSQueue(WorkQueue):
+    """
+    Amazon SQS queue
+    """
+
+    def __init__(self, url, visibility_timeout=300):
+        import boto3
+
+        self.url = url
+        self.visibility_timeout = visibility_timeout
+        self.client = boto3.client(
+            'sqs', endpoint_url=get_config('queue.sqs_endpoint_url')
+        )
+
+    def put(self, body):
+        self.client.send_message(QueueUrl=self.url, MessageBody=json.dumps(body))
+
+    def put_many(self, bodies):
+        bodies = list(bodies)
+        # at most 10 messages per batch request
+        for i in range(0, len(bodies), 10):
+            res = self.client.send_message_batch(QueueUrl=self.url, Entries=[
+                {'Id': str(n), 'MessageBody': json.dumps(body)}
+                for n, body in enumerate(bodies[i:i + 10])
+            ])
+            if res.get('Failed'):
+                raise RuntimeError('Failed to enqueue {} messages'.format(len(res['Failed'])))
+
+    def get(self, wait=0):
+        res = self.client.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=min(20, int(wait)),
+            VisibilityTimeout=self.visibility_timeout,
+        )
+        for message in res.get('Messages', []):
+            return Message(
+                message['MessageId'], json.loads(message['Body']), message['ReceiptHandle']
+            )
+        return None
+
+    def ack(self, message):
+        self.client.delete_message(QueueUrl=self.url, ReceiptHandle=message.receipt)
+
+
+__queues = {}
+
+
+def get_queue(url=None):
+    """
+    queue for sqlite:///path/to.db, memory:// (in-process) or an SQS queue url
+    (https://sqs.<region>.amazonaws.com/<account>/<name>)
+    """
+
+    cfg = get_config('queue')
+    url = url or cfg['url']
+    if url not in __queues:
+        if url.startswith('sqlite://'):
+            queue = SQLiteQueue(
+                url[len('sqlite://'):], cfg['visibility_timeout'], cfg['max_attempts']
+            )
+        elif url.startswith('memory://'):
+            queue = SQLiteQueue(':memory:', cfg['visibility_timeout'], cfg['max_attempts'])
+        elif url.startswith('https://'):
+            queue = SQSQueue(url, cfg['visibility_timeout'])
+        else:
+            raise ValueError('Unknown queue "{}"'.format(url))
+        __queues[url] = queue
+    return __queues[url]
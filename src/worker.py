@@ -0,0 +1,276 @@
+import json
+import traceback
+from collections import Counter
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from config import get_config
+from src.batch import get_credentials, get_date_range
+from src.dkb import DKBSession, query_info
+from src.lease import get_lease
+from src.sheets import dump_monthly_sums, load_monthly_sums
+from src.sinks import get_sinks
+from src.storage import get_store
+from src.work_queue import get_queue
+
+
+def split_windows(start_date, end_date, days):
+    """
+    non overlapping (start_date, end_date) windows of at most `days` days,
+    newest first, one window for `days` <= 0
+    """
+
+    if days <= 0:
+        return [(start_date, end_date)]
+
+    windows = []
+    end = end_date
+    while end >= start_date:
+        start = max(start_date, end - timedelta(days=days - 1))
+        windows.append((start, end))
+        end = start - timedelta(days=1)
+    return windows
+
+
+def coordinate(tenant, queue=None, verbose=True):
+    """
+    login, discover the accounts of a tenant and enqueue one work item per
+    account and date window
+    """
+
+    if not tenant.get('time_span'):
+        raise ValueError('time_span has to be specified')
+
+    queue_cfg = get_config('queue')
+    queue = queue or get_queue()
+    creds = get_credentials(tenant.get('credentials', 'DKB'))
+    start_date, end_date = get_date_range(
+        str(tenant['time_span']), tenant.get('end_date', '')
+    )
+
+    session = DKBSession(
+        username=creds['username'],
+        password=creds['password'],
+        verbose=verbose
+    )
+    session.login()
+    exports = session.plan(
+        split_windows(start_date, end_date, queue_cfg['window_days'])
+    )
+    session.logout()
+
+    run_id = '{}-{}'.format(datetime.now().strftime('%Y%m%dT%H%M%S'), uuid4().hex[:8])
+    info = query_info(start_date, end_date)
+    windows = Counter(account['account_number'] for account, _ in exports)
+    accounts = list(windows)
+
+    items = []
+    window = Counter()
+    for account, params in exports:
+        account_number = account['account_number']
+        items.append({
+            'run_id': run_id,
+            'tenant': tenant.get('name', 'default'),
+            'credentials': tenant.get('credentials', 'DKB'),
+            'sheet_name': tenant.get('sheet_name'),
+            'columnar_target': tenant.get('columnar_target'),
+            'search_target': tenant.get('search_target'),
+            'info': info,
+            'accounts': accounts,
+            'account': account,
+            'params': params,
+            'window': window[account_number],
+            'windows': windows[account_number],
+        })
+        window[account_number] += 1
+
+    queue.put_many(items)
+    if verbose:
+        print('Enqueued {} work items of run "{}"'.format(len(items), run_id))
+
+    return {'run_id': run_id, 'items': len(items), 'accounts': accounts}
+
+
+class Worker(object):
+    """
+    Processes the work items of coordinated runs. The last window of an
+    account writes the account to the sinks, the last account the dashboard.
+    Workers finishing at once claim these steps, only one of them runs each.
+    Usage
+    -----
+    >>> worker = Worker()
+    >>> worker.drain(get_queue())
+    >>> worker.close()
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.__results = get_store(get_config('queue.results_target'))
+        self.__sessions = {}
+        self.__sinks_cache = {}
+        self.__client = None
+
+    def __session(self, credentials):
+        """
+        one logged in banking session per credentials for all items of a worker
+        """
+
+        if credentials not in self.__sessions:
+            creds = get_credentials(credentials)
+            session = DKBSession(
+                username=creds['username'],
+                password=creds['password'],
+                verbose=self.verbose
+            )
+            session.login()
+            self.__sessions[credentials] = session
+        return self.__sessions[credentials]
+
+    def __account_sinks(self, item):
+        key = (item['sheet_name'], item['columnar_target'], item.get('search_target'))
+        if key not in self.__sinks_cache:
+            self.__sinks_cache[key] = self.__sinks(item)
+        return self.__sinks_cache[key]
+
+    def __sinks(self, item, monthly=None):
+        names = [name.strip() for name in get_config('sinks')]
+        options = {'gsheet': {'sheet_name': item['sheet_name'], 'monthly': monthly}}
+        if 'gsheet' in names:
+            if not self.__client:
+                from src.sheets import get_client
+                self.__client = get_client(self.verbose)
+            options['gsheet']['client'] = self.__client
+        if item['columnar_target']:
+            options['columnar'] = {'target': item['columnar_target']}
+        if item.get('search_target'):
+            options['search'] = {'target': item['search_target']}
+        return get_sinks(names, verbose=self.verbose, options=options)
+
+    def __read(self, key):
+        return json.loads(self.__results.read(key).decode('utf-8'))
+
+    def __write(self, key, value):
+        self.__results.write(key, json.dumps(value).encode('utf-8'))
+
+    def __claim(self, key, done, finalize):
+        """
+        `finalize()` in the worker holding the lease of the step, unless the
+        step already wrote its `done` result. The lease of a failed step is
+        released, the redelivered item runs it again.
+        """
+
+        if not get_config('lock.enabled'):
+            if self.__results.read(done) is None:
+                finalize()
+            return
+
+        lease = get_lease()
+        owner = uuid4().hex
+        if not lease.acquire(key, owner, get_config('lock.ttl')):
+            # finalized by another worker
+            return
+        try:
+            if self.__results.read(done) is None:
+                finalize()
+        except Exception as e:
+            lease.release(key, owner, {'status': 'failed', 'err': str(e)})
+            raise
+        lease.release(key, owner, {'status': 'ok'})
+
+    def process(self, item):
+        run_id = item['run_id']
+        account = item['account']
+        account_number = account['account_number']
+
+        session = self.__session(item['credentials'])
+        res = session.fetch_export(data=account, params=item['params'])
+        prefix = '{}/{}/windows/'.format(run_id, account_number)
+        self.__write('{}{}.json'.format(prefix, item['window']), res)
+
+        keys = self.__results.list(prefix)
+        if len(keys) < item['windows']:
+            return
+
+        self.__claim(
+            '{}/{}/finalize'.format(run_id, account_number),
+            '{}/accounts/{}.json'.format(run_id, account_number),
+            lambda: self.__account(item)
+        )
+        if len(self.__results.list('{}/accounts/'.format(run_id))) < len(item['accounts']):
+            return
+        self.__claim(
+            '{}/dashboard'.format(run_id),
+            '{}/result.json'.format(run_id),
+            lambda: self.__dashboard(item)
+        )
+
+    def __account(self, item):
+        run_id = item['run_id']
+        account_number = item['account']['account_number']
+        prefix = '{}/{}/windows/'.format(run_id, account_number)
+
+        # newest window first, its total is the current one
+        windows = [
+            self.__read('{}{}.json'.format(prefix, i)) for i in range(item['windows'])
+        ]
+        data = windows[0]
+        data['transactions'] = [t for window in windows for t in window['transactions']]
+
+        monthly = {}
+        for sink in self.__account_sinks(item):
+            sink.add_data({'info': item['info'], 'accounts': {account_number: data}})
+            sums = getattr(sink, 'monthly', {}).get(data['title'])
+            if sums is not None:
+                monthly[data['title']] = sums
+
+        del data['transactions']
+        self.__write('{}/accounts/{}.json'.format(run_id, account_number), {
+            'account': data,
+            'monthly': {
+                title: dump_monthly_sums(sums) for title, sums in monthly.items()
+            },
+        })
+
+    def __dashboard(self, item):
+        run_id = item['run_id']
+        accounts = {}
+        monthly = {}
+        for account_number in item['accounts']:
+            res = self.__read('{}/accounts/{}.json'.format(run_id, account_number))
+            accounts[account_number] = res['account']
+            for title, sums in res['monthly'].items():
+                monthly[title] = load_monthly_sums(sums)
+
+        data = {'info': item['info'], 'accounts': accounts}
+        for sink in self.__sinks(item, monthly):
+            sink.update_dashboard(data)
+        self.__write('{}/result.json'.format(run_id), data)
+        if self.verbose:
+            print('Finished run "{}"'.format(run_id))
+
+    def drain(self, queue=None, wait=0):
+        """
+        process messages until the queue stays empty for `wait` seconds, failed
+        messages are not acked and delivered again after the visibility timeout
+        """
+
+        queue = queue or get_queue()
+        processed = 0
+        failed = 0
+        while True:
+            message = queue.get(wait=wait)
+            if message is None:
+                break
+            try:
+                self.process(message.body)
+                queue.ack(message)
+                processed += 1
+            except Exception:
+                traceback.print_exc()
+                failed += 1
+        return {'processed': processed, 'failed': failed}
+
+    def close(self):
+        for session in self.__sessions.values():
+            session.logout()
+        self.__sessions = {}